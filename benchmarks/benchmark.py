@@ -0,0 +1,348 @@
+# File:   benchmark.py
+# Author: Sean Watson
+# Date:   16 October 2026
+#
+# Throughput, latency and memory benchmarks for the notehub wrapper.
+#
+# License:
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Sean Watson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in all
+#    copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#    FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#    COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#    IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#    CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Benchmarks the notehub wrapper against a local fake Notehub.org.
+
+Starts a FakeNotehubServer in a separate process, creates notes of each
+size on it and then measures requests per second, latency percentiles and
+peak client memory for each way of fetching or publishing notes:
+
+    serial       get_note in a loop
+    threaded     get_note from several threads sharing one Notehub
+    bulk_get     Notehub.get_notes
+    bulk_create  Notehub.create_notes
+    async        AsyncNotehub.get_note with asyncio.gather (needs aiohttp)
+
+Results are written as JSON. Given a baseline from an earlier run the
+results are compared against it and the exit status is 1 if any scenario
+got slower than the tolerance allows.
+
+Example use:
+
+    python benchmarks/benchmark.py --sizes 1K,1M,16M --output results.json
+    python benchmarks/benchmark.py --baseline results.json
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import notehub
+from fake_notehub import FakeNotehubServer
+
+PID = 'bench-pid'
+PSK = 'bench-psk'
+PASSWORD = 'bench'
+SCENARIOS = ('serial', 'threaded', 'bulk_get', 'bulk_create', 'async')
+UNITS = {'K': 1024, 'M': 1024 * 1024}
+
+
+def parse_size(text):
+    """Parses a size such as 1K, 64K or 16M into bytes."""
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def format_size(size):
+    for unit in ('M', 'K'):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return '%d%s' % (size // UNITS[unit], unit)
+    return str(size)
+
+
+def make_text(size):
+    """Returns markdown note text of about size bytes."""
+    line = 'The quick brown fox jumps over the lazy dog. ' * 2 + '\n'
+    return ('# Benchmark note\n\n' + line * (size // len(line) + 1))[:size]
+
+
+def serve(conn, latency, error_rate):
+    """Runs the fake server, sending its URL back through conn."""
+    server = FakeNotehubServer(publishers={PID: PSK}, latency=latency,
+                               error_rate=error_rate)
+    conn.send(server.url)
+    server.serve_forever()
+
+
+def percentile(latencies, percent):
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    index = max(0, int(round(len(latencies) * percent / 100.0)) - 1)
+    return latencies[min(index, len(latencies) - 1)]
+
+
+class Scenario(object):
+    """Runs one benchmark scenario against the server."""
+
+    def __init__(self, url, workers, transport='http.client'):
+        self.url = url
+        self.workers = workers
+        self.transport = transport
+
+    def client(self, hooks=None):
+        nh = notehub.Notehub(PID, PSK, pool_size=self.workers, hooks=hooks,
+                             transport=self.transport)
+        nh.BASE_URL = self.url
+        return nh
+
+    def timed(self, func, *args):
+        """Calls func, returning (seconds, result-or-error)."""
+        start = time.perf_counter()
+        try:
+            result = func(*args)
+        except notehub.NotehubError as e:
+            result = e
+        return time.perf_counter() - start, result
+
+    def run(self, name, note_ids, text):
+        """Returns (latencies, errors) for a scenario."""
+        return getattr(self, 'run_' + name)(note_ids, text)
+
+    def run_serial(self, note_ids, text):
+        with self.client() as nh:
+            results = [self.timed(nh.get_note, note_id)
+                       for note_id in note_ids]
+        return self.summarize(results)
+
+    def run_threaded(self, note_ids, text):
+        with self.client() as nh:
+            with ThreadPoolExecutor(self.workers) as executor:
+                results = list(executor.map(
+                    lambda note_id: self.timed(nh.get_note, note_id),
+                    note_ids))
+        return self.summarize(results)
+
+    def run_bulk_get(self, note_ids, text):
+        samples = []
+        with self.client(hooks=[samples.append]) as nh:
+            errors = sum(isinstance(note, notehub.NotehubError)
+                         for _, note in nh.get_notes(note_ids, self.workers))
+        return [sample.total for sample in samples], errors
+
+    def run_bulk_create(self, note_ids, text):
+        samples = []
+        specs = ({'note_text': text, 'password': PASSWORD} for _ in note_ids)
+        with self.client(hooks=[samples.append]) as nh:
+            errors = sum(isinstance(note, notehub.NotehubError)
+                         for _, note in nh.create_notes(
+                             specs, max_workers=self.workers))
+        return [sample.total for sample in samples], errors
+
+    def run_async(self, note_ids, text):
+        async def fetch(nh, note_id):
+            start = time.perf_counter()
+            try:
+                result = await nh.get_note(note_id)
+            except notehub.NotehubError as e:
+                result = e
+            return time.perf_counter() - start, result
+
+        async def main():
+            async with notehub.AsyncNotehub(
+                    PID, PSK, pool_size=self.workers,
+                    max_in_flight=self.workers) as nh:
+                nh.BASE_URL = self.url
+                return await asyncio.gather(*[fetch(nh, note_id)
+                                              for note_id in note_ids])
+        return self.summarize(asyncio.run(main()))
+
+    def summarize(self, results):
+        latencies = [seconds for seconds, _ in results]
+        errors = sum(isinstance(result, notehub.NotehubError)
+                     for _, result in results)
+        return latencies, errors
+
+
+def has_aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        return False
+    return True
+
+
+def benchmark(args, url):
+    """Runs every scenario at every size and returns the results."""
+    scenario = Scenario(url, args.workers, args.transport)
+    results = []
+    for size in args.sizes:
+        text = make_text(size)
+        count = max(args.workers, min(args.requests, args.budget // size))
+        # Notes for the read scenarios. Distinct notes so single-flight
+        # coalescing doesn't hide requests.
+        with scenario.client() as nh:
+            note_ids = [note_id for _, note in nh.create_notes(
+                ({'note_text': '%d %s' % (i, text), 'password': PASSWORD}
+                 for i in range(count)), max_workers=args.workers)
+                for note_id in [getattr(note, 'get', lambda k: None)(
+                    'noteID')] if note_id]
+        for name in args.scenarios:
+            if name == 'async' and not has_aiohttp():
+                print('skipping async, aiohttp is not installed')
+                continue
+            start = time.perf_counter()
+            latencies, errors = scenario.run(name, note_ids, text)
+            seconds = time.perf_counter() - start
+            peak = None
+            if args.memory:
+                # A second, shorter run under tracemalloc since tracing
+                # slows the client down too much to time it
+                tracemalloc.start()
+                scenario.run(name, note_ids[:args.workers * 2], text)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            result = {'scenario': name,
+                      'size': size,
+                      'requests': len(note_ids),
+                      'errors': errors,
+                      'seconds': seconds,
+                      'requests_per_second': len(note_ids) / seconds,
+                      'p50': percentile(latencies, 50),
+                      'p95': percentile(latencies, 95),
+                      'p99': percentile(latencies, 99),
+                      'peak_memory_bytes': peak}
+            results.append(result)
+            print('%-12s %6s %6d req %8.1f req/s  p50 %7.2f ms  '
+                  'p99 %7.2f ms  peak %s' % (
+                      name, format_size(size), len(note_ids),
+                      result['requests_per_second'],
+                      (result['p50'] or 0) * 1000,
+                      (result['p99'] or 0) * 1000,
+                      format_size(peak) if peak is not None else '-'))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns a list of regressions against a baseline run."""
+    previous = dict(((r['scenario'], r['size']), r)
+                    for r in baseline['results'])
+    regressions = []
+    for result in results:
+        old = previous.get((result['scenario'], result['size']))
+        if old is None:
+            continue
+        key = '%s %s' % (result['scenario'], format_size(result['size']))
+        if result['requests_per_second'] < \
+                old['requests_per_second'] * (1 - tolerance):
+            regressions.append('%s: %.1f req/s, was %.1f' % (
+                key, result['requests_per_second'],
+                old['requests_per_second']))
+        if old['p99'] and result['p99'] and \
+                result['p99'] > old['p99'] * (1 + tolerance):
+            regressions.append('%s: p99 %.2f ms, was %.2f' % (
+                key, result['p99'] * 1000, old['p99'] * 1000))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='1K,64K,1M,16M',
+                        help='comma separated note sizes (default: '
+                             '%(default)s)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated scenarios (default: all)')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='requests per scenario (default: %(default)s)')
+    parser.add_argument('--budget', default='256M',
+                        help='cap on the note bytes moved per scenario, '
+                             'fewer requests are made for big notes '
+                             '(default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='concurrent requests (default: %(default)s)')
+    parser.add_argument('--transport', default='http.client',
+                        choices=sorted(notehub.TRANSPORTS),
+                        help='the transport Notehub uses (default: '
+                             '%(default)s)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the server waits per request')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of requests the server fails')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help="don't measure peak memory")
+    parser.add_argument('--output', default='benchmark-results.json',
+                        help='where to write the results '
+                             '(default: %(default)s)')
+    parser.add_argument('--baseline',
+                        help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against the baseline '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv)
+    args.sizes = [parse_size(size) for size in args.sizes.split(',')]
+    args.scenarios = args.scenarios.split(',')
+    args.budget = parse_size(args.budget)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario: ' + name)
+
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, daemon=True,
+                                     args=(child, args.latency,
+                                           args.error_rate))
+    server.start()
+    try:
+        results = benchmark(args, parent.recv())
+    finally:
+        server.terminate()
+
+    output = {'python': platform.python_version(),
+              'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'settings': {'workers': args.workers,
+                           'transport': args.transport,
+                           'latency': args.latency,
+                           'error_rate': args.error_rate},
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,280 @@
+# File:   fake_notehub.py
+# Author: Sean Watson
+# Date:   16 October 2026
+#
+# A local stand-in for the Notehub.org API used by the benchmarks.
+#
+# License:
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Sean Watson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in all
+#    copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#    FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#    COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#    IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#    CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""A local stand-in for the Notehub.org API.
+
+Implements GET, POST and PUT on /api/note the way Notehub.org does:
+signatures and passwords are checked and every response is wrapped in the
+same status envelope. Notes are kept in memory. Latency and an error rate
+can be added to every request. Responses are gzip compressed for clients
+that accept it, and gzip request bodies are accepted unless turned off.
+
+Example use:
+
+    server = FakeNotehubServer(publishers={'pid': 'psk'}, latency=0.01)
+    server.start()
+    nh = Notehub('pid', 'psk')
+    nh.BASE_URL = server.url
+    ...
+    server.stop()
+"""
+
+import gzip
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+
+class FakeNotehubHandler(BaseHTTPRequestHandler):
+    """Answers API requests for a FakeNotehubServer."""
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, without this Nagle's
+    # algorithm and delayed ACKs add 40 ms to every response
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self.respond(url.path, lambda: self.server.get_note(
+            self.first(parse_qs(url.query), 'noteID')))
+
+    def do_POST(self):
+        self.respond(self.path, lambda: self.server.create_note(self.form()))
+
+    def do_PUT(self):
+        self.respond(self.path, lambda: self.server.update_note(self.form()))
+
+    def first(self, values, name):
+        return values.get(name, [''])[0]
+
+    def body(self):
+        """Reads the request body, which may use chunked encoding."""
+        if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+            if not size:
+                return b''.join(chunks)
+
+    def form(self):
+        """Reads the form encoded request body into a dict."""
+        body = self.body()
+        if self.headers.get('Content-Encoding', '').lower() == 'gzip':
+            body = gzip.decompress(body)
+        values = parse_qs(body.decode('utf-8'), keep_blank_values=True)
+        return dict((name, value[0]) for name, value in values.items())
+
+    def respond(self, path, handle):
+        """Sends the result of handle() as a JSON response."""
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if path != '/api/note':
+            return self.send(404, {'message': 'Not found'})
+        if server.error_rate and random.random() < server.error_rate:
+            # Drain the body so the connection can be reused
+            self.body()
+            return self.send(503, {'message': 'Service unavailable'})
+        if (self.headers.get('Content-Encoding') and
+                not server.accept_gzip):
+            self.body()
+            return self.send(415, {'message': 'Unsupported encoding'})
+        self.send(200, handle())
+
+    def send(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        if (len(data) >= self.server.gzip_min_size and
+                'gzip' in self.headers.get('Accept-Encoding', '')):
+            data = gzip.compress(data, 6)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeNotehubServer(ThreadingHTTPServer):
+    """A threaded HTTP server that behaves like the Notehub.org API.
+
+    Attributes:
+        publishers: A dict of PID to PSK of the accepted publishers.
+        latency: Seconds to wait before answering each request.
+        error_rate: The fraction of requests answered with a 503.
+        gzip_min_size: The smallest response that is compressed, in bytes.
+        accept_gzip: Whether gzip request bodies are accepted, otherwise
+            they are answered with a 415.
+        requests: The number of requests received.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), publishers=None, latency=0,
+                 error_rate=0, gzip_min_size=1024, accept_gzip=True):
+        ThreadingHTTPServer.__init__(self, address, FakeNotehubHandler)
+        self.publishers = dict(publishers or {})
+        self.latency = latency
+        self.error_rate = error_rate
+        self.gzip_min_size = gzip_min_size
+        self.accept_gzip = accept_gzip
+        self.requests = 0
+        # note ID -> dict with the note, the publisher and the password hash
+        self._notes = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        """The URL to use as Notehub.BASE_URL."""
+        return 'http://%s:%d/api/note' % self.server_address[:2]
+
+    def start(self):
+        """Starts serving on a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops serving and closes the socket."""
+        self.shutdown()
+        self.server_close()
+
+    def finish_request(self, request, client_address):
+        with self._lock:
+            self.requests += 1
+        ThreadingHTTPServer.finish_request(self, request, client_address)
+
+    def _status(self, success, message='', **body):
+        body['status'] = {'success': success, 'message': message}
+        return body
+
+    def _signature(self, pid, text):
+        psk = self.publishers.get(pid)
+        if psk is None:
+            return None
+        return md5((pid + psk + text).encode('utf-8')).hexdigest()
+
+    def _urls(self, note_id):
+        return {'longURL': 'http://notehub.org/' + note_id,
+                'shortURL': 'http://notehub.org/' +
+                md5(note_id.encode('utf-8')).hexdigest()[:5]}
+
+    def get_note(self, note_id):
+        """Returns the GET NOTE response for a note."""
+        with self._lock:
+            note = self._notes.get(note_id)
+            if note is not None:
+                note['views'] += 1
+                note = dict(note)
+        if note is None:
+            return self._status(False, 'Note is not found')
+        title = note['note'].split('\n', 1)[0].strip('# \r')
+        body = {'note': note['note'],
+                'title': title,
+                'publisher': note['pid'],
+                'statistics': {'published': note['published'],
+                               'edited': note['edited'],
+                               'views': str(note['views']),
+                               'publisher': note['pid']}}
+        body.update(self._urls(note_id))
+        return self._status(True, **body)
+
+    def create_note(self, form):
+        """Returns the CREATE NOTE response for a form."""
+        pid, text = form.get('pid', ''), form.get('note', '')
+        signature = self._signature(pid, text)
+        if signature is None:
+            return self._status(False, 'PID is not registered')
+        if signature != form.get('signature'):
+            return self._status(False, 'Signature mismatch')
+        slug = '-'.join(re.findall(r'[a-z0-9]+', text[:80].lower())[:6])
+        with self._lock:
+            date = time.gmtime()
+            prefix = '%d/%d/%d/%s' % (date.tm_year, date.tm_mon,
+                                      date.tm_mday, slug or 'note')
+            note_id = prefix
+            count = 1
+            while note_id in self._notes:
+                note_id = '%s-%d' % (prefix, count)
+                count += 1
+            self._notes[note_id] = {
+                'note': text, 'pid': pid,
+                'password': form.get('password', ''),
+                'published': time.strftime('%a %b %d %H:%M:%S UTC %Y', date),
+                'edited': None, 'views': 0}
+        return self._status(True, noteID=note_id, **self._urls(note_id))
+
+    def update_note(self, form):
+        """Returns the UPDATE NOTE response for a form."""
+        pid, note_id = form.get('pid', ''), form.get('noteId', '')
+        text, password = form.get('note', ''), form.get('password', '')
+        signature = self._signature(pid, note_id + text + password)
+        if signature is None:
+            return self._status(False, 'PID is not registered')
+        if signature != form.get('signature'):
+            return self._status(False, 'Signature mismatch')
+        with self._lock:
+            note = self._notes.get(note_id)
+            if note is None:
+                return self._status(False, 'Note is not found')
+            if note['pid'] != pid:
+                return self._status(False, 'Note has another publisher')
+            if not note['password'] or note['password'] != password:
+                return self._status(False, 'Password is wrong')
+            note['note'] = text
+            note['edited'] = time.strftime('%a %b %d %H:%M:%S UTC %Y',
+                                           time.gmtime())
+        return self._status(True, **self._urls(note_id))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--pid', default='bench')
+    parser.add_argument('--psk', default='bench')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    args = parser.parse_args()
+    server = FakeNotehubServer(('127.0.0.1', args.port), {args.pid: args.psk},
+                               args.latency, args.error_rate)
+    print('Serving on ' + server.url)
+    server.serve_forever()
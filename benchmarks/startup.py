@@ -0,0 +1,168 @@
+# File:   startup.py
+# Author: Sean Watson
+# Date:   16 October 2026
+#
+# Import time and per-request overhead of each notehub transport.
+#
+# License:
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 Sean Watson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in all
+#    copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+#    FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+#    COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+#    IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+#    CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Measures import time and per-request overhead of each notehub transport.
+
+Import time is measured in fresh interpreters, as the time to run
+"import notehub" and to make a first call, less the time the interpreter
+takes to start. Per-request overhead is the median time of a serial
+get_note of a small note from a local FakeNotehubServer, which answers
+in well under a millisecond, so it is mostly the client's own cost.
+
+    http.client  Notehub with the default HTTPClientTransport
+    requests     Notehub with RequestsTransport
+    async        AsyncNotehub (needs aiohttp)
+
+Example use:
+
+    python benchmarks/startup.py --runs 20
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import py_compile
+import subprocess
+import sys
+import time
+
+from benchmark import HERE, PID, PSK, serve
+
+import notehub
+
+BACKENDS = ('http.client', 'requests', 'async')
+
+# Run in a fresh interpreter to time the first call, URL is filled in
+FIRST_CALL = '''
+import notehub
+nh = notehub.Notehub(%(pid)r, %(psk)r, transport=%(transport)r)
+nh.BASE_URL = %(url)r
+nh.get_note(%(note_id)r)
+'''
+
+FIRST_ASYNC_CALL = '''
+import asyncio, notehub
+async def main():
+    async with notehub.AsyncNotehub(%(pid)r, %(psk)r) as nh:
+        nh.BASE_URL = %(url)r
+        await nh.get_note(%(note_id)r)
+asyncio.run(main())
+'''
+
+
+def run_python(code, runs):
+    """Returns the fastest wall time of running code in a new interpreter."""
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', code],
+                              cwd=os.path.dirname(HERE))
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def request_overhead(backend, url, note_id, requests):
+    """Returns the median seconds of a serial get_note."""
+    if backend == 'async':
+        async def main():
+            async with notehub.AsyncNotehub(PID, PSK) as nh:
+                nh.BASE_URL = url
+                times = []
+                for _ in range(requests):
+                    start = time.perf_counter()
+                    await nh.get_note(note_id)
+                    times.append(time.perf_counter() - start)
+                return times
+        return median(asyncio.run(main()))
+    with notehub.Notehub(PID, PSK, transport=backend) as nh:
+        nh.BASE_URL = url
+        times = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            nh.get_note(note_id)
+            times.append(time.perf_counter() - start)
+    return median(times)
+
+
+def has_aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        return False
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10,
+                        help='interpreters started per measurement, the '
+                             'fastest is kept (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='requests per backend (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, daemon=True,
+                                     args=(child, 0, 0))
+    server.start()
+    try:
+        url = parent.recv()
+        with notehub.Notehub(PID, PSK) as nh:
+            nh.BASE_URL = url
+            note_id = nh.create_note('# Startup\n\nA small note.')['noteID']
+
+        # Time loading the module, not compiling it
+        py_compile.compile(notehub.__file__)
+        baseline = run_python('pass', args.runs)
+        imported = run_python('import notehub', args.runs)
+        print('%-12s %8.1f ms' % ('import', (imported - baseline) * 1000))
+        for backend in BACKENDS:
+            if backend == 'async' and not has_aiohttp():
+                print('skipping async, aiohttp is not installed')
+                continue
+            template = FIRST_ASYNC_CALL if backend == 'async' else FIRST_CALL
+            first = run_python(template % {'pid': PID, 'psk': PSK,
+                                           'transport': backend, 'url': url,
+                                           'note_id': note_id}, args.runs)
+            overhead = request_overhead(backend, url, note_id, args.requests)
+            print('%-12s first call %8.1f ms  per request %6.0f us' % (
+                backend, (first - baseline) * 1000, overhead * 1e6))
+    finally:
+        server.terminate()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
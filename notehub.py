@@ -100,187 +100,5201 @@ __author__ = 'Sean Watson'
 __date__ = '18 January 2014'
 
 
+import argparse
+import codecs
+import collections
+import collections.abc
+from copy import deepcopy
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from concurrent.futures import wait
+from datetime import datetime
+import fnmatch
+import gzip
+import heapq
 from hashlib import md5
+from hashlib import sha256
+import http.client
+import io
 import json
-import requests
+import math
+import os
+import random
+import re
+import select
+import sqlite3
 import sys
+import threading
+import time
+import urllib.parse
+import uuid
+import zlib
 
 
 class NotehubError(Exception):
     """Exception thrown by Notehub methods when an error occurs.
+
+    Attributes:
+        status_code: The HTTP response code, or None if no response was
+            received.
     """
-    pass
 
-class Notehub(object):
-    """A wrapper for the Notehub.org api.
+    def __init__(self, message, status_code=None):
+        super(NotehubError, self).__init__(message)
+        self.status_code = status_code
+
+class CircuitOpenError(NotehubError):
+    """Raised instead of making a call while a CircuitBreaker is open.
+    """
+
+def _is_overload(error):
+    """Private. Returns whether a NotehubError suggests Notehub.org is
+    struggling: no response, too many requests or a server error. Errors
+    reported in a successful response, such as a bad password, don't.
+    """
+    code = error.status_code
+    return code is None or code == 429 or code >= 500
+
+def _fan_out(func, items, max_workers, ordered=True):
+    """Private. Calls func on each item using a bounded pool of threads.
+
+    Items are pulled from the iterable lazily. No more than 2 * max_workers
+    calls are submitted ahead of the results that have been consumed, so
+    memory stays bounded however long the iterable is.
+
+    Args:
+        func: A function taking one item.
+        items: An iterable of items.
+        max_workers: The number of worker threads.
+        ordered: Optional. Default True. If True results are yielded in the
+            order of the items, otherwise as soon as they complete.
+
+    Yields:
+        (item, result) tuples where result is what func returned, or the
+        NotehubError it raised.
+    """
+    def call(item):
+        try:
+            return func(item)
+        except NotehubError as e:
+            return e
+
+    window = max_workers * 2
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    # Ordered mode keeps futures in submission order, unordered mode maps
+    # each future back to its item
+    pending = collections.deque() if ordered else {}
+    try:
+        for item in items:
+            future = executor.submit(call, item)
+            if ordered:
+                pending.append((item, future))
+            else:
+                pending[future] = item
+            while len(pending) >= window:
+                for result in _drain(pending, ordered):
+                    yield result
+        while pending:
+            for result in _drain(pending, ordered):
+                yield result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def _drain(pending, ordered):
+    """Private. Removes and returns at least one finished result for _fan_out.
+    """
+    if ordered:
+        item, future = pending.popleft()
+        return [(item, future.result())]
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    return [(pending.pop(future), future.result()) for future in done]
+
+class RateLimiter(object):
+    """A thread-safe token bucket rate limiter.
+
+    Tokens are added at a fixed rate up to a maximum of burst. Each call to
+    acquire() takes one token, waiting until one is available.
 
     Attributes:
-        pid: The publisher ID received from Notehub.org.
-        psk: The publisher secret key received from Notehub.org. 
-        version: The api version to use. (Default: '1.4').
+        rate: The number of tokens added per second.
+        burst: The maximum number of tokens that can be saved up.
     """
 
-    BASE_URL = 'http://notehub.org/api/note'
+    def __init__(self, rate, burst=1):
+        """Constructor for RateLimiter object.
 
-    def __init__(self, pid, psk, version='1.4'):
-        """Constructor for Notehub object.
+        Args:
+            rate: The number of calls allowed per second.
+            burst: Optional. Default 1. The number of calls that can be made
+                back to back after the limiter has been idle.
+        """
+        if rate <= 0:
+            raise ValueError('rate must be greater than 0')
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, blocking until one is available.
+        """
+        # Sleeping off the debt outside the lock serves callers in the
+        # order they arrived
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def reserve(self):
+        """Takes a token without waiting for it.
+
+        Returns:
+            How many seconds to wait before using the token.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            return -self._tokens / self.rate
+
+    def wait_time(self):
+        """Returns how many seconds acquire() would wait if it were called
+        now, without taking a token.
+        """
+        with self._lock:
+            self._refill()
+            return max(0.0, (1 - self._tokens) / self.rate)
+
+    def _refill(self):
+        """Private. Adds the tokens earned since the last call. The lock
+        must be held.
+        """
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+class NoteCache(object):
+    """A thread-safe in-memory cache of GET NOTE responses.
+
+    Entries are evicted least recently used first when there are more than
+    max_entries of them or the notes they hold add up to more than max_bytes.
+    Entries older than ttl seconds are treated as missing.
+
+    Attributes:
+        max_entries: The maximum number of notes to keep. (Default: 1000).
+        max_bytes: The maximum total size of the note text to keep, in UTF-8
+            bytes. None for no limit. (Default: None).
+        ttl: How many seconds a note is kept. None to keep notes until they
+            are evicted. (Default: None).
+        hits: The number of lookups that found a note.
+        misses: The number of lookups that didn't find a note.
+        evictions: The number of notes removed to stay under the limits.
+        expirations: The number of notes removed because they were too old.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=None, ttl=None):
+        """Constructor for NoteCache object.
 
         Args:
-            pid: The publisher ID received from Notehub.org.
-            psk: The publisher secret key received from Notehub.org.
-            version: Optional. Default '1.4'. Which version of the API to use.
+            max_entries: Optional. Default 1000. The maximum number of notes
+                to keep.
+            max_bytes: Optional. The maximum total size of the note text to
+                keep. Default is no limit.
+            ttl: Optional. How many seconds to keep a note for. Default is
+                no limit.
         """
-        self.pid = pid
-        self.psk = psk
-        self.version = version
-    
-    def _request(self, method, params={}, data={}):
-        """Private. Preforms operations common to all API calls.
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._bytes = 0
+        # note_id -> (note, size, expiry time), least recently used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
 
-        Preforms the operations common to all API calls such as contructing the
-        URL, making the HTTP request, and checking the response codes. A dictionary
-        should be passed in either as "params" or "data". If "data" is provided then
-        an HTTP POST request will be used.
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        """The total size of the note text currently held, in bytes.
+        """
+        return self._bytes
+
+    def get(self, note_id):
+        """Looks up a note.
 
         Args:
-            method: The HTTP method to use, GET, POST or PUT
-            params: HTTP GET parameters
-            data: HTTP POST data
+            note_id: The ID of the note.
 
         Returns:
-            A dict populated from the JSON response from the server. The "status"
-            object is removed since error checking is handled here.
+            A copy of the cached dict, or None if the note isn't cached or
+            has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(note_id)
+            if entry is not None and entry[2] is not None \
+                    and entry[2] <= time.monotonic():
+                self._remove(note_id)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(note_id)
+            self.hits += 1
+        return deepcopy(entry[0])
+
+    def put(self, note_id, note):
+        """Adds or replaces a note.
+
+        Args:
+            note_id: The ID of the note.
+            note: The dict returned by Notehub.get_note. A copy is kept.
+        """
+        size = len(note.get('note', '').encode('utf-8'))
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        note = deepcopy(note)
+        with self._lock:
+            self._remove(note_id)
+            self._entries[note_id] = (note, size, expires)
+            self._bytes += size
+            while self._entries and (
+                    len(self._entries) > self.max_entries or
+                    (self.max_bytes is not None and
+                     self._bytes > self.max_bytes)):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, note_id):
+        """Removes a note from the cache if it is there.
+
+        Args:
+            note_id: The ID of the note.
+        """
+        with self._lock:
+            self._remove(note_id)
+
+    def clear(self):
+        """Removes every note from the cache. The counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, note_id):
+        """Private. Removes an entry. The lock must be held.
+        """
+        entry = self._entries.pop(note_id, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+class _SQLiteStore(object):
+    """Private. The connection handling shared by the classes that keep
+    their data in a SQLite file.
+
+    One connection is shared by all threads, used while holding _lock. It
+    is opened lazily and reopened in a forked child, SQLite connections
+    can't be used across a fork.
+    """
+
+    # The start of the NotehubError message for SQLite errors
+    ERROR = 'Error'
+
+    def __init__(self, directory, filename):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, filename)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _create_tables(self, conn):
+        """Private. Creates the tables if they don't exist.
+        """
+        raise NotImplementedError
+
+    def _connect(self):
+        """Private. Returns the connection, opening it if needed. The lock
+        must be held.
+        """
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                               check_same_thread=False)
+        # WAL lets readers in other processes carry on during a write
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        self._create_tables(conn)
+        self._conn = conn
+        self._pid = os.getpid()
+        return conn
+
+    def _transaction(self, func):
+        """Private. Calls func(conn) inside a write transaction.
+
+        Takes the lock, rolls back if func raises, and raises SQLite errors
+        as NotehubError.
+        """
+        with self._lock:
+            try:
+                conn = self._connect()
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    result = func(conn)
+                    conn.execute('COMMIT')
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+                return result
+            except sqlite3.Error as e:
+                raise NotehubError(self.ERROR + ': ' + str(e))
+
+    def _query(self, sql, args=()):
+        """Private. Runs a read only query and returns the first row.
+        """
+        with self._lock:
+            try:
+                return self._connect().execute(sql, args).fetchone()
+            except sqlite3.Error as e:
+                raise NotehubError(self.ERROR + ': ' + str(e))
+
+    def close(self):
+        """Closes the connection to the SQLite file. It is reopened if it is
+        used again.
+        """
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+class DiskNoteCache(_SQLiteStore):
+    """A cache of GET NOTE responses kept in a SQLite file.
+
+    Has the same interface as NoteCache so it can be given to Notehub as its
+    cache. Because the notes are kept on disk they survive restarts and
+    several processes can share the same directory. A forked process opens
+    its own connection to the file the first time it uses the cache.
+
+    The note text is compressed and stored apart from the rest of the
+    response (the URLs, title and statistics) so that expiry and eviction
+    never have to read it. Entries are evicted least recently used first.
+
+    Errors from SQLite, such as the file staying locked by another process
+    for longer than the timeout, are raised as NotehubError.
+
+    Attributes:
+        path: The path of the SQLite file.
+        max_entries: The maximum number of notes to keep. None for no limit.
+            (Default: None).
+        max_bytes: The maximum total size of the stored note text, in
+            compressed bytes. None for no limit. (Default: None).
+        ttl: How many seconds a note is kept. None to keep notes until they
+            are evicted. (Default: None).
+        hits: The number of lookups from this object that found a note.
+        misses: The number of lookups from this object that didn't.
+        evictions: The number of notes this object removed to stay under
+            the limits.
+        expirations: The number of notes this object removed because they
+            were too old.
+    """
+
+    FILENAME = 'notehub-cache.sqlite3'
+    ERROR = 'Cache error'
+
+    def __init__(self, directory, max_entries=None, max_bytes=None, ttl=None):
+        """Constructor for DiskNoteCache object.
+
+        Args:
+            directory: The directory to keep the cache in. It is created if
+                it doesn't exist.
+            max_entries: Optional. The maximum number of notes to keep.
+                Default is no limit.
+            max_bytes: Optional. The maximum total size of the stored note
+                text. Default is no limit.
+            ttl: Optional. How many seconds to keep a note for. Default is
+                no limit.
+        """
+        super(DiskNoteCache, self).__init__(directory, self.FILENAME)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _create_tables(self, conn):
+        """Private. Creates the tables if they don't exist.
+        """
+        conn.execute('CREATE TABLE IF NOT EXISTS meta ('
+                     'note_id TEXT PRIMARY KEY, data TEXT NOT NULL, '
+                     'size INTEGER NOT NULL, expires REAL, '
+                     'accessed REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS meta_accessed '
+                     'ON meta (accessed)')
+        conn.execute('CREATE INDEX IF NOT EXISTS meta_expires '
+                     'ON meta (expires)')
+        conn.execute('CREATE TABLE IF NOT EXISTS body ('
+                     'note_id TEXT PRIMARY KEY, note BLOB NOT NULL)')
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM meta')[0]
+
+    @property
+    def size(self):
+        """The total size of the stored note text, in bytes.
+        """
+        return self._query('SELECT COALESCE(SUM(size), 0) FROM meta')[0]
+
+    def get(self, note_id):
+        """Looks up a note.
+
+        Args:
+            note_id: The ID of the note.
+
+        Returns:
+            The cached dict, or None if the note isn't cached or has expired.
 
         Raises:
-            NotehubError: There was a problem making the API call. The message
-                contains a string explaining what went wrong.
+            NotehubError: The SQLite file couldn't be read.
         """
+        now = time.time()
 
-        # Make the request
-        if method == 'GET':
-            req = requests.get(self.BASE_URL, params=params)
-        elif method == 'POST':
-            req = requests.post(self.BASE_URL, data=data)
-        else: # PUT
-            req = requests.put(self.BASE_URL, data=data)
+        def lookup(conn):
+            # One statement so the metadata and text always come from the
+            # same put, even if another process is writing
+            row = conn.execute('SELECT meta.data, meta.expires, body.note '
+                               'FROM meta JOIN body USING (note_id) '
+                               'WHERE note_id = ?', (note_id,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if row[1] is not None and row[1] <= now:
+                self._delete(conn, [(note_id,)])
+                self.expirations += 1
+                self.misses += 1
+                return None
+            conn.execute('UPDATE meta SET accessed = ? WHERE note_id = ?',
+                         (now, note_id))
+            self.hits += 1
+            return row
 
-        # Check the response code
-        if req.status_code != requests.codes.ok:
-            raise NotehubError('Server returned non-200 response code: '
-                                + str(req.status_code))
+        row = self._transaction(lookup)
+        if row is None:
+            return None
+        note = json.loads(row[0])
+        note['note'] = zlib.decompress(row[2]).decode('utf-8')
+        return note
 
-        # Parse the response
-        resp = req.json()
+    def put(self, note_id, note):
+        """Adds or replaces a note.
 
-        # Check the status
-        try:
-            if resp['status']['success'] != True:
-                raise NotehubError(
-                    'Non successful status: ' + resp['status']['message'])
-            del resp['status']
-        except KeyError:
-            # Sometimes on failure there is no 'status'. 'success' and
-            # 'message' are still there though
-            raise NotehubError(
-                    'Non successful status: ' + resp['message'])
-        return resp
+        Args:
+            note_id: The ID of the note.
+            note: The dict returned by Notehub.get_note.
 
-    def _get_signature(self, text):
-        """Private. Generates a Notehub.org signature with the given text.
+        Raises:
+            NotehubError: The SQLite file couldn't be written.
+        """
+        meta = dict((k, v) for k, v in note.items() if k != 'note')
+        data = json.dumps(meta, separators=(',', ':'))
+        body = zlib.compress(note.get('note', '').encode('utf-8'))
+        now = time.time()
+        expires = now + self.ttl if self.ttl is not None else None
+
+        def insert(conn):
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?, ?, ?, ?)',
+                         (note_id, data, len(body), expires, now))
+            conn.execute('INSERT OR REPLACE INTO body VALUES (?, ?)',
+                         (note_id, sqlite3.Binary(body)))
+            self._evict(conn, now)
+
+        self._transaction(insert)
+
+    def _evict(self, conn, now):
+        """Private. Removes expired notes, then the least recently used
+        notes until the cache is under its limits. Must be called inside a
+        transaction.
+        """
+        expired = conn.execute('SELECT note_id FROM meta '
+                               'WHERE expires <= ?', (now,)).fetchall()
+        self._delete(conn, expired)
+        self.expirations += len(expired)
+        if self.max_entries is None and self.max_bytes is None:
+            return
+        count, size = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM meta').fetchone()
+        rows = conn.execute('SELECT note_id, size FROM meta '
+                            'ORDER BY accessed')
+        evicted = []
+        for note_id, entry_size in rows:
+            if ((self.max_entries is None or count <= self.max_entries) and
+                    (self.max_bytes is None or size <= self.max_bytes)):
+                break
+            evicted.append((note_id,))
+            count -= 1
+            size -= entry_size
+        self._delete(conn, evicted)
+        self.evictions += len(evicted)
+
+    def _delete(self, conn, note_ids):
+        """Private. Deletes notes, given as a list of 1-tuples.
+        """
+        conn.executemany('DELETE FROM meta WHERE note_id = ?', note_ids)
+        conn.executemany('DELETE FROM body WHERE note_id = ?', note_ids)
+
+    def invalidate(self, note_id):
+        """Removes a note from the cache if it is there.
 
         Args:
-            text: The text to be included in the signature.
+            note_id: The ID of the note.
+
+        Raises:
+            NotehubError: The SQLite file couldn't be written.
         """
-        full_text = self.pid + self.psk + text
-        return md5(full_text.encode('utf-8')).hexdigest()
+        self._transaction(lambda conn: self._delete(conn, [(note_id,)]))
 
+    def clear(self):
+        """Removes every note from the cache. The counters are kept.
 
-    def get_note(self, note_id):
-        """Retreives the text of a note on Notehub.org.
+        Raises:
+            NotehubError: The SQLite file couldn't be written.
+        """
+        def delete_all(conn):
+            conn.execute('DELETE FROM meta')
+            conn.execute('DELETE FROM body')
 
-        Makes a call to Notehub.org's GET NOTE api. This returns
-        the text of a note from a given note ID. It also returns
-        some URLs that link to the note and some statistics about it.
+        self._transaction(delete_all)
+
+class ContentHashIndex(_SQLiteStore):
+    """An index of the text last published to each note, kept in a SQLite
+    file.
+
+    Given to Notehub as its index, update_note skips the call when the new
+    text is the same as the text last published, and create_note and
+    update_note record the text they publish. Only a hash of the text is
+    kept.
+
+    A note missing from the index, e.g. after the file was deleted or for
+    notes published elsewhere, can be filled in from Notehub.org. With
+    rebuild set update_note does this itself, fetching the note with
+    get_note the first time it is updated, and rebuild_from() fills in
+    many notes at once.
+
+    Errors from SQLite are raised as NotehubError.
+
+    Attributes:
+        path: The path of the SQLite file.
+        rebuild: If True update_note fetches notes missing from the index
+            to check whether they changed. (Default: True).
+    """
+
+    FILENAME = 'notehub-index.sqlite3'
+    ERROR = 'Index error'
+
+    def __init__(self, directory, rebuild=True):
+        """Constructor for ContentHashIndex object.
 
         Args:
-            note_id: The ID of the note to request.
+            directory: The directory to keep the index in. It is created if
+                it doesn't exist.
+            rebuild: Optional. Default True. Whether update_note fetches
+                notes missing from the index.
+        """
+        super(ContentHashIndex, self).__init__(directory, self.FILENAME)
+        self.rebuild = rebuild
+
+    def _create_tables(self, conn):
+        """Private. Creates the tables if they don't exist.
+        """
+        conn.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                     'note_id TEXT PRIMARY KEY, hash TEXT NOT NULL)')
+
+    @staticmethod
+    def hash_text(text):
+        """Returns the hash the index keeps for a note's text.
+        """
+        digest = sha256()
+        for start in range(0, len(text), _NotehubBase.CHUNK_SIZE):
+            digest.update(
+                text[start:start + _NotehubBase.CHUNK_SIZE].encode('utf-8'))
+        return digest.hexdigest()
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM hashes')[0]
+
+    def get(self, note_id):
+        """Looks up the hash of the text last published to a note.
+
+        Args:
+            note_id: The ID of the note.
 
         Returns:
-            A dict populated from the JSON response of the API call.
+            The hash, or None if the note isn't in the index.
 
         Raises:
-            NotehubError: There was a problem making the call. Check the
-                message.
+            NotehubError: The SQLite file couldn't be read.
         """
-        params = {'noteID': note_id,
-                  'version': self.version,
-            }
-        return self._request('GET', params=params)
+        row = self._query('SELECT hash FROM hashes WHERE note_id = ?',
+                          (note_id,))
+        return row[0] if row is not None else None
 
-    def create_note(self, note_text, password='', theme='', text_font='',
-                    header_font=''):
-        """Creates a note on Notehub.org with the given text.
+    def put(self, note_id, text):
+        """Records the text published to a note.
 
-        Makes a call to Notehub.orgs CREATE NOTE api. To edit a note later
-        a password must be given. If successful the note's ID and some URLs
-        linking too it will be returned.
+        Args:
+            note_id: The ID of the note.
+            text: The text of the note.
+
+        Raises:
+            NotehubError: The SQLite file couldn't be written.
+        """
+        digest = self.hash_text(text)
+        self._transaction(lambda conn: conn.execute(
+            'INSERT OR REPLACE INTO hashes VALUES (?, ?)', (note_id, digest)))
+
+    def is_unchanged(self, note_id, text):
+        """Checks whether text is the text last published to a note.
 
         Args:
-            note_text: The ID of the note to request.
-            password: Optional. A password to allow for updating the note.
-            theme: Optional. The color theme to use.
-            text_font: Optional. Font to use for body text.
-            header_font: Optional. Font to use for header text.
+            note_id: The ID of the note.
+            text: The text of the note.
 
         Returns:
-            A dict populated from the JSON response of the API call.
+            True if it is, False if it isn't or the note isn't in the index.
 
         Raises:
-            NotehubError: There was a problem making the call. Check the
-                message.
+            NotehubError: The SQLite file couldn't be read.
         """
-        data = {'note': note_text,
-                'pid': self.pid,
-                'signature': self._get_signature(note_text),
-                'version': self.version,
-            }
-        if password:
-            data['password'] = md5(password.encode('utf-8')).hexdigest()
-        if theme:
-            data['theme'] = theme
-        if text_font:
-            data['text-font'] = text_font
-        if header_font:
-            data['header-font'] = header_font
-        return self._request('POST', data=data)
+        return self.get(note_id) == self.hash_text(text)
 
-    def update_note(self, note_id, new_note_text, password):
-        """Edits a note on Notehub.org.
+    def invalidate(self, note_id):
+        """Removes a note from the index if it is there.
 
-        Makes a call to Notehub.org's UPDATE NOTE api. The note must have
-        been originally created with a password to allow updating. If
-        successful some URLs that link to the note will be returned.
+        Args:
+            note_id: The ID of the note.
+
+        Raises:
+            NotehubError: The SQLite file couldn't be written.
+        """
+        self._transaction(lambda conn: conn.execute(
+            'DELETE FROM hashes WHERE note_id = ?', (note_id,)))
+
+    def clear(self):
+        """Removes every note from the index.
+
+        Raises:
+            NotehubError: The SQLite file couldn't be written.
+        """
+        self._transaction(lambda conn: conn.execute('DELETE FROM hashes'))
+
+    def rebuild_from(self, notehub, note_ids, max_workers=None):
+        """Fills in the index from the notes on Notehub.org.
 
         Args:
-            note_id: The ID of the note to request.
-            new_note_text: The text to replace the existing text with.
-            password: The password the note was created with.
+            notehub: The Notehub object to fetch the notes with.
+            note_ids: An iterable of the IDs of the notes to fetch.
+            max_workers: Optional. Default the pool_size of notehub. The
+                number of requests to make at once.
 
         Returns:
-            A dict populated from the JSON response of the API call.
+            A dict of note IDs to the NotehubError for the notes that
+            couldn't be fetched.
 
         Raises:
-            NotehubError: There was a problem making the call. Check the
-                message.
+            NotehubError: The SQLite file couldn't be written.
         """
-        encoded_password = md5(password.encode('utf-8')).hexdigest()
-        data = {'noteId': note_id,
-                'note': new_note_text,
-                'pid': self.pid,
-                'signature': self._get_signature(
-                    note_id + new_note_text + encoded_password),
-                'password': encoded_password,
-                'version': self.version,
-            }
-        return self._request('PUT', data=data)
+        errors = {}
+        for note_id, note in notehub.get_notes(note_ids, max_workers,
+                                               ordered=False):
+            if isinstance(note, NotehubError):
+                errors[note_id] = note
+            else:
+                self.put(note_id, note['note'])
+        return errors
+
+class MirrorManifest(_SQLiteStore):
+    """What a Mirror has published, kept in a SQLite file.
+
+    Maps each file's path, relative to the mirrored directory, to its
+    modification time and size, a hash of its text, the ID of its note and
+    a hash of the password the note was created with. Each upload is saved
+    in its own transaction as soon as it finishes, so an interrupted run
+    picks up where it stopped.
+
+    Errors from SQLite are raised as NotehubError.
+
+    Attributes:
+        path: The path of the SQLite file.
+    """
+
+    FILENAME = '.notehub-mirror.sqlite3'
+    ERROR = 'Manifest error'
+
+    # The columns of an entry, after the path
+    FIELDS = ('mtime', 'size', 'hash', 'note_id', 'password_hash')
+
+    def __init__(self, directory):
+        """Constructor for MirrorManifest object.
+
+        Args:
+            directory: The directory to keep the manifest in. It is created
+                if it doesn't exist.
+        """
+        super(MirrorManifest, self).__init__(directory, self.FILENAME)
+
+    def _create_tables(self, conn):
+        """Private. Creates the tables if they don't exist.
+        """
+        conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                     'path TEXT PRIMARY KEY, mtime INTEGER NOT NULL, '
+                     'size INTEGER NOT NULL, hash TEXT NOT NULL, '
+                     'note_id TEXT NOT NULL, password_hash TEXT NOT NULL)')
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM files')[0]
+
+    def get(self, path):
+        """Looks up a file.
+
+        Args:
+            path: The path of the file, relative to the mirrored directory.
+
+        Returns:
+            A dict with the FIELDS of the entry, or None if the file hasn't
+            been published.
+
+        Raises:
+            NotehubError: The SQLite file couldn't be read.
+        """
+        row = self._query('SELECT %s FROM files WHERE path = ?' %
+                          ', '.join(self.FIELDS), (path,))
+        return dict(zip(self.FIELDS, row)) if row is not None else None
+
+    def paths(self):
+        """Returns the set of paths in the manifest.
+
+        Raises:
+            NotehubError: The SQLite file couldn't be read.
+        """
+        with self._lock:
+            try:
+                rows = self._connect().execute(
+                    'SELECT path FROM files').fetchall()
+            except sqlite3.Error as e:
+                raise NotehubError(self.ERROR + ': ' + str(e))
+        return set(row[0] for row in rows)
+
+    def put(self, path, mtime, size, digest, note_id, password_hash):
+        """Adds or replaces a file's entry.
+
+        Args:
+            path: The path of the file, relative to the mirrored directory.
+            mtime: The modification time of the file, in nanoseconds.
+            size: The size of the file in bytes.
+            digest: ContentHashIndex.hash_text of the text of the file.
+            note_id: The ID of the file's note.
+            password_hash: The hashed password the note was created with.
+
+        Raises:
+            NotehubError: The SQLite file couldn't be written.
+        """
+        self._transaction(lambda conn: conn.execute(
+            'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+            (path, mtime, size, digest, note_id, password_hash)))
+
+    def invalidate(self, path):
+        """Removes a file's entry if it is there.
+
+        Raises:
+            NotehubError: The SQLite file couldn't be written.
+        """
+        self._transaction(lambda conn: conn.execute(
+            'DELETE FROM files WHERE path = ?', (path,)))
+
+class NoteOwners(_SQLiteStore):
+    """A record of which publisher ID created each note, kept in a SQLite
+    file.
+
+    NotehubPool uses it to make update_note calls with the credentials that
+    created the note. Errors from SQLite are raised as NotehubError.
+
+    Attributes:
+        path: The path of the SQLite file.
+    """
+
+    FILENAME = 'notehub-owners.sqlite3'
+    ERROR = 'Owners error'
+
+    def __init__(self, directory):
+        """Constructor for NoteOwners object.
+
+        Args:
+            directory: The directory to keep the file in. It is created if
+                it doesn't exist.
+        """
+        super(NoteOwners, self).__init__(directory, self.FILENAME)
+
+    def _create_tables(self, conn):
+        """Private. Creates the tables if they don't exist.
+        """
+        conn.execute('CREATE TABLE IF NOT EXISTS owners ('
+                     'note_id TEXT PRIMARY KEY, pid TEXT NOT NULL)')
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM owners')[0]
+
+    def get(self, note_id):
+        """Looks up the publisher ID that created a note.
+
+        Returns:
+            The publisher ID, or None if the note isn't recorded.
+
+        Raises:
+            NotehubError: The SQLite file couldn't be read.
+        """
+        row = self._query('SELECT pid FROM owners WHERE note_id = ?',
+                          (note_id,))
+        return row[0] if row is not None else None
+
+    def put(self, note_id, pid):
+        """Records the publisher ID that created a note.
+
+        Raises:
+            NotehubError: The SQLite file couldn't be written.
+        """
+        self._transaction(lambda conn: conn.execute(
+            'INSERT OR REPLACE INTO owners VALUES (?, ?)', (note_id, pid)))
+
+class RetryPolicy(object):
+    """Decides which failed calls Notehub retries and when.
+
+    A call is retried if no response was received or the response code is
+    one of retry_status_codes. Retries wait for a random time between 0 and
+    backoff * 2 ** (retry number - 1) seconds, capped at max_backoff.
+    CREATE NOTE calls are never retried since retrying one could publish the
+    note twice.
+
+    Hedged requests can be used to cut the tail latency of GET NOTE. If
+    no response has arrived after hedge_after seconds a second request is
+    made and whichever answers first is used.
+
+    Attributes:
+        max_attempts: The maximum number of requests made for one call,
+            including the first. (Default: 3).
+        backoff: The base wait before a retry, in seconds. (Default: 0.1).
+        max_backoff: The longest wait before a retry, in seconds.
+            (Default: 10).
+        retry_status_codes: The response codes that are retried.
+            (Default: 429, 500, 502, 503 and 504).
+        deadline: The total number of seconds a call may take, including
+            retries, or None for no limit. (Default: None).
+        hedge_after: Seconds to wait before sending a second GET NOTE
+            request, or None to never hedge. (Default: None).
+    """
+
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_attempts=3, backoff=0.1, max_backoff=10,
+                 retry_status_codes=RETRY_STATUS_CODES, deadline=None,
+                 hedge_after=None):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_status_codes = retry_status_codes
+        self.deadline = deadline
+        self.hedge_after = hedge_after
+
+    def should_retry(self, error):
+        """Returns whether a NotehubError is worth retrying.
+        """
+        if isinstance(error, CircuitOpenError):
+            return False
+        return (error.status_code is None or
+                error.status_code in self.retry_status_codes)
+
+    def get_delay(self, retry):
+        """Returns how many seconds to wait before a retry.
+
+        Args:
+            retry: Which retry this is, starting at 1.
+        """
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** (retry - 1)))
+
+class ConcurrencyLimiter(object):
+    """Adapts how many requests a Notehub object has in flight.
+
+    Uses additive increase, multiplicative decrease: the limit grows by
+    about one for each limit's worth of requests that succeed without
+    latency rising, and is multiplied by decrease when a request fails
+    with no response, a 429 or a 5xx, or when the recent latency rises
+    above latency_tolerance times the long run latency. Only one decrease
+    is made for the requests that were in flight together, so a burst of
+    failures doesn't collapse the limit to min_limit.
+
+    Calls beyond the limit wait for a request to finish. It is thread-safe.
+
+    Attributes:
+        limit: The current limit, read it for monitoring. It is a float,
+            int(limit) requests can be in flight.
+        in_flight: The number of requests in flight.
+        min_limit: The lowest the limit goes. (Default: 1).
+        max_limit: The highest the limit goes. (Default: 64).
+        decrease: What the limit is multiplied by to shrink it.
+            (Default: 0.5).
+        latency_tolerance: How many times the long run latency the recent
+            latency can reach before the limit shrinks. (Default: 2).
+        latency: The recent latency, a moving average in seconds.
+        baseline_latency: The long run latency, a slower moving average.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=64, decrease=0.5,
+                 latency_tolerance=2.0):
+        """Constructor for ConcurrencyLimiter object.
+
+        Args:
+            initial: Optional. Default 4. The limit to start at.
+            min_limit: Optional. Default 1. The lowest the limit goes.
+            max_limit: Optional. Default 64. The highest the limit goes.
+            decrease: Optional. Default 0.5. What the limit is multiplied by
+                to shrink it.
+            latency_tolerance: Optional. Default 2. How far latency can rise
+                before the limit shrinks.
+        """
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.latency = None
+        self.baseline_latency = None
+        self._started = 0
+        # Requests started before this number were in flight at the last
+        # decrease
+        self._decreased_at = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Waits until a request can be made.
+
+        Returns:
+            A token to pass to release.
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            self._started += 1
+            return self._started
+
+    def release(self, token, latency, error=None):
+        """Records a finished request and adjusts the limit.
+
+        Args:
+            token: What acquire returned.
+            latency: How long the request took, in seconds, or None if it
+                was interrupted and shouldn't change the limit.
+            error: Optional. The NotehubError the request failed with.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+            if latency is None:
+                return
+            if error is not None and _is_overload(error):
+                self._shrink(token)
+                return
+            if self.latency is None:
+                self.latency = self.baseline_latency = latency
+            else:
+                self.latency += (latency - self.latency) * 0.2
+                self.baseline_latency += (latency -
+                                          self.baseline_latency) * 0.02
+            if self.latency > self.baseline_latency * self.latency_tolerance:
+                self._shrink(token)
+            elif error is None:
+                grown = self.limit + 1.0 / self.limit
+                self.limit = min(self.max_limit, grown)
+                self._condition.notify()
+
+    def _shrink(self, token):
+        """Private. Decreases the limit, once per group of requests that
+        were in flight together. The lock must be held.
+        """
+        if token <= self._decreased_at:
+            return
+        self._decreased_at = self._started
+        self.limit = max(self.min_limit, self.limit * self.decrease)
+
+class CircuitBreaker(object):
+    """Makes Notehub fail fast while Notehub.org is failing.
+
+    Keeps the outcome of the last window requests. When at least
+    min_requests have been made and the share of them that failed with no
+    response, a 429 or a 5xx reaches failure_threshold the breaker opens
+    and calls raise CircuitOpenError without a request being made. After
+    cooldown seconds it lets one request through: if that succeeds the
+    breaker closes, otherwise it stays open for another cooldown.
+
+    It is thread-safe.
+
+    Attributes:
+        state: 'closed', 'open' or 'half_open', read it for monitoring.
+        failure_threshold: The share of failed requests that opens the
+            breaker. (Default: 0.5).
+        window: How many recent requests are counted. (Default: 20).
+        min_requests: How many requests must be counted before the breaker
+            can open. (Default: 10).
+        cooldown: How many seconds the breaker stays open. (Default: 30).
+        opened: The number of times the breaker has opened.
+    """
+
+    def __init__(self, failure_threshold=0.5, window=20, min_requests=10,
+                 cooldown=30):
+        """Constructor for CircuitBreaker object.
+
+        Args:
+            failure_threshold: Optional. Default 0.5. The share of failed
+                requests that opens the breaker.
+            window: Optional. Default 20. How many recent requests are
+                counted.
+            min_requests: Optional. Default 10. How many requests must be
+                counted before the breaker can open.
+            cooldown: Optional. Default 30. How many seconds the breaker
+                stays open.
+        """
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.opened = 0
+        self._results = collections.deque(maxlen=window)
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def error_rate(self):
+        """The share of the counted requests that failed.
+        """
+        with self._lock:
+            if not self._results:
+                return 0.0
+            return self._results.count(False) / float(len(self._results))
+
+    def before_request(self):
+        """Checks whether a request may be made.
+
+        Raises:
+            CircuitOpenError: The breaker is open.
+        """
+        with self._lock:
+            if self.state == 'closed':
+                return
+            if (self.state == 'open' and
+                    time.monotonic() - self._opened_at >= self.cooldown):
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._trial:
+                self._trial = True
+                return
+            raise CircuitOpenError('Circuit breaker is open')
+
+    def record(self, error=None):
+        """Records the outcome of a request allowed by before_request.
+
+        Args:
+            error: Optional. The NotehubError the request failed with.
+        """
+        failed = error is not None and _is_overload(error)
+        with self._lock:
+            if self.state == 'half_open':
+                self._trial = False
+                if failed:
+                    self._open()
+                else:
+                    self.state = 'closed'
+                    self._results.clear()
+                return
+            self._results.append(not failed)
+            if (self.state == 'closed' and
+                    len(self._results) >= self.min_requests and
+                    self._results.count(False) >=
+                    self.failure_threshold * len(self._results)):
+                self._open()
+
+    def cancel(self):
+        """Records that a request allowed by before_request was interrupted
+        and has no outcome.
+        """
+        with self._lock:
+            self._trial = False
+
+    def _open(self):
+        """Private. Opens the breaker. The lock must be held.
+        """
+        self.state = 'open'
+        self.opened += 1
+        self._opened_at = time.monotonic()
+        self._results.clear()
+
+class CallSample(object):
+    """The measurements of one Notehub call, passed to every hook.
+
+    Times are in seconds. A call that was retried adds up the phases of all
+    of its attempts, total also includes the time spent waiting between
+    them.
+
+    Attributes:
+        call: The method called, 'get_note', 'create_note' or 'update_note'.
+        method: The HTTP method used.
+        status_code: The HTTP response code of the last attempt, or None if
+            no response was received.
+        error: The class name of the exception the call raised, or None.
+        attempts: The number of HTTP requests made.
+        request_bytes: The size of the request body as sent, or of the URL
+            for GET.
+        response_bytes: The size of the response body, after decompressing.
+        request_bytes_saved: How many bytes compressing the request body
+            saved.
+        response_bytes_saved: How many bytes the server saved by compressing
+            the response body.
+        sign: Time spent building the request, signing and hashing.
+        compress: Time spent compressing the request body and decompressing
+            the response body.
+        connect: Time spent opening connections.
+        wait: Time spent waiting for the server to start answering.
+        download: Time spent reading the response body.
+        parse: Time spent parsing and checking the response.
+        total: Time for the whole call.
+    """
+
+    __slots__ = ('call', 'method', 'status_code', 'error', 'attempts',
+                 'request_bytes', 'response_bytes', 'request_bytes_saved',
+                 'response_bytes_saved', 'sign', 'compress', 'connect', 'wait',
+                 'download', 'parse', 'total')
+
+    PHASES = ('sign', 'compress', 'connect', 'wait', 'download', 'parse',
+              'total')
+
+    def __init__(self, call, method):
+        self.call = call
+        self.method = method
+        self.status_code = None
+        self.error = None
+        self.attempts = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.request_bytes_saved = 0
+        self.response_bytes_saved = 0
+        self.sign = 0.0
+        self.compress = 0.0
+        self.connect = 0.0
+        self.wait = 0.0
+        self.download = 0.0
+        self.parse = 0.0
+        self.total = 0.0
+
+    def __repr__(self):
+        return 'CallSample(%s)' % ', '.join(
+            '%s=%r' % (name, getattr(self, name)) for name in self.__slots__)
+
+class LatencyHistogram(object):
+    """A hook that keeps latency histograms of Notehub calls.
+
+    Keeps a histogram per call and phase, with buckets 2% wide so
+    percentiles are accurate to within 2% and memory doesn't grow with the
+    number of calls. Also counts response codes and errors.
+
+    Example use:
+
+        histogram = LatencyHistogram()
+        nh = Notehub(PID, PSK, hooks=[histogram])
+        ...
+        print(histogram.percentiles('get_note'))
+
+    Attributes:
+        status_codes: A Counter of (call, status_code) pairs.
+        errors: A Counter of (call, error class name) pairs.
+    """
+
+    GROWTH = 1.02
+    SMALLEST = 1e-6
+
+    def __init__(self):
+        # (call, phase) -> {bucket: count}
+        self._buckets = {}
+        self._counts = collections.Counter()
+        self.status_codes = collections.Counter()
+        self.errors = collections.Counter()
+        self._lock = threading.Lock()
+        self._log_growth = math.log(self.GROWTH)
+
+    def __call__(self, sample):
+        with self._lock:
+            self._counts[sample.call] += 1
+            self.status_codes[(sample.call, sample.status_code)] += 1
+            if sample.error is not None:
+                self.errors[(sample.call, sample.error)] += 1
+            for phase in CallSample.PHASES:
+                buckets = self._buckets.setdefault((sample.call, phase), {})
+                bucket = self._bucket(getattr(sample, phase))
+                buckets[bucket] = buckets.get(bucket, 0) + 1
+
+    def _bucket(self, seconds):
+        """Private. Returns the bucket a time falls in.
+        """
+        if seconds <= self.SMALLEST:
+            return 0
+        return int(math.log(seconds / self.SMALLEST) / self._log_growth) + 1
+
+    def count(self, call):
+        """Returns the number of samples recorded for a call.
+        """
+        return self._counts[call]
+
+    def percentile(self, call, percent, phase='total'):
+        """Returns a percentile of the recorded times.
+
+        Args:
+            call: 'get_note', 'create_note' or 'update_note'.
+            percent: The percentile to return, from 0 to 100.
+            phase: Optional. Default 'total'. One of CallSample.PHASES.
+
+        Returns:
+            The time in seconds, or None if nothing has been recorded.
+        """
+        with self._lock:
+            buckets = sorted(self._buckets.get((call, phase), {}).items())
+        total = sum(count for _, count in buckets)
+        if not total:
+            return None
+        rank = max(1, int(math.ceil(total * percent / 100.0)))
+        seen = 0
+        for bucket, count in buckets:
+            seen += count
+            if seen >= rank:
+                break
+        if bucket == 0:
+            return 0.0
+        # The middle of the bucket
+        return self.SMALLEST * self.GROWTH ** (bucket - 0.5)
+
+    def percentiles(self, call, phase='total'):
+        """Returns the p50, p95 and p99 times of a call, in seconds.
+
+        Returns:
+            A dict with keys 'p50', 'p95' and 'p99'.
+        """
+        return dict(('p%d' % percent, self.percentile(call, percent, phase))
+                    for percent in (50, 95, 99))
+
+class _CallTimer(object):
+    """Private. Collects the CallSample of one call for the hooks.
+    """
+
+    def __init__(self, call, method):
+        self.sample = CallSample(call, method)
+        self.start = time.perf_counter()
+
+    def finish(self, hooks, error=None):
+        """Fills in the total time and the error and calls the hooks.
+        """
+        sample = self.sample
+        sample.total = time.perf_counter() - self.start
+        if error is not None:
+            sample.error = type(error).__name__
+            if getattr(error, 'status_code', None) is not None:
+                sample.status_code = error.status_code
+        for hook in hooks:
+            hook(sample)
+
+# The _CallTimer of the request being made by each thread, used by the
+# timed connections to report how long connecting took
+_timing = threading.local()
+
+def _timed_connect(connect):
+    """Private. Wraps a connection's connect method so that it reports how
+    long connecting took to the _CallTimer of the current thread.
+    """
+    def timed_connect(self):
+        start = time.perf_counter()
+        try:
+            connect(self)
+        finally:
+            timer = getattr(_timing, 'timer', None)
+            if timer is not None:
+                timer.sample.connect += time.perf_counter() - start
+    return timed_connect
+
+class Transport(object):
+    """The interface Notehub uses to send HTTP requests.
+
+    A transport creates sessions. A session is an object with the parts of
+    the requests.Session API that Notehub uses: get, post, put and head
+    methods taking the same arguments as requests (params, data, headers,
+    timeout and stream) and returning a response with status_code,
+    content, json(), iter_content(chunk_size), close() and a request with
+    the url and body that were sent, and a close() method that closes its
+    connections. A session must be safe to use from many threads at once.
+
+    Attributes:
+        errors: A tuple of the exception classes a session raises when a
+            request fails. They are raised as NotehubError.
+    """
+
+    errors = (OSError,)
+
+    def new_session(self, pool_size):
+        """Creates a session keeping up to pool_size idle connections.
+        """
+        raise NotImplementedError
+
+class HTTPClientTransport(Transport):
+    """Sends requests with the http.client module of the standard library.
+
+    The default transport. Each session keeps a pool of keep-alive
+    connections. Cookies are never stored and proxy environment variables
+    are not used.
+    """
+
+    errors = (OSError, http.client.HTTPException)
+
+    def new_session(self, pool_size):
+        return _HTTPClientSession(pool_size)
+
+class RequestsTransport(Transport):
+    """Sends requests with the requests package, which is only imported
+    when the first session is created.
+
+    Use it for the features of requests that HTTPClientTransport doesn't
+    have, such as proxies set in the environment.
+    """
+
+    def __init__(self):
+        self._pool_classes = None
+
+    @property
+    def errors(self):
+        import requests
+        return (requests.exceptions.RequestException,)
+
+    def new_session(self, pool_size):
+        import http.cookiejar
+        import requests
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        # Connections that report how long connecting took to the hooks
+        adapter.poolmanager.pool_classes_by_scheme = self._get_pool_classes()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['Connection'] = 'keep-alive'
+        # urllib3 decompresses the body as it is streamed
+        session.headers['Accept-Encoding'] = 'gzip'
+        # The API doesn't use cookies, refusing them keeps the session free
+        # of state shared between threads
+        session.cookies.set_policy(
+            http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        return session
+
+    def _get_pool_classes(self):
+        """Private. Returns the urllib3 connection pool classes, by scheme,
+        that time their connections.
+        """
+        if self._pool_classes is None:
+            import urllib3
+            self._pool_classes = {}
+            for scheme, pool in (('http', urllib3.HTTPConnectionPool),
+                                 ('https', urllib3.HTTPSConnectionPool)):
+                connection = type(pool.ConnectionCls.__name__,
+                                  (pool.ConnectionCls,),
+                                  {'connect': _timed_connect(
+                                      pool.ConnectionCls.connect)})
+                self._pool_classes[scheme] = type(
+                    pool.__name__, (pool,), {'ConnectionCls': connection})
+        return self._pool_classes
+
+# Transports by the names that can be given to Notehub
+TRANSPORTS = {'http.client': HTTPClientTransport,
+              'requests': RequestsTransport}
+
+class _TimedHTTPConnection(http.client.HTTPConnection):
+    connect = _timed_connect(http.client.HTTPConnection.connect)
+
+class _TimedHTTPSConnection(http.client.HTTPSConnection):
+    connect = _timed_connect(http.client.HTTPSConnection.connect)
+
+class _SentRequest(object):
+    """Private. The url and body of a request, as response.request.
+    """
+
+    __slots__ = ('method', 'url', 'body')
+
+    def __init__(self, method, url, body):
+        self.method = method
+        self.url = url
+        self.body = body
+
+class _HTTPClientSession(object):
+    """Private. The session of HTTPClientTransport, a pool of keep-alive
+    http.client connections.
+
+    A connection is taken out of the pool for each request and put back
+    once its response has been read to the end.
+    """
+
+    HEADERS = {'User-Agent': 'python-notehub', 'Accept': 'application/json',
+               'Accept-Encoding': 'gzip'}
+
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        # (scheme, host, port) -> idle connections, most recently used last
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, params=None, timeout=None, stream=False, **kwargs):
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        return self.request('GET', url, timeout=timeout, stream=stream,
+                            **kwargs)
+
+    def head(self, url, timeout=None, stream=False, **kwargs):
+        return self.request('HEAD', url, timeout=timeout, stream=stream,
+                            **kwargs)
+
+    def post(self, url, data=None, headers=None, timeout=None,
+             stream=False):
+        return self.request('POST', url, data, headers, timeout, stream)
+
+    def put(self, url, data=None, headers=None, timeout=None, stream=False):
+        return self.request('PUT', url, data, headers, timeout, stream)
+
+    def request(self, method, url, data=None, headers=None, timeout=None,
+                stream=False):
+        """Sends a request, returning an _HTTPClientResponse.
+
+        data can be a dict, which is form encoded, bytes or an iterable of
+        bytes. An iterable is sent with chunked encoding unless it has a
+        len attribute.
+        """
+        split = urllib.parse.urlsplit(url)
+        key = (split.scheme, split.hostname, split.port)
+        path = split.path or '/'
+        if split.query:
+            path += '?' + split.query
+        all_headers = dict(self.HEADERS)
+        all_headers.update(headers or {})
+        body = data
+        if isinstance(data, dict):
+            body = urllib.parse.urlencode(data).encode('ascii')
+            all_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif getattr(data, 'len', None) is not None:
+            all_headers['Content-Length'] = str(data.len)
+        if not body and method in ('POST', 'PUT'):
+            body = b''
+
+        conn = self._get_connection(key, timeout)
+        try:
+            conn.request(method, path, body, all_headers)
+            resp = conn.getresponse()
+        except BaseException:
+            conn.close()
+            raise
+        response = _HTTPClientResponse(self, key, conn, resp,
+                                       _SentRequest(method, url, body))
+        if not stream:
+            response.content
+        return response
+
+    def _get_connection(self, key, timeout):
+        """Private. Takes an idle connection from the pool, or opens a new
+        one.
+        """
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn = idle.pop()
+                if not self._is_dropped(conn):
+                    conn.sock.settimeout(timeout)
+                    conn.timeout = timeout
+                    return conn
+                conn.close()
+        scheme, host, port = key
+        if scheme == 'https':
+            return _TimedHTTPSConnection(host, port, timeout=timeout)
+        return _TimedHTTPConnection(host, port, timeout=timeout)
+
+    def _is_dropped(self, conn):
+        """Private. Checks whether the server has closed an idle connection.
+        An idle connection that can be read from has either been closed or
+        sent something unexpected, either way it can't be used.
+        """
+        if conn.sock is None:
+            return True
+        try:
+            return bool(select.select([conn.sock], [], [], 0)[0])
+        except (OSError, ValueError):
+            return True
+
+    def _release(self, key, conn):
+        """Private. Puts a connection whose response has been read back in
+        the pool.
+        """
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Closes the idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+class _HTTPClientResponse(object):
+    """Private. A response from _HTTPClientSession.
+
+    A gzip compressed body is decompressed as it is read.
+
+    Attributes:
+        wire_bytes: The number of body bytes read from the connection.
+        decompress_time: Seconds spent decompressing the body.
+    """
+
+    def __init__(self, session, key, conn, resp, request):
+        self.status_code = resp.status
+        self.headers = resp.headers
+        self.request = request
+        self.wire_bytes = 0
+        self.decompress_time = 0.0
+        self._session = session
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self._content = None
+        self._decoder = None
+        encoding = resp.getheader('Content-Encoding', '').strip().lower()
+        if encoding == 'gzip':
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _decode(self, chunk, final=False):
+        """Private. Decompresses a chunk of the body read from the
+        connection.
+        """
+        self.wire_bytes += len(chunk)
+        if self._decoder is None:
+            return chunk
+        start = time.perf_counter()
+        try:
+            chunk = self._decoder.decompress(chunk)
+            if final:
+                chunk += self._decoder.flush()
+        except zlib.error as e:
+            raise http.client.HTTPException('Invalid gzip response: ' +
+                                            str(e))
+        finally:
+            self.decompress_time += time.perf_counter() - start
+        return chunk
+
+    def iter_content(self, chunk_size=1):
+        """Yields the body in chunks, of up to chunk_size bytes before
+        decompressing.
+        """
+        if self._content is not None:
+            for start in range(0, len(self._content), chunk_size):
+                yield self._content[start:start + chunk_size]
+            return
+        while True:
+            raw = self._resp.read(chunk_size)
+            chunk = self._decode(raw, final=not raw)
+            if chunk:
+                yield chunk
+            if not raw:
+                break
+        self._finish()
+
+    @property
+    def content(self):
+        """The whole body.
+        """
+        if self._content is None:
+            self._content = self._decode(self._resp.read(), final=True)
+            self._finish()
+        return self._content
+
+    def json(self):
+        return json.loads(self.content)
+
+    def _finish(self):
+        """Private. Hands the connection back once the body has been read.
+        """
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if self._resp.will_close:
+            conn.close()
+        else:
+            self._session._release(self._key, conn)
+
+    def close(self):
+        """Closes the response. A connection whose response wasn't read to
+        the end can't be reused, so it is closed.
+        """
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            if self._resp.isclosed() and not self._resp.will_close:
+                self._session._release(self._key, conn)
+            else:
+                conn.close()
+
+class _Flight(object):
+    """Private. A get_note request that other threads can wait on.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.followers = 0
+        # Set when the note is updated while the request is being made
+        self.stale = False
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        """Waits for the request and returns a copy of its result.
+
+        Raises:
+            The exception raised by the request, if there was one.
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return deepcopy(self.result)
+
+def _parse_date(text):
+    """Private. Parses a Notehub.org date such as
+    'Sun Jan 26 18:52:37 UTC 2014', or returns None if it can't be parsed.
+    """
+    if not text:
+        return None
+    try:
+        return datetime.strptime(text.replace('UTC', '+0000'),
+                                 '%a %b %d %H:%M:%S %z %Y')
+    except (TypeError, ValueError):
+        return None
+
+class NoteStatistics(collections.abc.Mapping):
+    """The statistics of a Note.
+
+    Reads like the "statistics" dict of a GET NOTE response, so
+    stats['views'] is still the string Notehub.org sent. The attributes
+    hold the parsed values.
+
+    Attributes:
+        views: The number of views, as an int. None if it wasn't sent.
+        publisher: The publisher name.
+        published: When the note was published, as an aware datetime in
+            UTC, or None. Parsed on access.
+        edited: When the note was last edited, as published.
+    """
+
+    __slots__ = ('views', 'publisher', '_published', '_edited', '_extra')
+
+    KEYS = ('published', 'edited', 'views', 'publisher')
+
+    def __init__(self, stats):
+        views = stats.get('views')
+        try:
+            self.views = int(views)
+        except (TypeError, ValueError):
+            self.views = views
+        self.publisher = _intern(stats.get('publisher'))
+        self._published = stats.get('published')
+        self._edited = stats.get('edited')
+        extra = dict((key, value) for key, value in stats.items()
+                     if key not in self.KEYS)
+        self._extra = extra or None
+
+    @property
+    def published(self):
+        return _parse_date(self._published)
+
+    @property
+    def edited(self):
+        return _parse_date(self._edited)
+
+    def __getitem__(self, key):
+        if key == 'views':
+            return self.views if self.views is None else str(self.views)
+        if key == 'publisher':
+            return self.publisher
+        if key == 'published':
+            return self._published
+        if key == 'edited':
+            return self._edited
+        if self._extra is not None:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        for key in self.KEYS:
+            yield key
+        for key in self._extra or ():
+            yield key
+
+    def __len__(self):
+        return len(self.KEYS) + len(self._extra or ())
+
+    def __repr__(self):
+        return 'NoteStatistics(%r)' % dict(self)
+
+class Note(collections.abc.Mapping):
+    """A compact, read only GET NOTE result.
+
+    Holds the same data as the dict get_note returns by default in a
+    fraction of the memory. It reads like that dict, note['title'],
+    note.get('longURL') and so on work as before, and dict(note) or
+    note.to_dict() give back a plain dict, e.g. to serialize it.
+    Publisher names are interned so notes share them.
+
+    Attributes:
+        id: The ID of the note.
+        title: The title of the note.
+        note: The text of the note.
+        publisher: The publisher name.
+        long_url: The full URL of the note.
+        short_url: The short URL of the note.
+        statistics: A NoteStatistics.
+        views: The number of views, as an int.
+    """
+
+    __slots__ = ('id', 'title', 'note', 'publisher', 'long_url',
+                 'short_url', 'statistics', '_extra')
+
+    # Response keys and the attributes holding them
+    KEYS = (('title', 'title'), ('note', 'note'), ('publisher', 'publisher'),
+            ('longURL', 'long_url'), ('shortURL', 'short_url'),
+            ('statistics', 'statistics'))
+    _ATTRS = dict(KEYS)
+
+    def __init__(self, note_id, resp):
+        """
+        Args:
+            note_id: The ID of the note.
+            resp: The dict returned by get_note.
+        """
+        self.id = note_id
+        self.title = resp.get('title')
+        self.note = resp.get('note')
+        self.publisher = _intern(resp.get('publisher'))
+        self.long_url = resp.get('longURL')
+        self.short_url = resp.get('shortURL')
+        stats = resp.get('statistics')
+        self.statistics = (NoteStatistics(stats) if isinstance(stats, dict)
+                           else stats)
+        extra = dict((key, value) for key, value in resp.items()
+                     if key not in self._ATTRS)
+        self._extra = extra or None
+
+    @property
+    def views(self):
+        return getattr(self.statistics, 'views', None)
+
+    def to_dict(self):
+        """Returns the note as the dict get_note returns by default.
+        """
+        resp = dict(self)
+        if isinstance(self.statistics, NoteStatistics):
+            resp['statistics'] = dict(self.statistics)
+        return resp
+
+    def __getitem__(self, key):
+        attr = self._ATTRS.get(key)
+        if attr is not None:
+            return getattr(self, attr)
+        if self._extra is not None:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        for key, _ in self.KEYS:
+            yield key
+        for key in self._extra or ():
+            yield key
+
+    def __len__(self):
+        return len(self.KEYS) + len(self._extra or ())
+
+    def __repr__(self):
+        return 'Note(%r, title=%r)' % (self.id, self.title)
+
+def _intern(text):
+    """Private. Interns a string that many notes are likely to share.
+    """
+    return sys.intern(text) if isinstance(text, str) else text
+
+class _NoteSource(object):
+    """Private. Reads note text a chunk at a time, as UTF-8 bytes.
+
+    The source can be a path, a file object opened in binary or text mode,
+    or an iterable of str or bytes chunks. Paths and seekable files can be
+    read more than once, which lets the request body report its length and
+    be sent again on a retry.
+    """
+
+    def __init__(self, source, chunk_size):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.start = None
+        self.used = False
+        if not isinstance(source, str) and hasattr(source, 'read'):
+            try:
+                if source.seekable():
+                    self.start = source.tell()
+            except (AttributeError, io.UnsupportedOperation):
+                pass
+
+    @property
+    def rereadable(self):
+        return isinstance(self.source, str) or self.start is not None
+
+    def __iter__(self):
+        if isinstance(self.source, str):
+            with open(self.source, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                    yield chunk
+            return
+        if not self.rereadable:
+            if self.used:
+                raise NotehubError('The note text can only be read once')
+            self.used = True
+        if hasattr(self.source, 'read'):
+            if self.start is not None:
+                self.source.seek(self.start)
+            chunks = iter(lambda: self.source.read(self.chunk_size), '')
+        else:
+            chunks = iter(self.source)
+        for chunk in chunks:
+            if not chunk:
+                # A binary file signals the end with b''
+                break
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            yield chunk
+
+class _FormBody(object):
+    """Private. A streamed application/x-www-form-urlencoded request body.
+
+    The note comes first so the signature, which is computed as the note is
+    read, can be sent after it. When the source can be read twice the
+    signature and length are worked out up front and the body is sent with
+    a Content-Length, otherwise it is sent with chunked encoding.
+
+    Attributes:
+        headers: The headers to send with the body.
+        len: The body length in bytes, only set when it is known up front.
+    """
+
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+    def __init__(self, source, signer, suffix, fields):
+        """
+        Args:
+            source: A _NoteSource with the note text.
+            signer: An md5 object that has hashed whatever is signed before
+                the note.
+            suffix: Bytes hashed after the note.
+            fields: The other form fields, as a dict.
+        """
+        self.source = source
+        self.signer = signer
+        self.suffix = suffix
+        self.fields = urllib.parse.urlencode(fields).encode('ascii')
+        self.signature = None
+        if source.rereadable:
+            signer = self.signer.copy()
+            length = len(b'note=&') + len(self.fields) + len(b'&signature=')
+            for chunk in source:
+                signer.update(chunk)
+                length += len(urllib.parse.quote_plus(chunk))
+            signer.update(self.suffix)
+            self.signature = signer.hexdigest()
+            self.len = length + len(self.signature)
+
+    def __iter__(self):
+        signer = self.signer.copy()
+        yield b'note='
+        for chunk in self.source:
+            signer.update(chunk)
+            yield urllib.parse.quote_plus(chunk).encode('ascii')
+        signer.update(self.suffix)
+        yield b'&' + self.fields + b'&signature='
+        yield (self.signature or signer.hexdigest()).encode('ascii')
+
+class _GzipBody(object):
+    """Private. A gzip compressed request body, compressed a chunk at a time
+    as it is sent with chunked encoding.
+
+    Attributes:
+        headers: The headers to send with the body.
+        raw_bytes: The number of bytes compressed so far.
+        sent_bytes: The number of compressed bytes produced so far.
+        compress_time: Seconds spent compressing so far.
+    """
+
+    def __init__(self, body, headers, level=6):
+        """
+        Args:
+            body: The uncompressed body, as an iterable of bytes.
+            headers: The headers the uncompressed body would be sent with.
+            level: The zlib compression level.
+        """
+        self.body = body
+        self.headers = dict(headers)
+        self.headers['Content-Encoding'] = 'gzip'
+        self.level = level
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.compress_time = 0.0
+
+    def __iter__(self):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        for chunk in self.body:
+            start = time.perf_counter()
+            self.raw_bytes += len(chunk)
+            chunk = compressor.compress(chunk)
+            self.compress_time += time.perf_counter() - start
+            if chunk:
+                self.sent_bytes += len(chunk)
+                yield chunk
+        start = time.perf_counter()
+        chunk = compressor.flush()
+        self.compress_time += time.perf_counter() - start
+        self.sent_bytes += len(chunk)
+        yield chunk
+
+class _CompressedForm(bytes):
+    """Private. A gzip compressed form body, with the headers to send it
+    with.
+    """
+
+    headers = {'Content-Type': 'application/x-www-form-urlencoded',
+               'Content-Encoding': 'gzip'}
+
+# A run of JSON string text with no quotes or escapes
+_STRING_RUN = re.compile(r'[^"\\]*')
+
+def _split_note(chunks, write):
+    """Private. Parses a streamed GET NOTE response, passing the text of the
+    note to write as it arrives instead of keeping it in memory.
+
+    Args:
+        chunks: An iterable of the response body, as bytes.
+        write: Called with each piece of the note text.
+
+    Returns:
+        A dict of the other fields of the response.
+
+    Raises:
+        NotehubError: The response isn't a JSON object.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    parser = json.JSONDecoder()
+    fields = {}
+    state = 'start'
+    key = None
+    buf = ''
+    done = False
+    chunks = iter(chunks)
+    while not done:
+        chunk = next(chunks, None)
+        final = chunk is None
+        buf += decoder.decode(chunk or b'', final=final)
+        pos = 0
+        try:
+            while True:
+                if state != 'text':
+                    while pos < len(buf) and buf[pos] in ' \t\r\n':
+                        pos += 1
+                if pos >= len(buf):
+                    break
+                if state == 'start':
+                    if buf[pos] != '{':
+                        raise ValueError('Expected an object')
+                    pos += 1
+                    state = 'key'
+                elif state == 'key':
+                    if buf[pos] == '}':
+                        done = True
+                        break
+                    if buf[pos] == ',':
+                        pos += 1
+                        continue
+                    key, end = parser.raw_decode(buf, pos)
+                    colon = len(buf) - len(buf[end:].lstrip())
+                    if colon >= len(buf):
+                        break
+                    if buf[colon] != ':' or not isinstance(key, str):
+                        raise ValueError('Expected a key')
+                    pos = colon + 1
+                    state = 'note' if key == 'note' else 'value'
+                elif state == 'note' and buf[pos] == '"':
+                    pos += 1
+                    state = 'text'
+                elif state == 'text':
+                    pos = _write_string(buf, pos, write)
+                    if pos < 0:
+                        # Waiting on more data, keep the unwritten part
+                        pos = -pos - 1
+                        break
+                    state = 'key'
+                else:
+                    # Another value, or a note that isn't a string. Numbers
+                    # could still be cut short so need a character after.
+                    value, end = parser.raw_decode(buf, pos)
+                    if end >= len(buf) and not final:
+                        break
+                    fields[key] = value
+                    pos = end
+                    state = 'key'
+        except ValueError:
+            if final:
+                raise NotehubError('Invalid JSON response', 200)
+        buf = buf[pos:]
+        if final and not done:
+            raise NotehubError('Invalid JSON response', 200)
+    return fields
+
+def _write_string(buf, pos, write):
+    """Private. Writes the JSON string text in buf starting at pos, up to
+    its closing quote.
+
+    Returns:
+        The position after the closing quote, or if the string carries on
+        past the end of buf -(position of the first unwritten char) - 1.
+    """
+    while True:
+        end = _STRING_RUN.match(buf, pos).end()
+        if end > pos:
+            write(buf[pos:end])
+        if end >= len(buf):
+            return -end - 1
+        if buf[end] == '"':
+            return end + 1
+        # An escape. The first half of a surrogate pair is written
+        # together with the second.
+        size = 6 if buf[end + 1:end + 2] == 'u' else 2
+        if size == 6 and buf[end + 2:end + 4].lower() in ('d8', 'd9', 'da',
+                                                          'db'):
+            size = 12 if buf[end + 6:end + 8] == '\\u' else 6
+            if end + 12 > len(buf):
+                return -end - 1
+        if end + size > len(buf):
+            return -end - 1
+        write(json.loads('"' + buf[end:end + size] + '"'))
+        pos = end + size
+
+class _NotehubBase(object):
+    """Private. The parts of the api wrapper shared by Notehub and AsyncNotehub.
+
+    Builds the parameters for each API call, generates signatures, hashes
+    passwords and checks the responses. Subclasses only need to provide a
+    way to make the HTTP request.
+    """
+
+    BASE_URL = 'http://notehub.org/api/note'
+
+    # How much note text is encoded and hashed at a time
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, pid, psk, version='1.4'):
+        self.pid = pid
+        self.psk = psk
+        self.version = version
+        # ((pid, psk), md5 object that has hashed pid + psk)
+        self._signer = None
+
+    def _check_status_code(self, status_code):
+        """Private. Raises a NotehubError if the response code isn't 200.
+        """
+        if status_code != 200:
+            raise NotehubError('Server returned non-200 response code: '
+                                + str(status_code), status_code)
+
+    def _check_status(self, resp):
+        """Private. Checks the status object of a parsed response.
+
+        Args:
+            resp: The dict parsed from the JSON response.
+
+        Returns:
+            The same dict with the "status" object removed.
+
+        Raises:
+            NotehubError: The status reports that the call failed, or the
+                response isn't shaped like an API response.
+        """
+        if not isinstance(resp, dict):
+            raise NotehubError('Malformed response: ' + repr(resp)[:100], 200)
+        try:
+            if resp['status']['success'] != True:
+                raise NotehubError(
+                    'Non successful status: ' +
+                    str(resp['status'].get('message', '')), 200)
+            del resp['status']
+        except (KeyError, TypeError, AttributeError):
+            # Sometimes on failure there is no 'status'. 'success' and
+            # 'message' are still there though
+            if 'message' not in resp:
+                raise NotehubError('Malformed response: no status', 200)
+            raise NotehubError(
+                    'Non successful status: ' + str(resp['message']), 200)
+        return resp
+
+    def _loads(self, body):
+        """Private. Parses a JSON response body.
+
+        Args:
+            body: The response body, as bytes or text.
+
+        Raises:
+            NotehubError: The body isn't valid JSON.
+        """
+        try:
+            if isinstance(body, bytes):
+                body = body.decode('utf-8')
+            return json.loads(body)
+        except ValueError as e:
+            raise NotehubError('Invalid JSON response: ' + str(e), 200)
+
+    def _get_signer(self):
+        """Private. Returns an md5 object that has already hashed the pid and
+        psk, ready for the signed text to be added.
+        """
+        signer = self._signer
+        if signer is None or signer[0] != (self.pid, self.psk):
+            signer = self._signer = ((self.pid, self.psk),
+                md5((self.pid + self.psk).encode('utf-8')))
+        return signer[1].copy()
+
+    def _get_signature(self, *texts):
+        """Private. Generates a Notehub.org signature with the given text.
+
+        The text is hashed a chunk at a time so a large note isn't copied
+        into one big string first.
+
+        Args:
+            texts: The text to be included in the signature, in order.
+        """
+        signer = self._get_signer()
+        for text in texts:
+            for start in range(0, len(text), self.CHUNK_SIZE):
+                signer.update(
+                    text[start:start + self.CHUNK_SIZE].encode('utf-8'))
+        return signer.hexdigest()
+
+    def _hash_password(self, password):
+        """Private. Hashes a password the way Notehub.org expects it.
+        """
+        return md5(password.encode('utf-8')).hexdigest()
+
+    def _get_note_params(self, note_id):
+        """Private. Builds the HTTP GET parameters for GET NOTE.
+        """
+        return {'noteID': note_id,
+                'version': self.version,
+            }
+
+    def _create_note_data(self, note_text, password='', theme='',
+                          text_font='', header_font=''):
+        """Private. Builds the HTTP POST data for CREATE NOTE.
+        """
+        data = {'note': note_text,
+                'pid': self.pid,
+                'signature': self._get_signature(note_text),
+                'version': self.version,
+            }
+        data.update(self._create_note_options(password, theme, text_font,
+                                              header_font))
+        return data
+
+    def _create_note_options(self, password, theme, text_font, header_font):
+        """Private. Builds the optional HTTP POST data for CREATE NOTE.
+        """
+        data = {}
+        if password:
+            data['password'] = self._hash_password(password)
+        if theme:
+            data['theme'] = theme
+        if text_font:
+            data['text-font'] = text_font
+        if header_font:
+            data['header-font'] = header_font
+        return data
+
+    def _update_note_data(self, note_id, new_note_text, password):
+        """Private. Builds the HTTP PUT data for UPDATE NOTE.
+        """
+        encoded_password = self._hash_password(password)
+        return {'noteId': note_id,
+                'note': new_note_text,
+                'pid': self.pid,
+                'signature': self._get_signature(
+                    note_id, new_note_text, encoded_password),
+                'password': encoded_password,
+                'version': self.version,
+            }
+
+class Notehub(_NotehubBase):
+    """A wrapper for the Notehub.org api.
+
+    Attributes:
+        pid: The publisher ID received from Notehub.org.
+        psk: The publisher secret key received from Notehub.org. 
+        version: The api version to use. (Default: '1.4').
+        pool_size: The maximum number of keep-alive connections held open to
+            Notehub.org. (Default: 10).
+        cache: A NoteCache or DiskNoteCache used by get_note, or None.
+            (Default: None).
+        retry: The RetryPolicy used for failed calls, or None to never
+            retry. (Default: None).
+        hooks: A list of callables given a CallSample after every call
+            that reaches Notehub.org. (Default: []).
+        typed_notes: If True notes are returned as Note objects.
+            (Default: False).
+        index: The ContentHashIndex used by update_note, or None.
+            (Default: None).
+        transport: The Transport that sends the requests.
+            (Default: HTTPClientTransport()).
+        limiter: The ConcurrencyLimiter for requests, or None.
+            (Default: None).
+        breaker: The CircuitBreaker for requests, or None. (Default: None).
+        compress_threshold: The smallest request body, in bytes, that is
+            sent gzip compressed, or None to never compress.
+            (Default: None).
+        skipped: The number of update_note calls skipped because the text
+            hadn't changed.
+        coalesced: The number of get_note calls that were answered by
+            another thread's request for the same note instead of making
+            their own.
+
+    A Notehub object owns a pooled HTTP session that is reused across calls
+    so each request doesn't pay for a new TCP handshake. The object can be
+    shared between threads: the connection pool is thread-safe and the
+    session's headers are never changed after it is created and it doesn't
+    store cookies. Call close() when finished with the object, or use it as
+    a context manager:
+
+        with Notehub(PID, PSK) as nh:
+            nh.get_note('2014/1/26/test')
+    """
+
+    def __init__(self, pid, psk, version='1.4', pool_size=10, cache=None,
+                 retry=None, hooks=None, typed_notes=False, index=None,
+                 transport='http.client', limiter=None, breaker=None,
+                 compress_threshold=None):
+        """Constructor for Notehub object.
+
+        Args:
+            pid: The publisher ID received from Notehub.org.
+            psk: The publisher secret key received from Notehub.org.
+            version: Optional. Default '1.4'. Which version of the API to use.
+            pool_size: Optional. Default 10. The maximum number of keep-alive
+                connections to keep open. Set this to at least the number of
+                threads that will share the object.
+            cache: Optional. A NoteCache or DiskNoteCache to serve get_note
+                from. Notes are added to it as they are fetched and removed
+                when they are updated through this object.
+            retry: Optional. A RetryPolicy deciding which failed calls are
+                retried. Default is to never retry.
+            hooks: Optional. A list of callables, such as a
+                LatencyHistogram, that are given a CallSample after every
+                call. They are called in the thread that made the call and
+                any exception they raise is passed on to the caller. Calls
+                are only timed when there are hooks.
+            typed_notes: Optional. Default False. If True get_note and
+                get_notes return Note objects instead of dicts.
+            index: Optional. A ContentHashIndex that lets update_note skip
+                notes whose text hasn't changed.
+            transport: Optional. Default 'http.client'. The Transport that
+                sends the requests, or the name of one in TRANSPORTS.
+            limiter: Optional. A ConcurrencyLimiter that adapts how many
+                requests are in flight at once. Default is no limit beyond
+                the callers' own threads.
+            breaker: Optional. A CircuitBreaker that fails calls fast while
+                Notehub.org is failing.
+            compress_threshold: Optional. Request bodies of at least this
+                many bytes are sent gzip compressed. Streamed notes are
+                always compressed when it is set. If the server answers a
+                compressed request with a 415 the request is sent again
+                uncompressed and compression is turned off. Default is to
+                never compress.
+        """
+        super(Notehub, self).__init__(pid, psk, version)
+        self.pool_size = pool_size
+        if isinstance(transport, str):
+            if transport not in TRANSPORTS:
+                raise ValueError('Unknown transport: %r' % transport)
+            transport = TRANSPORTS[transport]()
+        self.transport = transport
+        self.limiter = limiter
+        self.breaker = breaker
+        self.compress_threshold = compress_threshold
+        self._gzip_accepted = True
+        self.typed_notes = typed_notes
+        self.index = index
+        self.skipped = 0
+        self.cache = cache
+        self.retry = retry
+        self.hooks = list(hooks or [])
+        self.coalesced = 0
+        self._session_lock = threading.Lock()
+        self._session = self._new_session()
+        self._hedge_executor = None
+        # note_id -> _Flight for the get_note requests being made
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _new_session(self):
+        """Private. Creates a keep-alive session with a connection pool.
+        """
+        return self.transport.new_session(self.pool_size)
+
+    def _get_session(self):
+        """Private. Returns the session, reopening it if it was closed.
+        """
+        with self._session_lock:
+            if self._session is None:
+                self._session = self._new_session()
+            return self._session
+
+    def warmup(self, connections=1):
+        """Opens connections to Notehub.org ahead of the first request.
+
+        Sends that many HEAD requests at the same time so that each one
+        opens its own connection, then leaves the connections in the pool
+        so that the first calls don't have to wait on a TCP handshake. No
+        API call is made and the response codes are ignored.
+
+        Args:
+            connections: Optional. Default 1. How many connections to open.
+                Capped at pool_size.
+
+        Raises:
+            NotehubError: A connection could not be opened.
+        """
+        session = self._get_session()
+        count = max(1, min(connections, self.pool_size))
+        # Every request holds on to its connection until all of them have
+        # one, otherwise a quick response would hand its connection to the
+        # next request instead of a new one being opened
+        barrier = threading.Barrier(count)
+        errors = []
+
+        def open_connection():
+            try:
+                resp = session.head(self.BASE_URL, stream=True)
+            except self.transport.errors as e:
+                errors.append(e)
+                barrier.abort()
+                return
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                pass
+            # Reading the (empty) body puts the connection back in the pool
+            resp.content
+
+        threads = [threading.Thread(target=open_connection)
+                   for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise NotehubError('Unable to connect: ' + str(errors[0]))
+
+    def close(self):
+        """Closes all pooled connections.
+
+        The object can still be used afterwards, a new pool will be opened
+        on the next call.
+        """
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+            if self._hedge_executor is not None:
+                self._hedge_executor.shutdown(wait=False)
+                self._hedge_executor = None
+    
+    def _start_timer(self, call, method):
+        """Private. Returns a _CallTimer for a call if there are hooks to
+        report to, otherwise None.
+        """
+        if self.hooks:
+            return _CallTimer(call, method)
+        return None
+
+    def _request(self, method, params={}, data={}, timer=None):
+        """Private. Preforms operations common to all API calls.
+
+        Preforms the operations common to all API calls such as contructing the
+        URL, making the HTTP request, and checking the response codes. A dictionary
+        should be passed in either as "params" or "data". If "data" is provided then
+        an HTTP POST request will be used. Failed calls are retried as allowed by
+        the retry policy.
+
+        Args:
+            method: The HTTP method to use, GET, POST or PUT
+            params: HTTP GET parameters
+            data: HTTP POST data
+            timer: Optional. The _CallTimer to record the call in.
+
+        Returns:
+            A dict populated from the JSON response from the server. The "status"
+            object is removed since error checking is handled here.
+
+        Raises:
+            NotehubError: There was a problem making the API call. The message
+                contains a string explaining what went wrong.
+        """
+        if timer is None:
+            return self._retry_request(method, params, data)
+        try:
+            resp = self._retry_request(method, params, data, timer)
+        except BaseException as e:
+            timer.finish(self.hooks, e)
+            raise
+        timer.finish(self.hooks)
+        return resp
+
+    def _retry_request(self, method, params, data, timer=None):
+        """Private. Makes the request for _request, retrying it as allowed by
+        the retry policy.
+        """
+        policy = self.retry
+        if policy is None:
+            return self._attempt(self._send, method, params, data,
+                                 timer=timer)
+
+        deadline = None
+        if policy.deadline is not None:
+            deadline = time.monotonic() + policy.deadline
+        # CREATE NOTE isn't idempotent so it is never retried
+        max_attempts = 1 if method == 'POST' else policy.max_attempts
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                if method == 'GET' and policy.hedge_after is not None:
+                    return self._attempt(self._send_hedged, params, deadline,
+                                         policy.hedge_after, timer)
+                return self._attempt(self._send, method, params, data,
+                                     deadline, timer)
+            except NotehubError as e:
+                if attempt >= max_attempts or not policy.should_retry(e):
+                    raise
+                delay = policy.get_delay(attempt)
+                if deadline is not None and \
+                        time.monotonic() + delay >= deadline:
+                    raise
+            time.sleep(delay)
+
+    def _attempt(self, send, *args, **kwargs):
+        """Private. Calls send(*args, **kwargs) to make a request, subject
+        to the circuit breaker and concurrency limiter.
+        """
+        breaker = self.breaker
+        limiter = self.limiter
+        if breaker is not None:
+            breaker.before_request()
+        token = limiter.acquire() if limiter is not None else None
+        start = time.monotonic()
+        try:
+            resp = send(*args, **kwargs)
+        except NotehubError as e:
+            if limiter is not None:
+                limiter.release(token, time.monotonic() - start, e)
+            if breaker is not None:
+                breaker.record(e)
+            raise
+        except BaseException:
+            if limiter is not None:
+                limiter.release(token, None)
+            if breaker is not None:
+                breaker.cancel()
+            raise
+        if limiter is not None:
+            limiter.release(token, time.monotonic() - start)
+        if breaker is not None:
+            breaker.record()
+        return resp
+
+    def _send_hedged(self, params, deadline, hedge_after, timer=None):
+        """Private. Makes a GET request, sending a second copy of it if the
+        first is slower than hedge_after seconds. The first response wins.
+
+        The requests run on other threads so only the number of attempts is
+        recorded in the timer.
+        """
+        futures = [self._submit_hedge(params, deadline)]
+        done, _ = wait(futures, timeout=hedge_after)
+        if not done:
+            futures.append(self._submit_hedge(params, deadline))
+        if timer is not None:
+            timer.sample.attempts += len(futures)
+        error = None
+        for future in as_completed(futures):
+            try:
+                return future.result()
+            except NotehubError as e:
+                error = e
+        raise error
+
+    def _submit_hedge(self, params, deadline):
+        """Private. Starts a GET request on the hedging thread pool.
+        """
+        with self._session_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(
+                    max_workers=self.pool_size)
+            # Submitting under the lock means close() can't shut the pool
+            # down in between
+            return self._hedge_executor.submit(self._send, 'GET', params, {},
+                                               deadline)
+
+    def _send(self, method, params, data, deadline=None, timer=None):
+        """Private. Makes one HTTP request and checks the response.
+
+        Args:
+            method: The HTTP method to use, GET, POST or PUT
+            params: HTTP GET parameters
+            data: HTTP POST data
+            deadline: Optional. The time.monotonic() value by which the whole
+                call, including reading the response body, must finish.
+            timer: Optional. The _CallTimer to record the phases in.
+
+        Returns:
+            The checked response, as returned by _request.
+
+        Raises:
+            NotehubError: The request failed or ran past the deadline.
+        """
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise NotehubError('Deadline exceeded')
+
+        # Make the request. With a deadline the body is streamed so the time
+        # spent downloading it can be checked too, the requests timeout only
+        # limits each socket operation. It is also streamed when timing the
+        # call, to tell waiting on the server apart from downloading.
+        session = self._get_session()
+        stream = deadline is not None or timer is not None
+        body = data
+        if method != 'GET':
+            body = self._compress(data, timer)
+        if timer is not None:
+            timer.sample.attempts += 1
+            connect = timer.sample.connect
+            _timing.timer = timer
+            sent = time.perf_counter()
+        try:
+            try:
+                # A streamed or compressed body brings its own headers
+                headers = getattr(body, 'headers', None)
+                if method == 'GET':
+                    req = session.get(self.BASE_URL, params=params,
+                                      timeout=timeout, stream=stream)
+                elif method == 'POST':
+                    req = session.post(self.BASE_URL, data=body,
+                                       headers=headers, timeout=timeout,
+                                       stream=stream)
+                else: # PUT
+                    req = session.put(self.BASE_URL, data=body,
+                                      headers=headers, timeout=timeout,
+                                      stream=stream)
+            finally:
+                if timer is not None:
+                    _timing.timer = None
+                    received = time.perf_counter()
+                    timer.sample.wait += (received - sent -
+                                          (timer.sample.connect - connect))
+                    if isinstance(body, _GzipBody):
+                        # Compressed while it was being sent
+                        timer.sample.wait -= body.compress_time
+                        timer.sample.compress += body.compress_time
+                        timer.sample.request_bytes_saved += (
+                            body.raw_bytes - body.sent_bytes)
+
+            if timer is not None:
+                timer.sample.status_code = req.status_code
+                sent_body = (req.request.body if method != 'GET'
+                             else req.request.url)
+                if isinstance(sent_body, _GzipBody):
+                    timer.sample.request_bytes = sent_body.sent_bytes
+                elif isinstance(sent_body, (str, bytes)):
+                    timer.sample.request_bytes = len(sent_body)
+                else:
+                    # A streamed _FormBody's length is only known when it
+                    # could be read up front
+                    timer.sample.request_bytes = getattr(sent_body, 'len', 0)
+
+            if req.status_code == 415 and body is not data:
+                # The server doesn't take compressed bodies
+                req.close()
+                self._gzip_accepted = False
+                return self._send(method, params, data, deadline, timer)
+
+            # Check the response code
+            self._check_status_code(req.status_code)
+
+            if not stream:
+                try:
+                    resp = req.json()
+                except ValueError as e:
+                    raise NotehubError('Invalid JSON response: ' + str(e),
+                                       req.status_code)
+                return self._check_status(resp)
+            chunks = []
+            try:
+                for chunk in req.iter_content(64 * 1024):
+                    if deadline is not None and time.monotonic() > deadline:
+                        raise NotehubError('Deadline exceeded')
+                    chunks.append(chunk)
+            finally:
+                req.close()
+        except self.transport.errors as e:
+            raise NotehubError('Unable to make request: ' + str(e))
+
+        # Parse the response and check the status
+        body = b''.join(chunks)
+        if timer is None:
+            return self._check_status(self._loads(body))
+        downloaded = time.perf_counter()
+        decompress_time = getattr(req, 'decompress_time', 0.0)
+        timer.sample.download += downloaded - received - decompress_time
+        timer.sample.compress += decompress_time
+        timer.sample.response_bytes = len(body)
+        timer.sample.response_bytes_saved = max(
+            0, len(body) - self._wire_bytes(req, len(body)))
+        try:
+            return self._check_status(self._loads(body))
+        finally:
+            timer.sample.parse += time.perf_counter() - downloaded
+
+    def get_note(self, note_id):
+        """Retreives the text of a note on Notehub.org.
+
+        Makes a call to Notehub.org's GET NOTE api. This returns
+        the text of a note from a given note ID. It also returns
+        some URLs that link to the note and some statistics about it.
+
+        If the object has a cache the note is returned from it when
+        possible. If another thread is already requesting the same note
+        this call waits for that request and shares its result.
+
+        Args:
+            note_id: The ID of the note to request.
+
+        Returns:
+            A dict populated from the JSON response of the API call, or a
+            Note if typed_notes is set.
+
+        Raises:
+            NotehubError: There was a problem making the call. Check the
+                message.
+        """
+        note = self._get_note(note_id)
+        return Note(note_id, note) if self.typed_notes else note
+
+    def _get_note(self, note_id):
+        """Private. Makes the get_note call, returning the response dict.
+        """
+        if self.cache is not None:
+            note = self.cache.get(note_id)
+            if note is not None:
+                return note
+
+        with self._flights_lock:
+            flight = self._flights.get(note_id)
+            leader = flight is None
+            if leader:
+                flight = self._flights[note_id] = _Flight()
+            else:
+                flight.followers += 1
+                self.coalesced += 1
+        if not leader:
+            return flight.wait()
+
+        try:
+            timer = self._start_timer('get_note', 'GET')
+            params = self._get_note_params(note_id)
+            if timer is not None:
+                timer.sample.sign = time.perf_counter() - timer.start
+            note = self._request('GET', params=params, timer=timer)
+            if self.cache is not None:
+                self.cache.put(note_id, note)
+                # update_note marks the flight stale before it invalidates
+                # the cache, so either it removes this note or we do
+                if flight.stale:
+                    self.cache.invalidate(note_id)
+            flight.result = note
+        except BaseException as e:
+            # Followers must never see a result of None, even if this
+            # thread is interrupted
+            flight.error = e
+            raise
+        finally:
+            with self._flights_lock:
+                if self._flights.get(note_id) is flight:
+                    del self._flights[note_id]
+            flight.done.set()
+        # The followers copy flight.result so the caller gets its own copy
+        return deepcopy(note) if flight.followers else note
+
+    def get_notes(self, note_ids, max_workers=None, ordered=True):
+        """Retreives many notes from Notehub.org concurrently.
+
+        Makes GET NOTE calls for each of the note IDs from a pool of worker
+        threads. The note IDs are read lazily so this can be used with a
+        very long or unbounded iterable. A failed call doesn't stop the
+        batch, the NotehubError is returned in place of the note.
+
+        Args:
+            note_ids: An iterable of note IDs to request.
+            max_workers: Optional. Default pool_size. The number of requests
+                to make at once.
+            ordered: Optional. Default True. If True notes are returned in
+                the same order as note_ids, otherwise in the order they
+                arrive.
+
+        Yields:
+            (note_id, note) tuples. note is what get_note would have
+            returned, or a NotehubError if the call failed.
+        """
+        return _fan_out(self.get_note, note_ids,
+                        max_workers or self.pool_size, ordered)
+
+    def create_note(self, note_text, password='', theme='', text_font='',
+                    header_font=''):
+        """Creates a note on Notehub.org with the given text.
+
+        Makes a call to Notehub.orgs CREATE NOTE api. To edit a note later
+        a password must be given. If successful the note's ID and some URLs
+        linking too it will be returned.
+
+        Args:
+            note_text: The ID of the note to request.
+            password: Optional. A password to allow for updating the note.
+            theme: Optional. The color theme to use.
+            text_font: Optional. Font to use for body text.
+            header_font: Optional. Font to use for header text.
+
+        Returns:
+            A dict populated from the JSON response of the API call.
+
+        Raises:
+            NotehubError: There was a problem making the call. Check the
+                message.
+        """
+        timer = self._start_timer('create_note', 'POST')
+        data = self._create_note_data(note_text, password, theme, text_font,
+                                      header_font)
+        if timer is not None:
+            timer.sample.sign = time.perf_counter() - timer.start
+        resp = self._request('POST', data=data, timer=timer)
+        if self.index is not None and 'noteID' in resp:
+            self.index.put(resp['noteID'], note_text)
+        return resp
+
+    def create_notes(self, specs, rate=None, burst=1, max_workers=None,
+                     ordered=True):
+        """Creates many notes on Notehub.org concurrently.
+
+        Makes CREATE NOTE calls from a pool of worker threads, optionally
+        limited to a number of calls per second. The specs are read lazily,
+        only as fast as the calls can be made, so a generator can be used to
+        produce them. A failed call doesn't stop the batch, the
+        NotehubError is returned in place of the result.
+
+        Args:
+            specs: An iterable of dicts holding the arguments to create_note,
+                e.g. {'note_text': 'Test note 123.', 'password': 'abc123'}.
+            rate: Optional. The maximum number of calls per second. Default
+                is no limit.
+            burst: Optional. Default 1. The number of calls that can be made
+                back to back when under the rate limit.
+            max_workers: Optional. Default pool_size. The number of requests
+                to make at once.
+            ordered: Optional. Default True. If True results are returned in
+                the same order as specs, otherwise in the order they arrive.
+
+        Yields:
+            (spec, note) tuples. note is the dict that create_note would have
+            returned, including the noteID and URLs, or a NotehubError if the
+            call failed.
+        """
+        return self._bulk(lambda spec: self.create_note(**spec), specs,
+                          rate, burst, max_workers, ordered)
+
+    def update_note(self, note_id, new_note_text, password):
+        """Edits a note on Notehub.org.
+
+        Makes a call to Notehub.org's UPDATE NOTE api. The note must have
+        been originally created with a password to allow updating. If
+        successful some URLs that link to the note will be returned.
+
+        If the object has a cache the note is removed from it. If it has an
+        index and new_note_text is the text last published to the note no
+        call is made.
+
+        Args:
+            note_id: The ID of the note to request.
+            new_note_text: The text to replace the existing text with.
+            password: The password the note was created with.
+
+        Returns:
+            A dict populated from the JSON response of the API call, or
+            {'skipped': True} if the call was skipped.
+
+        Raises:
+            NotehubError: There was a problem making the call. Check the
+                message.
+        """
+        if self.index is not None and self._is_unchanged(note_id,
+                                                         new_note_text):
+            with self._flights_lock:
+                self.skipped += 1
+            return {'skipped': True}
+
+        timer = self._start_timer('update_note', 'PUT')
+        data = self._update_note_data(note_id, new_note_text, password)
+        if timer is not None:
+            timer.sample.sign = time.perf_counter() - timer.start
+        try:
+            resp = self._request('PUT', data=data, timer=timer)
+        finally:
+            self._note_changed(note_id)
+        if self.index is not None:
+            self.index.put(note_id, new_note_text)
+        return resp
+
+    def _is_unchanged(self, note_id, text):
+        """Private. Checks the index for whether text is the text last
+        published to a note, fetching the note if it is missing.
+        """
+        digest = self.index.get(note_id)
+        if digest is not None:
+            return digest == self.index.hash_text(text)
+        if not self.index.rebuild:
+            return False
+        try:
+            published = self._get_note(note_id).get('note')
+        except NotehubError:
+            # Let the update go ahead and report any problem
+            return False
+        if not isinstance(published, str):
+            return False
+        self.index.put(note_id, published)
+        return published == text
+
+    def _note_changed(self, note_id):
+        """Private. Forgets what is known about a note after an update.
+        """
+        # Even a failed call may have changed the note. A get_note already
+        # in flight may return the old text, so it must not be cached or
+        # shared with calls made from now on.
+        with self._flights_lock:
+            flight = self._flights.pop(note_id, None)
+            if flight is not None:
+                flight.stale = True
+        if self.cache is not None:
+            self.cache.invalidate(note_id)
+        if self.index is not None:
+            self.index.invalidate(note_id)
+
+    def get_note_to_file(self, note_id, file):
+        """Retreives a note on Notehub.org, writing its text to a file.
+
+        The text is written as it is downloaded, so memory use stays the
+        same however large the note is. The cache isn't used and the call
+        is made once, without retries, since the file may already have
+        been partly written when it fails.
+
+        Args:
+            note_id: The ID of the note to request.
+            file: A path, which is written as UTF-8, or a file object opened
+                in text mode.
+
+        Returns:
+            A dict populated from the JSON response of the API call, without
+            the "note" text.
+
+        Raises:
+            NotehubError: There was a problem making the call. Check the
+                message.
+        """
+        return self._check_status(self._attempt(
+            self._send_to_file, self._get_note_params(note_id), file))
+
+    def _compress(self, data, timer=None):
+        """Private. Compresses a POST or PUT body if it is at least
+        compress_threshold bytes.
+
+        Returns:
+            A dict or _FormBody body unchanged, the form encoded bytes of a
+            dict with a headers attribute, or a _GzipBody.
+        """
+        threshold = self.compress_threshold
+        if threshold is None or not self._gzip_accepted:
+            return data
+        if isinstance(data, _FormBody):
+            if getattr(data, 'len', threshold) < threshold:
+                return data
+            return _GzipBody(data, data.headers)
+        start = time.perf_counter()
+        form = urllib.parse.urlencode(data).encode('ascii')
+        if len(form) < threshold:
+            return data
+        body = _CompressedForm(gzip.compress(form, 6))
+        if timer is not None:
+            timer.sample.compress += time.perf_counter() - start
+            timer.sample.request_bytes_saved += len(form) - len(body)
+        return body
+
+    @staticmethod
+    def _wire_bytes(req, default):
+        """Private. Returns how many body bytes a streamed response read
+        from the connection, or default if the transport doesn't say.
+        """
+        wire_bytes = getattr(req, 'wire_bytes', None)
+        if wire_bytes is None:
+            # requests streams through a urllib3 response
+            tell = getattr(getattr(req, 'raw', None), 'tell', None)
+            wire_bytes = tell() if tell is not None else None
+        if not isinstance(wire_bytes, int):
+            return default
+        return wire_bytes
+
+    def _send_to_file(self, params, file):
+        """Private. Makes the GET request for get_note_to_file, returning
+        the unchecked response without the note.
+        """
+        try:
+            req = self._get_session().get(self.BASE_URL, params=params,
+                                          stream=True)
+            try:
+                self._check_status_code(req.status_code)
+                if isinstance(file, str):
+                    with open(file, 'w', encoding='utf-8', newline='') as f:
+                        return _split_note(
+                            req.iter_content(self.CHUNK_SIZE), f.write)
+                return _split_note(req.iter_content(self.CHUNK_SIZE),
+                                   file.write)
+            finally:
+                req.close()
+        except self.transport.errors as e:
+            raise NotehubError('Unable to make request: ' + str(e))
+
+    def create_note_stream(self, source, password='', theme='', text_font='',
+                           header_font=''):
+        """Creates a note on Notehub.org, reading its text from a file or
+        iterator.
+
+        Like create_note, but the text is signed and sent a chunk at a time
+        so it is never held in memory all at once. Paths and seekable files
+        are read twice, once to sign the note and once to send it, so the
+        request has a Content-Length. Other iterables are read once and
+        sent with chunked encoding.
+
+        Args:
+            source: A path, a file object opened in binary or text mode or
+                an iterable of str or UTF-8 bytes chunks.
+            password: Optional. A password to allow for updating the note.
+            theme: Optional. The color theme to use.
+            text_font: Optional. Font to use for body text.
+            header_font: Optional. Font to use for header text.
+
+        Returns:
+            A dict populated from the JSON response of the API call.
+
+        Raises:
+            NotehubError: There was a problem making the call. Check the
+                message.
+        """
+        fields = {'pid': self.pid, 'version': self.version}
+        fields.update(self._create_note_options(password, theme, text_font,
+                                                header_font))
+        data = _FormBody(_NoteSource(source, self.CHUNK_SIZE),
+                         self._get_signer(), b'', fields)
+        return self._request('POST', data=data,
+                             timer=self._start_timer('create_note_stream',
+                                                     'POST'))
+
+    def update_note_stream(self, note_id, source, password):
+        """Edits a note on Notehub.org, reading its new text from a file or
+        iterator.
+
+        Like update_note, but the text is signed and sent a chunk at a time
+        as in create_note_stream. An iterator source can only be read once,
+        so if the retry policy allows retries a failed call raises a
+        NotehubError on the retry instead of sending an empty note.
+
+        Args:
+            note_id: The ID of the note to request.
+            source: A path, a file object opened in binary or text mode or
+                an iterable of str or UTF-8 bytes chunks.
+            password: The password the note was created with.
+
+        Returns:
+            A dict populated from the JSON response of the API call.
+
+        Raises:
+            NotehubError: There was a problem making the call. Check the
+                message.
+        """
+        encoded_password = self._hash_password(password)
+        signer = self._get_signer()
+        signer.update(note_id.encode('utf-8'))
+        fields = {'pid': self.pid, 'version': self.version,
+                  'noteId': note_id, 'password': encoded_password}
+        data = _FormBody(_NoteSource(source, self.CHUNK_SIZE), signer,
+                         encoded_password.encode('utf-8'), fields)
+        try:
+            return self._request('PUT', data=data,
+                                 timer=self._start_timer('update_note_stream',
+                                                         'PUT'))
+        finally:
+            self._note_changed(note_id)
+
+    def update_notes(self, specs, rate=None, burst=1, max_workers=None,
+                     ordered=True):
+        """Edits many notes on Notehub.org concurrently.
+
+        The UPDATE NOTE counterpart of create_notes.
+
+        Args:
+            specs: An iterable of dicts holding the arguments to update_note,
+                e.g. {'note_id': '2014/1/26/test-note-123-1',
+                'new_note_text': 'Test note 123.', 'password': 'abc123'}.
+            rate: Optional. The maximum number of calls per second. Default
+                is no limit.
+            burst: Optional. Default 1. The number of calls that can be made
+                back to back when under the rate limit.
+            max_workers: Optional. Default pool_size. The number of requests
+                to make at once.
+            ordered: Optional. Default True. If True results are returned in
+                the same order as specs, otherwise in the order they arrive.
+
+        Yields:
+            (spec, note) tuples. note is the dict that update_note would have
+            returned, {'skipped': True} if the text hadn't changed, or a
+            NotehubError if the call failed.
+        """
+        return self._bulk(lambda spec: self.update_note(**spec), specs,
+                          rate, burst, max_workers, ordered)
+
+    def _bulk(self, func, specs, rate, burst, max_workers, ordered):
+        """Private. Runs func over specs for create_notes and update_notes.
+        """
+        call = func
+        if rate:
+            limiter = RateLimiter(rate, burst)
+            def call(spec):
+                limiter.acquire()
+                return func(spec)
+        return _fan_out(call, specs, max_workers or self.pool_size, ordered)
+
+class AsyncNotehub(_NotehubBase):
+    """An asyncio version of the Notehub.org api wrapper.
+
+    Provides the same calls as Notehub but each one is a coroutine, so a
+    single event loop can keep many requests in flight at once. All calls
+    made through an object share one connection pool and the number of
+    requests in flight at any time is capped by max_in_flight.
+
+    Requires the aiohttp package, which is only imported when the first
+    request is made. asyncio is only imported when an AsyncNotehub is
+    created, so that scripts using Notehub start faster.
+
+    Attributes:
+        pid: The publisher ID received from Notehub.org.
+        psk: The publisher secret key received from Notehub.org.
+        version: The api version to use. (Default: '1.4').
+        pool_size: The maximum number of connections held open to
+            Notehub.org. (Default: 100).
+        max_in_flight: The maximum number of requests in flight at once.
+            (Default: 100).
+        typed_notes: If True notes are returned as Note objects.
+            (Default: False).
+        coalesced: The number of get_note calls that were answered by
+            another task's request for the same note instead of making
+            their own.
+
+    Example use:
+
+        async with AsyncNotehub(PID, PSK) as nh:
+            notes = await asyncio.gather(*[nh.get_note(note_id)
+                                           for note_id in note_ids])
+    """
+
+    def __init__(self, pid, psk, version='1.4', pool_size=100,
+                 max_in_flight=100, typed_notes=False):
+        """Constructor for AsyncNotehub object.
+
+        Args:
+            pid: The publisher ID received from Notehub.org.
+            psk: The publisher secret key received from Notehub.org.
+            version: Optional. Default '1.4'. Which version of the API to use.
+            pool_size: Optional. Default 100. The maximum number of
+                connections to keep open.
+            max_in_flight: Optional. Default 100. The maximum number of
+                requests that can be waiting on Notehub.org at once. Extra
+                calls wait for a free slot.
+            typed_notes: Optional. Default False. If True get_note returns
+                Note objects instead of dicts.
+        """
+        super(AsyncNotehub, self).__init__(pid, psk, version)
+        self.pool_size = pool_size
+        self.typed_notes = typed_notes
+        self.max_in_flight = max_in_flight
+        self.coalesced = 0
+        import asyncio
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._session = None
+        # note_id -> [Task, number of followers] for the get_note requests
+        # being made
+        self._flights = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def _get_session(self):
+        """Private. Returns the session, opening it on first use.
+
+        The session has to be created while the event loop is running so it
+        isn't opened in the constructor.
+        """
+        if self._session is None or self._session.closed:
+            import aiohttp
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        """Closes all pooled connections.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _request(self, method, params={}, data={}):
+        """Private. Preforms operations common to all API calls.
+
+        The asyncio counterpart of Notehub._request.
+
+        Args:
+            method: The HTTP method to use, GET, POST or PUT
+            params: HTTP GET parameters
+            data: HTTP POST data
+
+        Returns:
+            A dict populated from the JSON response from the server. The "status"
+            object is removed since error checking is handled here.
+
+        Raises:
+            NotehubError: There was a problem making the API call. The message
+                contains a string explaining what went wrong.
+        """
+        import asyncio
+        import aiohttp
+        async with self._semaphore:
+            session = self._get_session()
+            try:
+                async with session.request(method, self.BASE_URL,
+                                           params=params or None,
+                                           data=data or None) as req:
+                    # Check the response code
+                    self._check_status_code(req.status)
+
+                    # Parse the response
+                    resp = self._loads(await req.read())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise NotehubError('Unable to make request: ' + str(e))
+
+        # Check the status
+        return self._check_status(resp)
+
+    async def get_note(self, note_id):
+        """Retreives the text of a note on Notehub.org.
+
+        See Notehub.get_note. If another task is already requesting the
+        same note this call waits for that request and shares its result.
+
+        Args:
+            note_id: The ID of the note to request.
+
+        Returns:
+            A dict populated from the JSON response of the API call, or a
+            Note if typed_notes is set.
+
+        Raises:
+            NotehubError: There was a problem making the call. Check the
+                message.
+        """
+        note = await self._get_note(note_id)
+        return Note(note_id, note) if self.typed_notes else note
+
+    async def _get_note(self, note_id):
+        """Private. Makes the get_note call, returning the response dict.
+        """
+        import asyncio
+        flight = self._flights.get(note_id)
+        if flight is None:
+            task = asyncio.ensure_future(
+                self._request('GET', params=self._get_note_params(note_id)))
+            flight = self._flights[note_id] = [task, 0]
+            task.add_done_callback(
+                lambda _: self._drop_flight(note_id, flight))
+            # Shielded so that cancelling one caller doesn't cancel the
+            # request for the others
+            note = await asyncio.shield(task)
+            return deepcopy(note) if flight[1] else note
+        flight[1] += 1
+        self.coalesced += 1
+        return deepcopy(await asyncio.shield(flight[0]))
+
+    async def create_note(self, note_text, password='', theme='', text_font='',
+                          header_font=''):
+        """Creates a note on Notehub.org with the given text.
+
+        See Notehub.create_note.
+
+        Args:
+            note_text: The text of the note.
+            password: Optional. A password to allow for updating the note.
+            theme: Optional. The color theme to use.
+            text_font: Optional. Font to use for body text.
+            header_font: Optional. Font to use for header text.
+
+        Returns:
+            A dict populated from the JSON response of the API call.
+
+        Raises:
+            NotehubError: There was a problem making the call. Check the
+                message.
+        """
+        data = self._create_note_data(note_text, password, theme, text_font,
+                                      header_font)
+        return await self._request('POST', data=data)
+
+    async def update_note(self, note_id, new_note_text, password):
+        """Edits a note on Notehub.org.
+
+        See Notehub.update_note.
+
+        Args:
+            note_id: The ID of the note to request.
+            new_note_text: The text to replace the existing text with.
+            password: The password the note was created with.
+
+        Returns:
+            A dict populated from the JSON response of the API call.
+
+        Raises:
+            NotehubError: There was a problem making the call. Check the
+                message.
+        """
+        data = self._update_note_data(note_id, new_note_text, password)
+        try:
+            return await self._request('PUT', data=data)
+        finally:
+            # A get_note already in flight may return the old text, calls
+            # made from now on must not share it
+            self._flights.pop(note_id, None)
+
+    def _drop_flight(self, note_id, flight):
+        """Private. Forgets a finished get_note request, unless it has
+        already been replaced by a newer one.
+        """
+        if self._flights.get(note_id) is flight:
+            del self._flights[note_id]
+
+
+class MirrorResult(object):
+    """What Mirror.run did with one file.
+
+    Attributes:
+        path: The path of the file, relative to the mirrored directory.
+        action: 'created' for a new note, 'updated' for a changed file,
+            'unchanged' if nothing was sent or 'failed'.
+        note_id: The ID of the file's note, or None if it couldn't be
+            created.
+        error: The NotehubError for a failed file, otherwise None.
+    """
+
+    __slots__ = ('path', 'action', 'note_id', 'error')
+
+    def __init__(self, path, action, note_id=None, error=None):
+        self.path = path
+        self.action = action
+        self.note_id = note_id
+        self.error = error
+
+    def __repr__(self):
+        return 'MirrorResult(%r, %r, %r)' % (self.path, self.action,
+                                             self.note_id)
+
+class _MirrorFile(object):
+    """Private. A file that Mirror.run is going to upload.
+    """
+
+    __slots__ = ('path', 'mtime', 'size', 'text', 'digest', 'note_id')
+
+    def __init__(self, path, mtime, size, text, digest, note_id):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.text = text
+        self.digest = digest
+        self.note_id = note_id
+
+class Mirror(object):
+    """Publishes a directory of text files as notes and keeps them up to
+    date.
+
+    Each file matching the patterns is published as its own note. A
+    MirrorManifest records what was published, so later runs only upload
+    new and changed files. A file whose modification time and size match
+    the manifest isn't read at all, one that only looks changed is read
+    and hashed before deciding.
+
+    Files are read as UTF-8. Notehub.org can't delete notes, so files that
+    have been removed are left alone and reported by removed(). A note is
+    always updated with the password it was created with, a file whose
+    note was created with a different password fails.
+
+    Attributes:
+        notehub: The Notehub object used to publish the notes.
+        directory: The directory being mirrored.
+        manifest: The MirrorManifest.
+        password: The password new notes are created with.
+        patterns: The glob patterns of the file names to publish.
+            (Default: ('*.md',)).
+        max_workers: The number of uploads to make at once. None for the
+            pool_size of notehub. (Default: None).
+
+    Example use:
+
+        with Notehub(PID, PSK) as nh:
+            for result in Mirror(nh, 'docs', password='abc123').run():
+                print(result.action, result.path, result.note_id)
+    """
+
+    def __init__(self, notehub, directory, password='', patterns=('*.md',),
+                 manifest=None, max_workers=None):
+        """Constructor for Mirror object.
+
+        Args:
+            notehub: The Notehub object to publish the notes with.
+            directory: The directory to mirror.
+            password: Optional. The password to create notes with, needed
+                to update them later.
+            patterns: Optional. Default ('*.md',). The glob patterns of the
+                file names to publish.
+            manifest: Optional. The MirrorManifest to use. Default is one
+                kept in directory.
+            max_workers: Optional. Default notehub.pool_size. The number of
+                uploads to make at once.
+        """
+        self.notehub = notehub
+        self.directory = directory
+        self.password = password
+        self.patterns = tuple(patterns)
+        self.manifest = manifest or MirrorManifest(directory)
+        self.max_workers = max_workers
+
+    def _files(self):
+        """Private. Yields the relative path and os.stat_result of every
+        file to publish, in a stable order.
+        """
+        for root, dirs, files in os.walk(self.directory):
+            # Skip hidden directories such as .git
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for name in sorted(files):
+                if not any(fnmatch.fnmatch(name, pattern)
+                           for pattern in self.patterns):
+                    continue
+                full_path = os.path.join(root, name)
+                path = os.path.relpath(full_path, self.directory)
+                yield path.replace(os.sep, '/'), os.stat(full_path)
+
+    def scan(self):
+        """Finds the files that need uploading, without uploading them.
+
+        Yields:
+            (path, action) tuples for every file, where action is 'new',
+            'changed' or 'unchanged'.
+
+        Raises:
+            NotehubError: The manifest couldn't be read.
+        """
+        for item in self._plan():
+            if isinstance(item, MirrorResult):
+                yield item.path, item.action
+            else:
+                yield item.path, 'new' if item.note_id is None else 'changed'
+
+    def _plan(self):
+        """Private. Yields a MirrorResult for each unchanged file and a
+        _MirrorFile for each file to upload.
+        """
+        password_hash = self.notehub._hash_password(self.password)
+        for path, stat in self._files():
+            entry = self.manifest.get(path)
+            if (entry is not None and entry['mtime'] == stat.st_mtime_ns and
+                    entry['size'] == stat.st_size):
+                yield MirrorResult(path, 'unchanged', entry['note_id'])
+                continue
+            full_path = os.path.join(self.directory, *path.split('/'))
+            try:
+                with open(full_path, encoding='utf-8', newline='') as f:
+                    text = f.read()
+            except (OSError, UnicodeDecodeError) as e:
+                yield MirrorResult(path, 'failed', entry and entry['note_id'],
+                                   NotehubError('Unable to read file: ' +
+                                                str(e)))
+                continue
+            digest = ContentHashIndex.hash_text(text)
+            if entry is None:
+                yield _MirrorFile(path, stat.st_mtime_ns, stat.st_size, text,
+                                  digest, None)
+            elif entry['password_hash'] != password_hash:
+                yield MirrorResult(path, 'failed', entry['note_id'],
+                                   NotehubError('The note was created with a '
+                                                'different password'))
+            elif entry['hash'] == digest:
+                # Touched but not changed, remember the new time
+                self.manifest.put(path, stat.st_mtime_ns, stat.st_size,
+                                  digest, entry['note_id'], password_hash)
+                yield MirrorResult(path, 'unchanged', entry['note_id'])
+            else:
+                yield _MirrorFile(path, stat.st_mtime_ns, stat.st_size, text,
+                                  digest, entry['note_id'])
+
+    def _upload(self, item):
+        """Private. Creates or updates the note for a file.
+        """
+        if item.note_id is None:
+            return self.notehub.create_note(item.text, self.password)
+        return self.notehub.update_note(item.note_id, item.text,
+                                        self.password)
+
+    def run(self):
+        """Uploads the new and changed files.
+
+        Files are read lazily and uploaded from a pool of worker threads,
+        so only the files being uploaded are held in memory. Each upload
+        is saved to the manifest as soon as it finishes. A failed upload
+        doesn't stop the run, it is retried by the next one.
+
+        Yields:
+            A MirrorResult for every file, in the order the uploads finish.
+            Files that aren't uploaded, 'unchanged' or 'failed' before an
+            upload was tried, are listed between them.
+
+        Raises:
+            NotehubError: The manifest couldn't be read or written.
+        """
+        password_hash = self.notehub._hash_password(self.password)
+        # The results for files that aren't uploaded, passed on as the
+        # uploads finish
+        unchanged = collections.deque()
+
+        def uploads():
+            for item in self._plan():
+                if isinstance(item, MirrorResult):
+                    unchanged.append(item)
+                else:
+                    yield item
+
+        results = _fan_out(self._upload, uploads(),
+                           self.max_workers or self.notehub.pool_size,
+                           ordered=False)
+        for item, note in results:
+            while unchanged:
+                yield unchanged.popleft()
+            if isinstance(note, NotehubError):
+                yield MirrorResult(item.path, 'failed', item.note_id, note)
+                continue
+            note_id = item.note_id or note.get('noteID')
+            if note_id is None:
+                yield MirrorResult(item.path, 'failed', None,
+                                   NotehubError('No noteID in the response',
+                                                200))
+                continue
+            self.manifest.put(item.path, item.mtime, item.size, item.digest,
+                              note_id, password_hash)
+            yield MirrorResult(item.path,
+                               'updated' if item.note_id else 'created',
+                               note_id)
+        while unchanged:
+            yield unchanged.popleft()
+
+    def removed(self):
+        """Returns the paths in the manifest whose files no longer exist,
+        or no longer match the patterns.
+
+        Raises:
+            NotehubError: The manifest couldn't be read.
+        """
+        return self.manifest.paths() - set(path for path, _ in self._files())
+
+class WatchEvent(object):
+    """A change to a note seen by a Watcher.
+
+    Attributes:
+        note_id: The ID of the note.
+        kind: 'text' when the text changed, 'edited' when the edited time
+            changed, 'views' when the view count changed or 'error' when
+            the note couldn't be fetched.
+        old: The value before the change. For 'text' the hash of the text,
+            for 'edited' the time as Notehub.org sent it and for 'views' an
+            int. None for 'error'.
+        new: The value after the change, or the NotehubError for 'error'.
+        note: The note that was fetched, a dict or a Note if the Notehub
+            object has typed_notes set. None for 'error'.
+    """
+
+    __slots__ = ('note_id', 'kind', 'old', 'new', 'note')
+
+    def __init__(self, note_id, kind, old, new, note=None):
+        self.note_id = note_id
+        self.kind = kind
+        self.old = old
+        self.new = new
+        self.note = note
+
+    @property
+    def delta(self):
+        """The change in the view count for a 'views' event, otherwise None.
+        """
+        if self.kind != 'views':
+            return None
+        return self.new - self.old
+
+    def __repr__(self):
+        return 'WatchEvent(%r, %r, %r, %r)' % (self.note_id, self.kind,
+                                               self.old, self.new)
+
+class _WatchState(object):
+    """Private. What a Watcher last saw of a note and when to poll it next.
+    """
+
+    __slots__ = ('interval', 'due', 'seen', 'digest', 'edited', 'views')
+
+    def __init__(self, interval, due):
+        self.interval = interval
+        self.due = due
+        self.seen = False
+        self.digest = None
+        self.edited = None
+        self.views = None
+
+class Watcher(object):
+    """Polls a set of notes and reports how they change.
+
+    Each note is polled on its own interval. A note that changed is polled
+    again after min_interval, a quiet one waits backoff times longer each
+    time up to max_interval, so most requests go to the notes that are
+    being edited and viewed. The first poll of a note only records it.
+
+    Notes are fetched through the Notehub object's connection pool, and its
+    concurrency limiter if it has one, without using its cache. A change
+    to the text removes the note from the cache.
+
+    Attributes:
+        notehub: The Notehub object used to fetch the notes.
+        min_interval: The shortest time between polls of a note, in
+            seconds. (Default: 5).
+        max_interval: The longest time between polls of a note, in seconds.
+            (Default: 300).
+        backoff: What the interval of a quiet note is multiplied by after
+            each poll. (Default: 2).
+        jitter: The fraction of each interval that is randomly taken off so
+            polls of notes added together spread out. (Default: 0.1).
+        max_workers: The number of notes to fetch at once. None for the
+            pool_size of notehub. (Default: None).
+
+    Example use:
+
+        with Notehub(PID, PSK) as nh:
+            watcher = Watcher(nh, note_ids, min_interval=10)
+            for event in watcher.events():
+                print(event.note_id, event.kind, event.old, event.new)
+    """
+
+    def __init__(self, notehub, note_ids=(), min_interval=5.0,
+                 max_interval=300.0, backoff=2.0, jitter=0.1,
+                 max_workers=None):
+        """Constructor for Watcher object.
+
+        Args:
+            notehub: The Notehub object to fetch the notes with.
+            note_ids: Optional. The IDs of the notes to watch. More can be
+                added with add().
+            min_interval: Optional. Default 5. The shortest time between
+                polls of a note, in seconds.
+            max_interval: Optional. Default 300. The longest time between
+                polls of a note, in seconds.
+            backoff: Optional. Default 2. What the interval of a quiet note
+                is multiplied by after each poll.
+            jitter: Optional. Default 0.1. The fraction of each interval
+                that is randomly taken off.
+            max_workers: Optional. Default notehub.pool_size. The number of
+                notes to fetch at once.
+        """
+        self.notehub = notehub
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        # Set when a note is added or the watcher is stopped, to wake
+        # events() early
+        self._wakeup = threading.Event()
+        # note ID -> _WatchState
+        self._states = {}
+        # (due, sequence, note ID), entries for removed notes or old due
+        # times are skipped when popped
+        self._schedule = []
+        self._sequence = 0
+        for note_id in note_ids:
+            self.add(note_id)
+
+    def add(self, note_id):
+        """Starts watching a note. It is polled on the next poll().
+        """
+        with self._lock:
+            if note_id in self._states:
+                return
+            state = _WatchState(self.min_interval, time.monotonic())
+            self._states[note_id] = state
+            self._push(note_id, state)
+        self._wakeup.set()
+
+    def remove(self, note_id):
+        """Stops watching a note.
+        """
+        with self._lock:
+            self._states.pop(note_id, None)
+
+    def interval(self, note_id):
+        """Returns the current polling interval of a watched note, in
+        seconds.
+
+        Raises:
+            KeyError: The note isn't being watched.
+        """
+        with self._lock:
+            return self._states[note_id].interval
+
+    def __len__(self):
+        return len(self._states)
+
+    def _push(self, note_id, state):
+        """Private. Schedules the next poll of a note. Needs the lock.
+        """
+        self._sequence += 1
+        heapq.heappush(self._schedule, (state.due, self._sequence, note_id))
+
+    def next_due(self):
+        """Returns the time.monotonic() value when the next note is due, or
+        None if no notes are watched.
+        """
+        with self._lock:
+            while self._schedule:
+                due, _, note_id = self._schedule[0]
+                state = self._states.get(note_id)
+                if state is not None and state.due == due:
+                    return due
+                heapq.heappop(self._schedule)
+            return None
+
+    def poll(self):
+        """Fetches the notes that are due and returns what changed.
+
+        Returns:
+            A list of WatchEvents, in no particular order.
+        """
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            while self._schedule and self._schedule[0][0] <= now:
+                when, _, note_id = heapq.heappop(self._schedule)
+                state = self._states.get(note_id)
+                if state is not None and state.due == when:
+                    due.append(note_id)
+        if not due:
+            return []
+
+        events = []
+        max_workers = self.max_workers or self.notehub.pool_size
+        for note_id, note in _fan_out(self._fetch, due, max_workers,
+                                      ordered=False):
+            with self._lock:
+                state = self._states.get(note_id)
+                if state is None:
+                    # Removed while it was being fetched
+                    continue
+                if isinstance(note, NotehubError):
+                    changes = [WatchEvent(note_id, 'error', None, note)]
+                else:
+                    changes = self._diff(note_id, state, note)
+                self._reschedule(note_id, state, changes)
+            events.extend(changes)
+        return events
+
+    def _fetch(self, note_id):
+        """Private. Makes a GET NOTE call, skipping the cache.
+        """
+        notehub = self.notehub
+        timer = notehub._start_timer('watch', 'GET')
+        params = notehub._get_note_params(note_id)
+        if timer is not None:
+            timer.sample.sign = time.perf_counter() - timer.start
+        return notehub._request('GET', params=params, timer=timer)
+
+    def _diff(self, note_id, state, note):
+        """Private. Records a fetched note, returning the WatchEvents for
+        what changed since it was last seen. Needs the lock.
+        """
+        text = note.get('note')
+        digest = ContentHashIndex.hash_text(text) \
+            if isinstance(text, str) else None
+        stats = note.get('statistics') or {}
+        edited = stats.get('edited')
+        try:
+            views = int(stats.get('views'))
+        except (TypeError, ValueError):
+            views = None
+
+        changes = []
+        if state.seen:
+            if self.notehub.typed_notes:
+                note = Note(note_id, note)
+            if digest != state.digest:
+                changes.append(WatchEvent(note_id, 'text', state.digest,
+                                          digest, note))
+                self.notehub._note_changed(note_id)
+            if edited != state.edited:
+                changes.append(WatchEvent(note_id, 'edited', state.edited,
+                                          edited, note))
+            if views != state.views and None not in (views, state.views):
+                changes.append(WatchEvent(note_id, 'views', state.views,
+                                          views, note))
+        state.seen = True
+        state.digest = digest
+        state.edited = edited
+        state.views = views
+        return changes
+
+    def _reschedule(self, note_id, state, changes):
+        """Private. Works out a note's next interval and schedules its next
+        poll. Needs the lock.
+        """
+        if changes and changes[0].kind != 'error':
+            state.interval = self.min_interval
+        else:
+            state.interval = min(state.interval * self.backoff,
+                                 self.max_interval)
+        interval = state.interval * (1 - self.jitter * random.random())
+        state.due = time.monotonic() + interval
+        self._push(note_id, state)
+
+    def events(self):
+        """Polls the notes as they fall due until stop() is called,
+        yielding what changed.
+
+        Yields:
+            WatchEvents.
+        """
+        self._stopped.clear()
+        while not self._stopped.is_set():
+            due = self.next_due()
+            delay = self.max_interval if due is None \
+                else due - time.monotonic()
+            if delay > 0:
+                self._wakeup.wait(delay)
+                self._wakeup.clear()
+                continue
+            for event in self.poll():
+                yield event
+
+    def run(self, callback):
+        """Calls callback with each WatchEvent until stop() is called.
+        """
+        for event in self.events():
+            callback(event)
+
+    def stop(self):
+        """Makes events() and run() return. Can be called from any thread or
+        from the callback.
+        """
+        self._stopped.set()
+        self._wakeup.set()
+
+class Prefetcher(object):
+    """Iterates over notes in order, fetching the next ones in the
+    background.
+
+    Keeps a window of upcoming notes being fetched so that each next()
+    usually returns a note that has already arrived. The window is sized
+    from the measured latency of a fetch and the time the caller spends
+    between calls to next(): enough fetches to cover one fetch's latency at
+    the pace the notes are being used, between min_window and max_window.
+    No more are started while the fetched notes waiting to be returned,
+    plus the expected size of those still being fetched, add up to
+    max_bytes.
+
+    Notes are fetched with get_note, so the Notehub object's cache is used.
+    A failed call doesn't stop the iteration, the NotehubError is returned
+    in place of the note.
+
+    Attributes:
+        notehub: The Notehub object used to fetch the notes.
+        min_window: The fewest notes fetched ahead. (Default: 1).
+        max_window: The most notes fetched ahead. None for the pool_size of
+            notehub. (Default: None).
+        max_bytes: The most bytes of note text to hold ahead of the caller.
+            (Default: 16 MB).
+        window: The current number of notes to fetch ahead.
+        hits: The number of notes that had arrived when next() was called.
+        misses: The number of notes next() had to wait for.
+
+    Example use:
+
+        with Prefetcher(nh, note_ids) as notes:
+            for note_id, note in notes:
+                render(note)
+    """
+
+    def __init__(self, notehub, note_ids, min_window=1, max_window=None,
+                 max_bytes=16 * 1024 * 1024):
+        """Constructor for Prefetcher object.
+
+        Args:
+            notehub: The Notehub object to fetch the notes with.
+            note_ids: An iterable of note IDs, in the order they'll be
+                used. It is read lazily.
+            min_window: Optional. Default 1. The fewest notes to fetch
+                ahead.
+            max_window: Optional. Default notehub.pool_size. The most notes
+                to fetch ahead.
+            max_bytes: Optional. Default 16 MB. The most bytes of note text
+                to hold ahead of the caller.
+        """
+        self.notehub = notehub
+        self.max_window = max_window or notehub.pool_size
+        self.min_window = max(1, min(min_window, self.max_window))
+        self.max_bytes = max_bytes
+        self.window = self.min_window
+        self.hits = 0
+        self.misses = 0
+        self._note_ids = iter(note_ids)
+        self._pending = collections.deque()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_window)
+        self._lock = threading.Lock()
+        # Bytes of the notes that arrived but haven't been returned
+        self._buffered = 0
+        # Moving averages of a fetch's latency and note size, and of the
+        # time the caller spends between calls to next()
+        self._latency = None
+        self._size = None
+        self._pace = None
+        self._returned = None
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __next__(self):
+        now = time.monotonic()
+        if self._returned is not None:
+            self._pace = self._average(self._pace, now - self._returned)
+        self._fill()
+        if not self._pending:
+            self.close()
+            raise StopIteration
+        note_id, future = self._pending.popleft()
+        if future.done():
+            self.hits += 1
+        else:
+            self.misses += 1
+        try:
+            note, size = future.result()
+        except NotehubError as e:
+            note, size = e, 0
+        with self._lock:
+            self._buffered -= size
+        self._fill()
+        self._returned = time.monotonic()
+        return note_id, note
+
+    @staticmethod
+    def _average(average, value, alpha=0.2):
+        """Private. Adds a value to an exponentially weighted moving
+        average.
+        """
+        if average is None:
+            return value
+        return average + alpha * (value - average)
+
+    def _fetch(self, note_id):
+        """Private. Fetches a note on a worker thread, returning it and the
+        size of its text.
+        """
+        start = time.monotonic()
+        try:
+            note = self.notehub.get_note(note_id)
+        finally:
+            latency = time.monotonic() - start
+            with self._lock:
+                self._latency = self._average(self._latency, latency)
+        text = note.get('note')
+        size = len(text) if isinstance(text, str) else 0
+        with self._lock:
+            self._buffered += size
+            self._size = self._average(self._size, size)
+        return note, size
+
+    def _tune(self):
+        """Private. Sizes the window to cover a fetch's latency at the pace
+        the caller uses the notes.
+        """
+        with self._lock:
+            latency = self._latency
+        if latency is None:
+            # Nothing is known until the first fetch finishes
+            return
+        if self._pace:
+            window = int(math.ceil(latency / self._pace)) + 1
+        else:
+            window = self.max_window
+        self.window = max(self.min_window, min(window, self.max_window))
+
+    def _fill(self):
+        """Private. Starts fetches until the window is full or the memory
+        budget is spent.
+        """
+        self._tune()
+        while len(self._pending) < self.window:
+            with self._lock:
+                in_flight = sum(1 for _, future in self._pending
+                                if not future.done())
+                expected = self._buffered + in_flight * (self._size or 0)
+            if self._pending and expected >= self.max_bytes:
+                break
+            note_id = next(self._note_ids, None)
+            if note_id is None:
+                break
+            self._pending.append(
+                (note_id, self._executor.submit(self._fetch, note_id)))
+
+    def close(self):
+        """Stops fetching. Fetches already made are left to finish.
+        """
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=False)
+
+class Ticket(object):
+    """A create_note or update_note call queued by a WriteBehind.
+
+    Attributes:
+        id: The string that identifies the call in the journal.
+        call: 'create_note' or 'update_note'.
+        result: The response of the call once it has been made, such as
+            the noteID and URLs of a created note. None until then.
+        error: The NotehubError the call failed with, or None.
+    """
+
+    __slots__ = ('id', 'call', 'result', 'error', '_done')
+
+    def __init__(self, ticket_id, call):
+        self.id = ticket_id
+        self.call = call
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def done(self):
+        """Returns whether the call has been made or has failed.
+        """
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Waits for the call to be made and returns its response.
+
+        Args:
+            timeout: Optional. The most seconds to wait. Default is to wait
+                for as long as it takes.
+
+        Raises:
+            NotehubError: The call failed, or the timeout passed first.
+        """
+        if not self._done.wait(timeout):
+            raise NotehubError('Timed out waiting for ' + self.call)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def _resolve(self, result=None, error=None):
+        """Private. Records the outcome of the call and wakes waiters.
+        """
+        self.result = result
+        self.error = error
+        self._done.set()
+
+    def __repr__(self):
+        return 'Ticket(%r, %r)' % (self.id, self.call)
+
+class _JournalEntry(object):
+    """Private. A queued call that WriteBehind hasn't finished.
+    """
+
+    __slots__ = ('ticket', 'args', 'sent', 'attempts', 'not_before')
+
+    def __init__(self, ticket, args):
+        self.ticket = ticket
+        self.args = args
+        # Set once a create_note may have reached Notehub.org
+        self.sent = False
+        self.attempts = 0
+        self.not_before = 0.0
+
+    @property
+    def key(self):
+        """The note an update_note changes, calls for the same note are
+        made in order. None for create_note.
+        """
+        return self.args.get('note_id')
+
+    def records(self):
+        """The journal records that recreate the entry.
+        """
+        records = [{'op': 'queue', 't': self.ticket.id,
+                    'call': self.ticket.call, 'args': self.args}]
+        if self.sent:
+            records.append({'op': 'sent', 't': self.ticket.id})
+        return records
+
+class WriteBehind(object):
+    """Queues create_note and update_note calls in a journal on disk and
+    makes them in the background.
+
+    A call returns a Ticket as soon as it has been appended to the journal
+    and the journal has been fsynced, so callers don't wait on Notehub.org.
+    Concurrent callers share fsyncs. A background thread takes batches of
+    queued calls, makes them from a pool of worker threads and records the
+    results in the journal with one fsync per batch. Calls that fail with
+    a retryable error are retried with backoff, and calls for the same
+    note are made in the order they were queued.
+
+    When the journal is opened again after a crash the calls that weren't
+    finished are queued again. CREATE NOTE isn't idempotent, so a
+    create_note that may have reached Notehub.org before the crash isn't
+    sent again: its ticket fails instead of risking a duplicate note. The
+    same applies to a create_note that failed without a response. The
+    journal holds the note passwords, so it is created readable only by
+    its owner.
+
+    Attributes:
+        notehub: The Notehub object that makes the calls.
+        path: The path of the journal.
+        retry: The RetryPolicy for failed calls.
+            (Default: RetryPolicy(max_attempts=5)).
+        batch_size: The most calls taken from the queue at once.
+            (Default: 50).
+        max_workers: The number of calls to make at once. None for the
+            pool_size of notehub. (Default: None).
+        compact_every: How many finished calls to let build up in the
+            journal before rewriting it without them. (Default: 1000).
+
+    Example use:
+
+        with Notehub(PID, PSK) as nh, WriteBehind(nh, 'notes.journal') as wb:
+            ticket = wb.create_note('Some text', 'abc123')
+            ...
+            print(ticket.wait()['noteID'])
+    """
+
+    def __init__(self, notehub, path, retry=None, batch_size=50,
+                 max_workers=None, compact_every=1000):
+        """Constructor for WriteBehind object.
+
+        Replays the journal if it exists and starts the background thread.
+
+        Args:
+            notehub: The Notehub object to make the calls with.
+            path: The path of the journal. It is created if it doesn't
+                exist.
+            retry: Optional. The RetryPolicy for failed calls. Default is
+                up to 5 attempts.
+            batch_size: Optional. Default 50. The most calls taken from the
+                queue at once.
+            max_workers: Optional. Default notehub.pool_size. The number of
+                calls to make at once.
+            compact_every: Optional. Default 1000. How many finished calls
+                to let build up in the journal before rewriting it.
+
+        Raises:
+            NotehubError: The journal is corrupt.
+            OSError: The journal couldn't be read or written.
+        """
+        self.notehub = notehub
+        self.path = path
+        self.retry = retry if retry is not None else RetryPolicy(
+            max_attempts=5)
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._sync_lock = threading.Lock()
+        self._written = 0
+        self._synced = 0
+        self._finished = 0
+        self._queue = collections.deque()
+        self._in_flight = {}
+        self._tickets = {}
+        self._closing = False
+        self._abandon = False
+        self._fd = None
+
+        failed = []
+        for entry in self._replay():
+            self._tickets[entry.ticket.id] = entry.ticket
+            if entry.sent:
+                failed.append(entry)
+            else:
+                self._queue.append(entry)
+        # Leaves out the calls that can't be replayed
+        self._compact()
+        for entry in failed:
+            entry.ticket._resolve(error=NotehubError(
+                'create_note may have reached Notehub.org before a crash, '
+                'it was not sent again'))
+        self._thread = threading.Thread(target=self._drain)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def create_note(self, note_text, password='', theme='', text_font='',
+                    header_font=''):
+        """Queues a Notehub.create_note call.
+
+        Returns:
+            A Ticket that resolves to the response of the call.
+
+        Raises:
+            NotehubError: The WriteBehind has been closed.
+            OSError: The call couldn't be written to the journal.
+        """
+        return self._enqueue('create_note', {
+            'note_text': note_text, 'password': password, 'theme': theme,
+            'text_font': text_font, 'header_font': header_font})
+
+    def update_note(self, note_id, new_note_text, password):
+        """Queues a Notehub.update_note call.
+
+        Returns:
+            A Ticket that resolves to the response of the call.
+
+        Raises:
+            NotehubError: The WriteBehind has been closed.
+            OSError: The call couldn't be written to the journal.
+        """
+        return self._enqueue('update_note', {
+            'note_id': note_id, 'new_note_text': new_note_text,
+            'password': password})
+
+    def ticket(self, ticket_id):
+        """Returns the Ticket with the given ID, for a call queued by this
+        object or replayed from the journal.
+
+        Raises:
+            KeyError: There is no such ticket.
+        """
+        with self._lock:
+            return self._tickets[ticket_id]
+
+    def pending(self):
+        """Returns the number of calls that haven't finished.
+        """
+        with self._lock:
+            return len(self._queue) + len(self._in_flight)
+
+    def flush(self, timeout=None):
+        """Waits for every queued call to finish.
+
+        Args:
+            timeout: Optional. The most seconds to wait. Default is to wait
+                for as long as it takes.
+
+        Returns:
+            True if every call finished, False if the timeout passed first.
+        """
+        with self._changed:
+            return self._changed.wait_for(
+                lambda: not self._queue and not self._in_flight, timeout)
+
+    def close(self, wait=True):
+        """Stops the background thread and closes the journal.
+
+        Args:
+            wait: Optional. Default True. Whether to finish the queued calls
+                first. Calls that aren't finished stay in the journal and
+                are made when it is opened again.
+        """
+        with self._changed:
+            if self._fd is None:
+                return
+            self._closing = True
+            self._abandon = not wait
+            self._changed.notify_all()
+        self._thread.join()
+        self._compact()
+        with self._lock:
+            os.close(self._fd)
+            self._fd = None
+
+    def _enqueue(self, call, args):
+        """Private. Journals a call and queues it.
+        """
+        ticket = Ticket(uuid.uuid4().hex, call)
+        entry = _JournalEntry(ticket, args)
+        with self._changed:
+            if self._closing:
+                raise NotehubError('WriteBehind is closed')
+            # Queued under the same lock as the write so calls for the same
+            # note are made in journal order
+            seq = self._write(entry.records())
+            self._tickets[ticket.id] = ticket
+            self._queue.append(entry)
+        self._sync(seq)
+        with self._changed:
+            self._changed.notify_all()
+        return ticket
+
+    def _write(self, records):
+        """Private. Appends records to the journal without syncing it.
+        Needs the lock.
+
+        Returns:
+            A sequence number to pass to _sync.
+        """
+        data = ''.join(json.dumps(record, separators=(',', ':')) + '\n'
+                       for record in records)
+        os.write(self._fd, data.encode('utf-8'))
+        self._written += 1
+        return self._written
+
+    def _sync(self, seq):
+        """Private. Makes sure the write numbered seq is on disk. A caller
+        that finds another's fsync has covered its write doesn't make one.
+        """
+        with self._sync_lock:
+            if self._synced >= seq:
+                return
+            with self._lock:
+                written = self._written
+                fd = self._fd
+            os.fsync(fd)
+            self._synced = written
+
+    def _append(self, records):
+        """Private. Appends records to the journal and syncs it.
+        """
+        if not records:
+            return
+        with self._lock:
+            seq = self._write(records)
+        self._sync(seq)
+
+    def _replay(self):
+        """Private. Reads the journal, returning the unfinished entries in
+        the order they were queued.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                lines = f.read().split(b'\n')
+        except FileNotFoundError:
+            return []
+        # A crash during a write can leave the last line cut short, it was
+        # never synced so no caller was given its ticket
+        lines.pop()
+        entries = collections.OrderedDict()
+        for number, line in enumerate(lines, 1):
+            try:
+                record = json.loads(line.decode('utf-8'))
+                op = record['op']
+                ticket_id = record['t']
+                if op == 'queue':
+                    ticket = Ticket(ticket_id, record['call'])
+                    entries[ticket_id] = _JournalEntry(ticket,
+                                                       record['args'])
+                elif op == 'sent':
+                    entries[ticket_id].sent = True
+                elif op == 'retry':
+                    entries[ticket_id].sent = False
+                else: # done or failed
+                    entries.pop(ticket_id, None)
+            except (ValueError, KeyError, TypeError) as e:
+                raise NotehubError('Journal error: bad record on line %d: %s'
+                                   % (number, e))
+        return list(entries.values())
+
+    def _compact(self):
+        """Private. Rewrites the journal with only the unfinished calls.
+        """
+        with self._sync_lock, self._lock:
+            entries = list(self._in_flight.values()) + list(self._queue)
+            tmp_path = self.path + '.tmp'
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+            try:
+                for entry in entries:
+                    data = ''.join(json.dumps(record, separators=(',', ':'))
+                                   + '\n' for record in entry.records())
+                    os.write(fd, data.encode('utf-8'))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            os.replace(tmp_path, self.path)
+            if self._fd is not None:
+                os.close(self._fd)
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+            self._synced = self._written
+            self._finished = 0
+
+    def _take_batch(self):
+        """Private. Takes the calls that are ready from the queue. Needs the
+        lock.
+        """
+        now = time.monotonic()
+        batch = []
+        waiting = collections.deque()
+        # Notes with an earlier call in flight, waiting or in the batch
+        blocked = set(entry.key for entry in self._in_flight.values())
+        for entry in self._queue:
+            key = entry.key
+            if (len(batch) >= self.batch_size or key in blocked or
+                    entry.not_before > now):
+                waiting.append(entry)
+            else:
+                batch.append(entry)
+            if key is not None:
+                blocked.add(key)
+        self._queue = waiting
+        for entry in batch:
+            self._in_flight[entry.ticket.id] = entry
+        return batch
+
+    def _drain(self):
+        """Private. Makes the queued calls until close() is called.
+        """
+        while True:
+            with self._changed:
+                if self._abandon:
+                    return
+                batch = self._take_batch()
+                while not batch:
+                    if self._abandon or (self._closing and not self._queue):
+                        return
+                    delay = min([entry.not_before for entry in self._queue],
+                                default=None)
+                    if delay is not None:
+                        delay -= time.monotonic()
+                    self._changed.wait(delay)
+                    batch = self._take_batch()
+            self._run(batch)
+
+    def _run(self, batch):
+        """Private. Makes a batch of calls and journals their results.
+        """
+        # CREATE NOTE can't be sent twice, so record that it may have been
+        # sent before sending it
+        self._append([{'op': 'sent', 't': entry.ticket.id}
+                      for entry in batch
+                      if entry.ticket.call == 'create_note'])
+        for entry in batch:
+            if entry.ticket.call == 'create_note':
+                entry.sent = True
+
+        records = []
+        finished = []
+        retries = []
+        max_workers = self.max_workers or self.notehub.pool_size
+        for entry, resp in _fan_out(self._call, batch, max_workers,
+                                    ordered=False):
+            if not isinstance(resp, NotehubError):
+                records.append({'op': 'done', 't': entry.ticket.id,
+                                'result': resp})
+                finished.append((entry, resp, None))
+                continue
+            entry.attempts += 1
+            # A create_note that got no response may have been made
+            retry = (entry.attempts < self.retry.max_attempts and
+                     self.retry.should_retry(resp) and
+                     not (entry.sent and resp.status_code is None))
+            if retry:
+                entry.not_before = (time.monotonic() +
+                                    self.retry.get_delay(entry.attempts))
+                if entry.sent:
+                    entry.sent = False
+                    records.append({'op': 'retry', 't': entry.ticket.id})
+                retries.append(entry)
+            else:
+                records.append({'op': 'failed', 't': entry.ticket.id,
+                                'error': str(resp),
+                                'code': resp.status_code})
+                finished.append((entry, None, resp))
+        self._append(records)
+
+        # Tickets only resolve once their results are on disk
+        for entry, resp, error in finished:
+            entry.ticket._resolve(resp, error)
+        with self._changed:
+            for entry in batch:
+                del self._in_flight[entry.ticket.id]
+            # Retries go before later calls for the same note
+            self._queue.extendleft(reversed(retries))
+            self._finished += len(finished)
+            compact = self._finished >= self.compact_every
+            self._changed.notify_all()
+        if compact:
+            self._compact()
+
+    def _call(self, entry):
+        """Private. Makes one queued call.
+        """
+        return getattr(self.notehub, entry.ticket.call)(**entry.args)
+
+class PublisherStats(object):
+    """A snapshot of the calls a NotehubPool has made with one publisher ID.
+
+    Attributes:
+        pid: The publisher ID.
+        in_flight: The number of calls being made.
+        calls: The number of calls finished.
+        errors: The number of finished calls that failed.
+        error_rate: errors / calls, or 0.0 before the first call.
+        throughput: Calls finished per second over the last WINDOW seconds.
+        mean_latency: The mean time a call took in seconds, not counting
+            waiting on the rate budget, or None before the first call.
+    """
+
+    __slots__ = ('pid', 'in_flight', 'calls', 'errors', 'error_rate',
+                 'throughput', 'mean_latency')
+
+    WINDOW = 60.0
+
+    def __repr__(self):
+        return ('PublisherStats(%r, calls=%d, errors=%d, in_flight=%d)' %
+                (self.pid, self.calls, self.errors, self.in_flight))
+
+class _Publisher(object):
+    """Private. One set of credentials in a NotehubPool and its counters.
+    The pool's lock must be held to use the counters.
+    """
+
+    def __init__(self, notehub, limiter):
+        self.notehub = notehub
+        self.limiter = limiter
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.latency = 0.0
+        # time.monotonic() when each recent call finished
+        self.finished = collections.deque()
+
+    def stats(self, now):
+        """Returns a PublisherStats for the counters.
+        """
+        while self.finished and self.finished[0] < now - PublisherStats.WINDOW:
+            self.finished.popleft()
+        stats = PublisherStats()
+        stats.pid = self.notehub.pid
+        stats.in_flight = self.in_flight
+        stats.calls = self.calls
+        stats.errors = self.errors
+        stats.error_rate = self.errors / self.calls if self.calls else 0.0
+        stats.throughput = len(self.finished) / PublisherStats.WINDOW
+        stats.mean_latency = (self.latency / self.calls if self.calls
+                              else None)
+        return stats
+
+class NotehubPool(object):
+    """Spreads calls across several Notehub.org publisher IDs.
+
+    Holds a Notehub object for each (pid, psk) pair. create_note uses the
+    publisher with the fewest calls in flight or, when rate is set, the
+    one whose rate budget frees up soonest, so publishing isn't capped by
+    the throttling of a single account. update_note uses the publisher
+    that created the note, looked up in owners. get_note uses the
+    publisher with the fewest calls in flight and doesn't use the rate
+    budget.
+
+    The object can be shared between threads.
+
+    Attributes:
+        publishers: The Notehub objects, one for each publisher ID.
+        owners: The NoteOwners recording which publisher created each
+            note, or None to only remember the notes created by this
+            object. (Default: None).
+        rate: The maximum create_note and update_note calls per second for
+            each publisher ID, or None for no limit. (Default: None).
+        burst: The number of calls a publisher can make back to back when
+            under the rate. (Default: 1).
+
+    Example use:
+
+        with NotehubPool([(PID1, PSK1), (PID2, PSK2)], rate=5,
+                         owners=NoteOwners('state')) as pool:
+            for spec, note in pool.create_notes(specs):
+                ...
+            print(pool.stats())
+    """
+
+    def __init__(self, credentials, owners=None, rate=None, burst=1,
+                 **options):
+        """Constructor for NotehubPool object.
+
+        Args:
+            credentials: An iterable of (pid, psk) pairs.
+            owners: Optional. A NoteOwners to record and look up which
+                publisher created each note. Default is to only remember
+                the notes created by this object.
+            rate: Optional. The maximum create_note and update_note calls
+                per second for each publisher ID. Default is no limit, and
+                create_note balances by calls in flight.
+            burst: Optional. Default 1. The number of calls a publisher can
+                make back to back when under the rate.
+            **options: Passed on to each Notehub object, e.g. pool_size,
+                retry or hooks.
+
+        Raises:
+            ValueError: No credentials were given, or a publisher ID was
+                given twice.
+        """
+        self.owners = owners
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        # Used instead of owners when there isn't one
+        self._created = {}
+        self._publishers = collections.OrderedDict()
+        for pid, psk in credentials:
+            if pid in self._publishers:
+                raise ValueError('Publisher ID given twice: %r' % pid)
+            limiter = RateLimiter(rate, burst) if rate else None
+            self._publishers[pid] = _Publisher(Notehub(pid, psk, **options),
+                                               limiter)
+        if not self._publishers:
+            raise ValueError('No credentials given')
+        self.publishers = [publisher.notehub
+                           for publisher in self._publishers.values()]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Closes every Notehub object.
+        """
+        for notehub in self.publishers:
+            notehub.close()
+
+    def stats(self):
+        """Returns a dict of publisher ID to PublisherStats.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return collections.OrderedDict(
+                (pid, publisher.stats(now))
+                for pid, publisher in self._publishers.items())
+
+    def _choose(self, budgeted):
+        """Private. Picks the publisher for a call that any of them can make
+        and counts the call as in flight.
+
+        Returns:
+            The _Publisher and how long to wait for its rate budget.
+        """
+        with self._lock:
+            if budgeted and self.rate:
+                publisher = min(self._publishers.values(),
+                                key=lambda p: (p.limiter.wait_time(),
+                                               p.in_flight, p.calls))
+            else:
+                publisher = min(self._publishers.values(),
+                                key=lambda p: (p.in_flight, p.calls))
+            publisher.in_flight += 1
+            return publisher, self._reserve(publisher, budgeted)
+
+    def _owner(self, note_id):
+        """Private. Counts an update_note call as in flight with the
+        publisher that created the note.
+
+        Returns:
+            The _Publisher and how long to wait for its rate budget.
+
+        Raises:
+            NotehubError: The note's publisher isn't known or isn't in the
+                pool.
+        """
+        if self.owners is not None:
+            pid = self.owners.get(note_id)
+        else:
+            with self._lock:
+                pid = self._created.get(note_id)
+        if pid is None:
+            raise NotehubError('The publisher of %s is not known' % note_id)
+        with self._lock:
+            publisher = self._publishers.get(pid)
+            if publisher is None:
+                raise NotehubError('%s was created by %s, which is not in '
+                                   'the pool' % (note_id, pid))
+            publisher.in_flight += 1
+            return publisher, self._reserve(publisher, True)
+
+    def _reserve(self, publisher, budgeted):
+        """Private. Takes a token from a publisher's rate budget, returning
+        how long to wait before using it.
+        """
+        if budgeted and publisher.limiter is not None:
+            return publisher.limiter.reserve()
+        return 0
+
+    def _call(self, chosen, method, *args):
+        """Private. Makes a call with a publisher picked by _choose or
+        _owner and records how it went.
+        """
+        publisher, delay = chosen
+        start = None
+        error = None
+        try:
+            if delay > 0:
+                time.sleep(delay)
+            start = time.monotonic()
+            return getattr(publisher.notehub, method)(*args)
+        except NotehubError as e:
+            error = e
+            raise
+        finally:
+            now = time.monotonic()
+            with self._lock:
+                publisher.in_flight -= 1
+                if start is not None:
+                    publisher.calls += 1
+                    if error is not None:
+                        publisher.errors += 1
+                    publisher.latency += now - start
+                    publisher.finished.append(now)
+
+    def get_note(self, note_id):
+        """Retreives a note with the least busy publisher. See
+        Notehub.get_note.
+        """
+        return self._call(self._choose(False), 'get_note', note_id)
+
+    def create_note(self, note_text, password='', theme='', text_font='',
+                    header_font=''):
+        """Creates a note with the least busy publisher and records which
+        one created it. See Notehub.create_note.
+
+        Raises:
+            NotehubError: There was a problem making the call, or recording
+                the publisher.
+        """
+        chosen = self._choose(True)
+        resp = self._call(chosen, 'create_note', note_text, password, theme,
+                          text_font, header_font)
+        note_id = resp.get('noteID')
+        if note_id is not None:
+            pid = chosen[0].notehub.pid
+            if self.owners is not None:
+                self.owners.put(note_id, pid)
+            else:
+                with self._lock:
+                    self._created[note_id] = pid
+        return resp
+
+    def update_note(self, note_id, new_note_text, password):
+        """Edits a note with the publisher that created it. See
+        Notehub.update_note.
+
+        Raises:
+            NotehubError: There was a problem making the call, or the
+                note's publisher isn't known.
+        """
+        return self._call(self._owner(note_id), 'update_note', note_id,
+                          new_note_text, password)
+
+    def create_notes(self, specs, max_workers=None, ordered=True):
+        """Creates many notes concurrently, spread across the publishers.
+        See Notehub.create_notes.
+
+        Args:
+            specs: An iterable of dicts holding the arguments to
+                create_note.
+            max_workers: Optional. Default the total pool_size of the
+                publishers. The number of requests to make at once.
+            ordered: Optional. Default True. If True results are returned in
+                the same order as specs, otherwise in the order they arrive.
+
+        Yields:
+            (spec, note) tuples, with a NotehubError in place of the note
+            if the call failed.
+        """
+        return _fan_out(lambda spec: self.create_note(**spec), specs,
+                        max_workers or self._max_workers(), ordered)
+
+    def update_notes(self, specs, max_workers=None, ordered=True):
+        """Edits many notes concurrently, each with the publisher that
+        created it. See create_notes.
+        """
+        return _fan_out(lambda spec: self.update_note(**spec), specs,
+                        max_workers or self._max_workers(), ordered)
+
+    def _max_workers(self):
+        """Private. The total connection pool size of the publishers.
+        """
+        return sum(notehub.pool_size for notehub in self.publishers)
+
+def export_notes(notehub, note_ids, path, max_workers=None,
+                 checkpoint_every=100):
+    """Backs up notes to a gzip compressed JSON lines archive.
+
+    Each line is the GET NOTE response of one note with its "noteID"
+    added. Notes are fetched concurrently with get_notes and written as
+    they arrive, so memory use doesn't grow with the number of notes.
+
+    Every checkpoint_every notes the archive is flushed to disk and its
+    size recorded in a checkpoint file next to it, path + '.checkpoint'.
+    Exporting to the same path again resumes from the last checkpoint:
+    anything written after it is discarded and the notes already in the
+    archive are skipped. Without a checkpoint file the archive is started
+    again. Notes that fail aren't written, so a rerun tries them again.
+
+    Args:
+        notehub: The Notehub object to fetch the notes with.
+        note_ids: An iterable of the IDs of the notes to export.
+        path: The path of the archive.
+        max_workers: Optional. Default the pool_size of notehub. The number
+            of requests to make at once.
+        checkpoint_every: Optional. Default 100. How many notes to write
+            between checkpoints.
+
+    Returns:
+        A dict of note IDs to the NotehubError for the notes that couldn't
+        be fetched.
+
+    Raises:
+        OSError: The archive couldn't be written.
+    """
+    checkpoint_path = path + '.checkpoint'
+    offset = 0
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            offset = json.load(f)['offset']
+    with open(path, 'ab') as f:
+        f.truncate(offset)
+    exported = set()
+    if offset:
+        exported.update(note['noteID'] for note in read_export(path))
+
+    def checkpoint(f):
+        f.flush()
+        os.fsync(f.fileno())
+        tmp_path = checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as tmp:
+            json.dump({'offset': f.tell()}, tmp)
+        os.replace(tmp_path, checkpoint_path)
+
+    errors = {}
+    pending = (note_id for note_id in note_ids if note_id not in exported)
+    with open(path, 'ab') as f:
+        # Each batch is its own gzip member, so the archive is valid up to
+        # every checkpoint
+        batch = None
+        count = 0
+        for note_id, note in notehub.get_notes(pending, max_workers,
+                                               ordered=False):
+            if isinstance(note, NotehubError):
+                errors[note_id] = note
+                continue
+            if batch is None:
+                batch = gzip.GzipFile(fileobj=f, mode='wb')
+            line = note.to_dict() if isinstance(note, Note) else dict(note)
+            line['noteID'] = note_id
+            batch.write(json.dumps(line, separators=(',', ':'))
+                        .encode('utf-8') + b'\n')
+            count += 1
+            if count >= checkpoint_every:
+                batch.close()
+                checkpoint(f)
+                batch = None
+                count = 0
+        if batch is not None:
+            batch.close()
+        checkpoint(f)
+    return errors
+
+def read_export(path):
+    """Reads the notes in an archive made by export_notes.
+
+    Args:
+        path: The path of the archive.
+
+    Yields:
+        The dict of each note, with its "noteID".
+
+    Raises:
+        OSError: The archive couldn't be read, or is corrupt.
+        ValueError: A line of the archive isn't valid JSON.
+    """
+    with gzip.open(path, 'rb') as f:
+        for line in f:
+            yield json.loads(line)
+
+def verify_export(notehub, path, max_workers=None):
+    """Checks the notes in an archive made by export_notes against
+    Notehub.org.
+
+    The text of each note is compared by its content hash, so only the
+    notes being checked are held in memory.
+
+    Args:
+        notehub: The Notehub object to fetch the notes with.
+        path: The path of the archive.
+        max_workers: Optional. Default the pool_size of notehub. The number
+            of requests to make at once.
+
+    Yields:
+        (note_id, result) tuples in the order the checks finish. result is
+        'ok' if the text on Notehub.org is the same as in the archive,
+        'changed' if it isn't, or the NotehubError if the note couldn't be
+        fetched.
+
+    Raises:
+        OSError: The archive couldn't be read, or is corrupt.
+    """
+    hashes = ((note['noteID'], ContentHashIndex.hash_text(note['note']))
+              for note in read_export(path))
+
+    def check(item):
+        note_id, digest = item
+        live = notehub.get_note(note_id)['note']
+        return 'ok' if ContentHashIndex.hash_text(live) == digest else 'changed'
+
+    for (note_id, _), result in _fan_out(
+            check, hashes, max_workers or notehub.pool_size, ordered=False):
+        yield note_id, result
+
+def _credentials(args):
+    """Private. Returns the pid and psk given on the command line or in the
+    NOTEHUB_PID and NOTEHUB_PSK environment variables.
+    """
+    return (args.pid or os.environ.get('NOTEHUB_PID', ''),
+            args.psk or os.environ.get('NOTEHUB_PSK', ''))
+
+def _mirror_command(args):
+    """Private. Runs the mirror command.
+    """
+    pid, psk = _credentials(args)
+    failed = 0
+    with Notehub(pid, psk, pool_size=args.parallel) as nh:
+        mirror = Mirror(nh, args.directory, args.password,
+                        args.pattern or ('*.md',),
+                        MirrorManifest(args.manifest or args.directory))
+        try:
+            if args.dry_run:
+                for path, action in mirror.scan():
+                    print('%s %s' % (action, path))
+                return 0
+            for result in mirror.run():
+                if result.action == 'failed':
+                    failed += 1
+                    print('failed %s: %s' % (result.path, result.error),
+                          file=sys.stderr)
+                elif result.action != 'unchanged' or args.verbose:
+                    print('%s %s %s' % (result.action, result.path,
+                                        result.note_id))
+            for path in sorted(mirror.removed()):
+                print('removed %s' % path)
+        finally:
+            mirror.manifest.close()
+    return 1 if failed else 0
+
+def _read_lines(path):
+    """Private. Yields the non-blank lines of a file, or of stdin for '-'.
+    """
+    f = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    try:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def _export_command(args):
+    """Private. Runs the export command.
+    """
+    pid, psk = _credentials(args)
+    with Notehub(pid, psk, pool_size=args.parallel) as nh:
+        errors = export_notes(nh, _read_lines(args.ids), args.archive)
+    for note_id, error in sorted(errors.items()):
+        print('failed %s: %s' % (note_id, error), file=sys.stderr)
+    return 1 if errors else 0
+
+def _verify_command(args):
+    """Private. Runs the verify command.
+    """
+    pid, psk = _credentials(args)
+    problems = 0
+    with Notehub(pid, psk, pool_size=args.parallel) as nh:
+        for note_id, result in verify_export(nh, args.archive):
+            if isinstance(result, NotehubError):
+                problems += 1
+                print('failed %s: %s' % (note_id, result), file=sys.stderr)
+            elif result != 'ok' or args.verbose:
+                problems += result != 'ok'
+                print('%s %s' % (result, note_id))
+    return 1 if problems else 0
+
+def _json_specs(lines, defaults):
+    """Private. Parses JSON specs, one per line, yielding (line, spec) with
+    the defaults filled in or (line, NotehubError) for a line that isn't a
+    JSON object.
+    """
+    for line in lines:
+        try:
+            spec = json.loads(line)
+        except ValueError as e:
+            yield line, NotehubError('Invalid JSON: ' + str(e))
+            continue
+        if not isinstance(spec, dict):
+            yield line, NotehubError('Expected a JSON object')
+            continue
+        for name, value in defaults.items():
+            if value:
+                spec.setdefault(name, value)
+        yield line, spec
+
+def _call_with_spec(func, spec):
+    """Private. Calls func(**spec), raising a bad spec as NotehubError.
+    """
+    if isinstance(spec, NotehubError):
+        raise spec
+    try:
+        return func(**spec)
+    except TypeError as e:
+        raise NotehubError('Invalid spec: ' + str(e))
+
+def _emit(item, result):
+    """Private. Writes the result for one input as a line of JSON.
+    """
+    line = {'input': item}
+    if isinstance(result, NotehubError):
+        line['error'] = str(result)
+        line['status_code'] = result.status_code
+    else:
+        line['result'] = (result.to_dict() if isinstance(result, Note)
+                          else result)
+    print(json.dumps(line), flush=True)
+    return not isinstance(result, NotehubError)
+
+def _batch_command(args):
+    """Private. Runs the get, create and update commands.
+
+    Each takes its inputs from the command line, or one per line from
+    stdin, and writes one line of JSON per input as the calls finish.
+    """
+    pid, psk = _credentials(args)
+    inputs = args.inputs or _read_lines('-')
+    failed = 0
+    with Notehub(pid, psk, pool_size=args.parallel) as nh:
+        if args.command == 'get':
+            results = nh.get_notes(inputs, ordered=False)
+        else:
+            func = {'create': nh.create_note,
+                    'update': nh.update_note}[args.command]
+            specs = _json_specs(inputs, {'password': args.password})
+            limiter = None
+            if args.rate:
+                limiter = RateLimiter(args.rate)
+
+            def call(item):
+                if limiter is not None:
+                    limiter.acquire()
+                return _call_with_spec(func, item[1])
+
+            results = ((line, result) for (line, _), result in
+                       _fan_out(call, specs, args.parallel, ordered=False))
+        for item, result in results:
+            failed += not _emit(item, result)
+    return 1 if failed else 0
+
+def main(argv=None):
+    """Runs the notehub command line tool.
+
+    Args:
+        argv: Optional. The arguments, default sys.argv[1:].
+
+    Returns:
+        The exit status.
+    """
+    parser = argparse.ArgumentParser(
+        prog='notehub', description='A client for the Notehub.org api.')
+    parser.add_argument('--pid', help='publisher ID (default: $NOTEHUB_PID)')
+    parser.add_argument('--psk',
+                        help='publisher secret key (default: $NOTEHUB_PSK)')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    get = commands.add_parser(
+        'get', help='fetch notes',
+        description='Fetches notes, writing a line of JSON for each as it '
+                    'arrives.')
+    get.add_argument('inputs', nargs='*', metavar='note_id',
+                     help='IDs of the notes to fetch (default: read one per '
+                          'line from stdin)')
+    create = commands.add_parser(
+        'create', help='create notes',
+        description='Creates notes from JSON specs holding the arguments '
+                    'to create_note, e.g. {"note_text": "Test note 123.", '
+                    '"password": "abc123"}, writing a line of JSON for '
+                    'each as it finishes.')
+    create.add_argument('inputs', nargs='*', metavar='spec',
+                        help='JSON specs (default: read one per line from '
+                             'stdin)')
+    update = commands.add_parser(
+        'update', help='update notes',
+        description='Updates notes from JSON specs holding the arguments '
+                    'to update_note, e.g. {"note_id": '
+                    '"2014/1/26/test-note-123-1", "new_note_text": "Test '
+                    'note 123."}, writing a line of JSON for each as it '
+                    'finishes.')
+    update.add_argument('inputs', nargs='*', metavar='spec',
+                        help='JSON specs (default: read one per line from '
+                             'stdin)')
+    for command in (get, create, update):
+        command.add_argument('--parallel', type=int, default=4,
+                             help='requests to make at once (default: '
+                                  '%(default)s)')
+        command.set_defaults(func=_batch_command)
+    for command in (create, update):
+        command.add_argument('--password', default='',
+                             help='password for specs that have none')
+        command.add_argument('--rate', type=float,
+                             help='the most calls to make per second')
+
+    mirror = commands.add_parser(
+        'mirror', help='publish a directory of files as notes',
+        description='Publishes each file in a directory as a note, only '
+                    'uploading new and changed files.')
+    mirror.add_argument('directory', help='the directory to mirror')
+    mirror.add_argument('--password', default='',
+                        help='the password to create notes with')
+    mirror.add_argument('--pattern', action='append',
+                        help='glob pattern of the file names to publish, can '
+                             'be repeated (default: *.md)')
+    mirror.add_argument('--manifest',
+                        help='directory to keep the manifest in (default: '
+                             'the mirrored directory)')
+    mirror.add_argument('--parallel', type=int, default=4,
+                        help='uploads to make at once (default: '
+                             '%(default)s)')
+    mirror.add_argument('--dry-run', action='store_true',
+                        help='only list what would be uploaded')
+    mirror.add_argument('--verbose', action='store_true',
+                        help='list unchanged files too')
+    mirror.set_defaults(func=_mirror_command)
+
+    export = commands.add_parser(
+        'export', help='back up notes to a compressed archive',
+        description='Fetches notes and writes them to a gzip compressed JSON '
+                    'lines archive. Running it again resumes an interrupted '
+                    'export.')
+    export.add_argument('ids',
+                        help='file of note IDs, one per line, or - for stdin')
+    export.add_argument('archive', help='the archive to write')
+    export.add_argument('--parallel', type=int, default=4,
+                        help='requests to make at once (default: '
+                             '%(default)s)')
+    export.set_defaults(func=_export_command)
+
+    verify = commands.add_parser(
+        'verify', help='check an archive against Notehub.org',
+        description='Checks that the notes in an archive made by export '
+                    'have the same text on Notehub.org.')
+    verify.add_argument('archive', help='the archive to check')
+    verify.add_argument('--parallel', type=int, default=4,
+                        help='requests to make at once (default: '
+                             '%(default)s)')
+    verify.add_argument('--verbose', action='store_true',
+                        help='list the notes that match too')
+    verify.set_defaults(func=_verify_command)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args)
+    except (NotehubError, OSError) as e:
+        print('notehub: %s' % e, file=sys.stderr)
+        return 1
 
+if __name__ == '__main__':
+    sys.exit(main())
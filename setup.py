@@ -9,4 +9,6 @@ setup(name='notehub',
       keywords='notehub',
       url='https://github.com/seanwatson/notehub',
       py_modules=['notehub'],
-      install_requires=['requests'])
+      python_requires='>=3.9',
+      extras_require={'async': ['aiohttp'], 'requests': ['requests']},
+      entry_points={'console_scripts': ['notehub=notehub:main']})
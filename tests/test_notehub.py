@@ -26,16 +26,29 @@
 #    IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 #    CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import asyncio
+import contextlib
+from hashlib import md5
 from copy import deepcopy
+from datetime import datetime
+from datetime import timezone
+import http.server
+import io
 import json
 import notehub
+import os
+import requests
+import shutil
+import socket
+import sqlite3
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
-if sys.version_info[0] == 2:
-    from mock import Mock
-else:
-    from unittest.mock import Mock
+from unittest.mock import Mock
 
 # If set to True and a PID and PSK are provided the tests will make actual HTTP
 # requests to Notehub.org. If it isn't necessary to test with real responses set
@@ -71,14 +84,49 @@ SAMPLE_UPDATE_NOTE = {u'longURL': u'http://notehub.org/2014/1/18/test-7',
                                   u'message': ''}
                       }
 
+class CountingHandler(http.server.BaseHTTPRequestHandler):
+    """Answers every request with SAMPLE_GET_NOTE over keep-alive
+    connections and counts the connections opened."""
+
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    open_handlers = []
+
+    def setup(self):
+        CountingHandler.connections += 1
+        CountingHandler.open_handlers.append(self)
+        http.server.BaseHTTPRequestHandler.setup(self)
+
+    @classmethod
+    def close_all(cls):
+        """Closes every connection, as a server timing them out would."""
+        handlers, cls.open_handlers = cls.open_handlers, []
+        for handler in handlers:
+            handler.connection.shutdown(socket.SHUT_RDWR)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        body = json.dumps(SAMPLE_GET_NOTE).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
 class TestNotehub(unittest.TestCase):
 
     def setUp(self):
         self.nh = notehub.Notehub(PID,PSK)
-        self.real_requests = notehub.requests
 
     def tearDown(self):
-        notehub.requests = self.real_requests
+        self.nh.close()
 
     def test_get_note(self):
         # If you don't want to test against live just have the request call
@@ -86,7 +134,7 @@ class TestNotehub(unittest.TestCase):
         if not TEST_AGAINST_LIVE:
             mock_response = Mock(status_code=200,
                                  json=lambda: deepcopy(SAMPLE_GET_NOTE))
-            notehub.requests.get = Mock(return_value=mock_response)
+            self.nh._session.get = Mock(return_value=mock_response)
         note = self.nh.get_note('2014/1/26/test')
         expected_note = deepcopy(SAMPLE_GET_NOTE)
         del expected_note['status']
@@ -95,6 +143,43 @@ class TestNotehub(unittest.TestCase):
         del expected_note['statistics']['views']
         self.assertEqual(expected_note, note)
 
+    def test_get_note_typed(self):
+        self.nh.typed_notes = True
+        mock_response = Mock(status_code=200,
+                             json=lambda: deepcopy(SAMPLE_GET_NOTE))
+        self.nh._session.get = Mock(return_value=mock_response)
+        note = self.nh.get_note('2014/1/26/test')
+        self.assertIsInstance(note, notehub.Note)
+        self.assertEqual('2014/1/26/test', note.id)
+        self.assertEqual(34, note.views)
+        self.assertEqual(datetime(2014, 1, 26, 18, 52, 37,
+                                  tzinfo=timezone.utc),
+                         note.statistics.published)
+        self.assertIsNone(note.statistics.edited)
+        self.assertEqual('http://notehub.org/vbbql', note.short_url)
+        # It still reads like the dict
+        expected_note = deepcopy(SAMPLE_GET_NOTE)
+        del expected_note['status']
+        self.assertEqual(expected_note, note)
+        self.assertEqual(expected_note, note.to_dict())
+        self.assertEqual('34', note['statistics']['views'])
+        self.assertEqual('Test', note.get('title'))
+        self.assertIsNone(note.get('noteID'))
+        self.assertFalse(hasattr(note, '__dict__'))
+
+    def test_note_keeps_unknown_fields(self):
+        resp = deepcopy(SAMPLE_GET_NOTE)
+        del resp['status']
+        resp['theme'] = 'dark'
+        resp['statistics']['views'] = None
+        note = notehub.Note('id', resp)
+        self.assertEqual('dark', note['theme'])
+        self.assertIsNone(note.views)
+        self.assertEqual(resp, note.to_dict())
+        # Publisher names are shared between notes
+        other = notehub.Note('id2', json.loads(json.dumps(resp)))
+        self.assertIs(note.publisher, other.publisher)
+
     def test_get_note_with_bad_note_id(self):
         bad_get_note_response = deepcopy(SAMPLE_GET_NOTE)
         bad_get_note_response['status'] = {'success': False,
@@ -104,7 +189,7 @@ class TestNotehub(unittest.TestCase):
         if not TEST_AGAINST_LIVE:
             mock_response = Mock(status_code=200,
                                  json=lambda: bad_get_note_response)
-            notehub.requests.get = Mock(return_value=mock_response)
+            self.nh._session.get = Mock(return_value=mock_response)
         with self.assertRaises(notehub.NotehubError):
             self.nh.get_note('not a real noteId')
 
@@ -114,7 +199,7 @@ class TestNotehub(unittest.TestCase):
         if not (TEST_AGAINST_LIVE and PID and PSK):
             mock_response = Mock(status_code=200,
                                  json=lambda: deepcopy(SAMPLE_CREATE_NOTE))
-            notehub.requests.post = Mock(return_value=mock_response)
+            self.nh._session.post = Mock(return_value=mock_response)
         note = self.nh.create_note('some test text')
         # Since the date and ID change, just check that a URL comes back
         self.assertEqual('http://notehub.org/', note['longURL'][:19])
@@ -128,7 +213,7 @@ class TestNotehub(unittest.TestCase):
         if not (TEST_AGAINST_LIVE and PID and PSK):
             mock_response = Mock(status_code=200,
                                  json=lambda: deepcopy(SAMPLE_CREATE_NOTE))
-            notehub.requests.post = Mock(return_value=mock_response)
+            self.nh._session.post = Mock(return_value=mock_response)
         note = self.nh.create_note('some test text', 'abc123')
         # Since the date and ID change, just check that a URL comes back
         self.assertEqual('http://notehub.org/', note['longURL'][:19])
@@ -144,7 +229,7 @@ class TestNotehub(unittest.TestCase):
         if not (TEST_AGAINST_LIVE and PID and PSK):
             mock_response = Mock(status_code=200,
                                  json=lambda: sample_note_with_theme)
-            notehub.requests.post = Mock(return_value=mock_response)
+            self.nh._session.post = Mock(return_value=mock_response)
         note = self.nh.create_note('some test text', theme='solarized-light',
                                    text_font='Alegreya Sans SC',
                                    header_font='Chau Philomene One')
@@ -163,7 +248,7 @@ class TestNotehub(unittest.TestCase):
         if not (TEST_AGAINST_LIVE and PID and PSK):
             mock_response = Mock(status_code=200,
                                  json=lambda: deepcopy(SAMPLE_UPDATE_NOTE))
-            notehub.requests.put = Mock(return_value=mock_response)
+            self.nh._session.put = Mock(return_value=mock_response)
         note = self.nh.update_note('2014/1/18/test-7', 'the new text',
                                    'abc123')
         expected_note = deepcopy(SAMPLE_UPDATE_NOTE)
@@ -179,7 +264,7 @@ class TestNotehub(unittest.TestCase):
         if not TEST_AGAINST_LIVE:
             mock_response = Mock(status_code=200,
                                  json=lambda: bad_create_note_response)
-            notehub.requests.post = Mock(return_value=mock_response)
+            self.nh._session.post = Mock(return_value=mock_response)
         self.nh.pid = 'example of not a pid'
         with self.assertRaises(notehub.NotehubError):
             self.nh.create_note('some test text')
@@ -194,11 +279,1378 @@ class TestNotehub(unittest.TestCase):
         if not TEST_AGAINST_LIVE:
             mock_response = Mock(status_code=200,
                                  json=lambda: bad_create_note_response)
-            notehub.requests.post = Mock(return_value=mock_response)
+            self.nh._session.post = Mock(return_value=mock_response)
+        self.nh.psk = 'example of not a psk'
+        with self.assertRaises(notehub.NotehubError):
+            self.nh.create_note('some test text')
+
+    def test_session_reused_between_calls(self):
+        mock_response = Mock(status_code=200,
+                             json=lambda: deepcopy(SAMPLE_GET_NOTE))
+        session = self.nh._session
+        session.get = Mock(return_value=mock_response)
+        self.nh.get_note('2014/1/26/test')
+        self.nh.get_note('2014/1/26/test')
+        self.assertIs(session, self.nh._session)
+        self.assertEqual(2, session.get.call_count)
+
+    def test_warmup_connections_are_reused(self):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                 CountingHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        for transport in notehub.TRANSPORTS:
+            with self.subTest(transport=transport):
+                CountingHandler.connections = 0
+                nh = notehub.Notehub(PID, PSK, pool_size=3,
+                                     transport=transport)
+                nh.BASE_URL = ('http://127.0.0.1:%d/api/note' %
+                               server.server_port)
+                self.addCleanup(nh.close)
+                nh.warmup(3)
+                self.assertEqual(3, CountingHandler.connections)
+                for _ in range(3):
+                    nh.get_note('2014/1/26/test')
+                self.assertEqual(3, CountingHandler.connections)
+
+    def test_hooks_get_call_samples(self):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                 CountingHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        for transport in notehub.TRANSPORTS:
+            with self.subTest(transport=transport):
+                self.check_hooks(server, transport)
+
+    def check_hooks(self, server, transport):
+        samples = []
+        histogram = notehub.LatencyHistogram()
+        nh = notehub.Notehub(PID, PSK, hooks=[samples.append, histogram],
+                             transport=transport)
+        nh.BASE_URL = 'http://127.0.0.1:%d/api/note' % server.server_port
+        self.addCleanup(nh.close)
+        nh.get_note('2014/1/26/test')
+        nh.get_note('2014/1/26/test')
+        first, second = samples
+        self.assertEqual(('get_note', 'GET', 200, None, 1),
+                         (first.call, first.method, first.status_code,
+                          first.error, first.attempts))
+        self.assertGreater(first.connect, 0)
+        # The second call reused the connection
+        self.assertEqual(0, second.connect)
+        self.assertEqual(len(json.dumps(SAMPLE_GET_NOTE)),
+                         first.response_bytes)
+        self.assertGreater(first.request_bytes, 0)
+        phases = sum(getattr(first, phase)
+                     for phase in notehub.CallSample.PHASES[:-1])
+        self.assertLessEqual(phases, first.total)
+        self.assertEqual(2, histogram.count('get_note'))
+        self.assertEqual(2, histogram.status_codes[('get_note', 200)])
+
+    def test_unknown_transport(self):
+        with self.assertRaises(ValueError):
+            notehub.Notehub(PID, PSK, transport='carrier pigeon')
+
+    def test_import_is_lazy(self):
+        # requests and asyncio are only imported when they are used
+        code = ('import sys, notehub; notehub.Notehub("", "").close(); '
+                'print(sorted(set(["requests", "asyncio", "aiohttp"]) & '
+                'set(sys.modules)))')
+        output = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.join(os.path.dirname(__file__), '..'))
+        self.assertEqual(b'[]', output.strip())
+
+    def test_dropped_connections_are_not_reused(self):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                 CountingHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        CountingHandler.connections = 0
+        nh = notehub.Notehub(PID, PSK)
+        nh.BASE_URL = 'http://127.0.0.1:%d/api/note' % server.server_port
+        self.addCleanup(nh.close)
+        nh.get_note('2014/1/26/test')
+        # The server times out the idle connection
+        conn, = [conn for conns in nh._session._idle.values()
+                 for conn in conns]
+        CountingHandler.close_all()
+        time.sleep(0.1)
+        nh.get_note('2014/1/26/test')
+        self.assertEqual(2, CountingHandler.connections)
+        self.assertIsNone(conn.sock)
+
+    def test_hooks_see_errors(self):
+        samples = []
+        self.nh.hooks = [samples.append]
+        self.nh._session.post = Mock(return_value=Mock(
+            status_code=503, request=Mock(body='note=some+test+text')))
+        with self.assertRaises(notehub.NotehubError):
+            self.nh.create_note('some test text')
+        self.assertEqual(19, samples[0].request_bytes)
+        self.assertEqual(('create_note', 503, 'NotehubError'),
+                         (samples[0].call, samples[0].status_code,
+                          samples[0].error))
+        self.assertGreater(samples[0].sign, 0)
+
+    def test_latency_histogram_percentiles(self):
+        histogram = notehub.LatencyHistogram()
+        for ms in range(1, 101):
+            sample = notehub.CallSample('update_note', 'PUT')
+            sample.total = ms / 1000.0
+            sample.status_code = 200
+            histogram(sample)
+        percentiles = histogram.percentiles('update_note')
+        for name, expected in [('p50', 0.050), ('p95', 0.095),
+                               ('p99', 0.099)]:
+            self.assertAlmostEqual(expected, percentiles[name],
+                                   delta=expected * 0.02)
+        self.assertIsNone(histogram.percentile('get_note', 50))
+        self.assertEqual(0.0, histogram.percentile('update_note', 50,
+                                                   phase='connect'))
+
+    def test_close_and_context_manager(self):
+        with notehub.Notehub(PID, PSK) as nh:
+            session = nh._session
+            session.close = Mock()
+        session.close.assert_called_once_with()
+        self.assertIsNone(nh._session)
+        # A closed object reopens its pool on the next call
+        self.assertIsNotNone(nh._get_session())
+        nh.close()
+
+    def mock_get_by_note_id(self, bad_note_ids=()):
+        def get(url, params, **kwargs):
+            body = deepcopy(SAMPLE_GET_NOTE)
+            body['note'] = params['noteID']
+            if params['noteID'] in bad_note_ids:
+                body['status'] = {'success': False, 'message': 'Bad noteID.'}
+            return Mock(status_code=200, json=lambda: body)
+        self.nh._session.get = Mock(side_effect=get)
+
+    def test_get_notes(self):
+        self.mock_get_by_note_id(bad_note_ids=['note-3'])
+        note_ids = ['note-%d' % i for i in range(50)]
+        results = list(self.nh.get_notes(iter(note_ids), max_workers=4))
+        self.assertEqual(note_ids, [note_id for note_id, _ in results])
+        for note_id, note in results:
+            if note_id == 'note-3':
+                self.assertIsInstance(note, notehub.NotehubError)
+            else:
+                self.assertEqual(note_id, note['note'])
+
+    def test_get_notes_reports_malformed_responses(self):
+        def get(url, params, **kwargs):
+            if params['noteID'] == 'not-json':
+                return Mock(status_code=200,
+                            json=Mock(side_effect=ValueError('bad json')))
+            if params['noteID'] == 'no-status':
+                return Mock(status_code=200, json=lambda: {'note': 'x'})
+            if params['noteID'] == 'not-a-dict':
+                return Mock(status_code=200, json=lambda: ['x'])
+            return self.ok_response()
+        self.nh._session.get = Mock(side_effect=get)
+        note_ids = ['ok-1', 'not-json', 'no-status', 'not-a-dict', 'ok-2']
+        results = dict(self.nh.get_notes(note_ids, max_workers=2))
+        self.assertEqual(set(note_ids), set(results))
+        for note_id in note_ids[1:4]:
+            self.assertIsInstance(results[note_id], notehub.NotehubError)
+        self.assertEqual(SAMPLE_GET_NOTE['note'], results['ok-2']['note'])
+
+    def test_get_notes_unordered(self):
+        self.mock_get_by_note_id()
+        note_ids = ['note-%d' % i for i in range(50)]
+        results = dict(self.nh.get_notes(note_ids, max_workers=4,
+                                         ordered=False))
+        self.assertEqual(set(note_ids), set(results))
+        for note_id, note in results.items():
+            self.assertEqual(note_id, note['note'])
+
+    def test_get_notes_reads_ids_lazily(self):
+        self.mock_get_by_note_id()
+        consumed = []
+        def note_ids():
+            for i in range(1000):
+                consumed.append(i)
+                yield 'note-%d' % i
+        results = self.nh.get_notes(note_ids(), max_workers=2)
+        next(results)
+        self.assertLessEqual(len(consumed), 5)
+        results.close()
+
+    def test_create_notes(self):
+        def post(url, data, **kwargs):
+            body = deepcopy(SAMPLE_CREATE_NOTE)
+            body['noteID'] = data['note']
+            return Mock(status_code=200, json=lambda: body)
+        self.nh._session.post = Mock(side_effect=post)
+        specs = [{'note_text': 'note %d' % i, 'password': 'abc123'}
+                 for i in range(10)]
+        results = list(self.nh.create_notes(specs, max_workers=3))
+        self.assertEqual(specs, [spec for spec, _ in results])
+        for spec, note in results:
+            self.assertEqual(spec['note_text'], note['noteID'])
+            self.assertIn('longURL', note)
+
+    def test_update_notes_with_rate_limit(self):
+        mock_response = Mock(status_code=200,
+                             json=lambda: deepcopy(SAMPLE_UPDATE_NOTE))
+        self.nh._session.put = Mock(return_value=mock_response)
+        specs = [{'note_id': 'note-%d' % i, 'new_note_text': 'new text',
+                  'password': 'abc123'} for i in range(6)]
+        start = time.monotonic()
+        results = list(self.nh.update_notes(specs, rate=50, burst=2))
+        # 2 calls come out of the burst, the other 4 wait 1/50 s each
+        self.assertGreaterEqual(time.monotonic() - start, 0.07)
+        self.assertEqual(6, len(results))
+        self.assertEqual(6, self.nh._session.put.call_count)
+
+    def test_rate_limiter(self):
+        limiter = notehub.RateLimiter(100, burst=5)
+        start = time.monotonic()
+        for _ in range(5):
+            limiter.acquire()
+        self.assertLess(time.monotonic() - start, 0.01)
+        for _ in range(5):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.045)
+        with self.assertRaises(ValueError):
+            notehub.RateLimiter(0)
+
+        limiter = notehub.RateLimiter(10)
+        self.assertEqual(0, limiter.wait_time())
+        self.assertEqual(0, limiter.reserve())
+        self.assertAlmostEqual(0.1, limiter.wait_time(), places=2)
+        self.assertAlmostEqual(0.1, limiter.reserve(), places=2)
+
+    def test_get_note_with_cache(self):
+        self.nh.cache = notehub.NoteCache()
+        mock_response = Mock(status_code=200,
+                             json=lambda: deepcopy(SAMPLE_GET_NOTE))
+        self.nh._session.get = Mock(return_value=mock_response)
+        first = self.nh.get_note('2014/1/26/test')
+        # Changing a returned note must not change the cached copy
+        first['note'] = 'changed'
+        second = self.nh.get_note('2014/1/26/test')
+        self.assertEqual(SAMPLE_GET_NOTE['note'], second['note'])
+        self.assertEqual(1, self.nh._session.get.call_count)
+        self.assertEqual((1, 1), (self.nh.cache.hits, self.nh.cache.misses))
+
+    def test_update_note_invalidates_cache(self):
+        self.nh.cache = notehub.NoteCache()
+        self.nh.cache.put('2014/1/18/test-7', deepcopy(SAMPLE_GET_NOTE))
+        mock_response = Mock(status_code=200,
+                             json=lambda: deepcopy(SAMPLE_UPDATE_NOTE))
+        self.nh._session.put = Mock(return_value=mock_response)
+        self.nh.update_note('2014/1/18/test-7', 'the new text', 'abc123')
+        self.assertIsNone(self.nh.cache.get('2014/1/18/test-7'))
+
+    def test_get_note_racing_update_note_is_not_cached(self):
+        self.nh.cache = notehub.NoteCache()
+        started = threading.Event()
+        release = threading.Event()
+        texts = ['OLD', 'NEW']
+        def get(url, params, **kwargs):
+            body = deepcopy(SAMPLE_GET_NOTE)
+            body['note'] = texts.pop(0)
+            if body['note'] == 'OLD':
+                started.set()
+                release.wait(5)
+            return Mock(status_code=200, json=lambda: body)
+        self.nh._session.get = Mock(side_effect=get)
+        self.nh._session.put = Mock(return_value=Mock(
+            status_code=200, json=lambda: deepcopy(SAMPLE_UPDATE_NOTE)))
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(self.nh.get_note('note')))
+        thread.start()
+        started.wait(5)
+        self.nh.update_note('note', 'NEW', 'abc123')
+        release.set()
+        thread.join(5)
+        self.assertEqual('OLD', results[0]['note'])
+        # Neither the cache nor the old flight may serve the old text now
+        self.assertEqual('NEW', self.nh.get_note('note')['note'])
+        self.assertEqual(2, self.nh._session.get.call_count)
+
+    def test_get_note_after_update_does_not_join_old_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+        texts = ['OLD', 'NEW']
+        def get(url, params, **kwargs):
+            body = deepcopy(SAMPLE_GET_NOTE)
+            body['note'] = texts.pop(0)
+            if body['note'] == 'OLD':
+                started.set()
+                release.wait(5)
+            return Mock(status_code=200, json=lambda: body)
+        self.nh._session.get = Mock(side_effect=get)
+        self.nh._session.put = Mock(return_value=Mock(
+            status_code=200, json=lambda: deepcopy(SAMPLE_UPDATE_NOTE)))
+        thread = threading.Thread(target=self.nh.get_note, args=('note',))
+        thread.start()
+        started.wait(5)
+        self.nh.update_note('note', 'NEW', 'abc123')
+        self.assertEqual('NEW', self.nh.get_note('note')['note'])
+        self.assertEqual(0, self.nh.coalesced)
+        release.set()
+        thread.join(5)
+
+    def test_note_cache_eviction(self):
+        cache = notehub.NoteCache(max_entries=3, max_bytes=10)
+        for i in range(3):
+            cache.put(i, {'note': 'abc'})
+        self.assertEqual(9, cache.size)
+        cache.get(0)
+        cache.put(3, {'note': 'abc'})
+        # 1 was the least recently used
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(1, cache.evictions)
+        cache.put(4, {'note': 'abcdefgh'})
+        self.assertEqual([4], list(cache._entries))
+        self.assertEqual(8, cache.size)
+        cache.invalidate(4)
+        self.assertEqual((0, 0), (len(cache), cache.size))
+
+    def test_note_cache_ttl(self):
+        cache = notehub.NoteCache(ttl=0.01)
+        cache.put('a', {'note': 'abc'})
+        self.assertIsNotNone(cache.get('a'))
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(1, cache.expirations)
+        self.assertEqual(0, cache.size)
+
+    def test_get_note_with_disk_cache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.nh.cache = notehub.DiskNoteCache(directory)
+        self.addCleanup(self.nh.cache.close)
+        mock_response = Mock(status_code=200,
+                             json=lambda: deepcopy(SAMPLE_GET_NOTE))
+        self.nh._session.get = Mock(return_value=mock_response)
+        note = self.nh.get_note('2014/1/26/test')
+        # A second object, as if in another process, reads the same file
+        other = notehub.DiskNoteCache(directory)
+        self.addCleanup(other.close)
+        self.assertEqual(note, other.get('2014/1/26/test'))
+        self.assertEqual(1, other.hits)
+        self.nh.cache.invalidate('2014/1/26/test')
+        self.assertIsNone(other.get('2014/1/26/test'))
+
+    def test_disk_cache_eviction_and_ttl(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = notehub.DiskNoteCache(directory, max_entries=2, ttl=60)
+        self.addCleanup(cache.close)
+        for i in range(3):
+            cache.put('note-%d' % i, {'note': 'text %d' % i, 'title': 'T'})
+            time.sleep(0.001)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.evictions)
+        self.assertIsNone(cache.get('note-0'))
+        self.assertEqual({'note': 'text 2', 'title': 'T'},
+                         cache.get('note-2'))
+        cache.ttl = -1
+        cache.put('note-3', {'note': 'old'})
+        self.assertIsNone(cache.get('note-3'))
+        self.assertEqual(1, cache.expirations)
+
+    def test_get_note_coalesces_concurrent_calls(self):
+        started = threading.Event()
+        release = threading.Event()
+        def get(url, params, **kwargs):
+            started.set()
+            release.wait(5)
+            return Mock(status_code=200,
+                        json=lambda: deepcopy(SAMPLE_GET_NOTE))
+        self.nh._session.get = Mock(side_effect=get)
+        results = []
+        def call():
+            results.append(self.nh.get_note('2014/1/26/test'))
+        threads = [threading.Thread(target=call) for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while self.nh.coalesced < 4:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(1, self.nh._session.get.call_count)
+        self.assertEqual(5, len(results))
+        self.assertEqual(5, len(set(id(note) for note in results)))
+        self.assertEqual({}, self.nh._flights)
+
+    def test_get_note_leader_interrupted(self):
+        started = threading.Event()
+        release = threading.Event()
+        def get(url, params, **kwargs):
+            started.set()
+            release.wait(5)
+            raise KeyboardInterrupt()
+        self.nh._session.get = Mock(side_effect=get)
+        leader_errors = []
+        def lead():
+            try:
+                self.nh.get_note('2014/1/26/test')
+            except KeyboardInterrupt as e:
+                leader_errors.append(e)
+        leader = threading.Thread(target=lead)
+        leader.start()
+        started.wait(5)
+        results = []
+        def follow():
+            try:
+                results.append(self.nh.get_note('2014/1/26/test'))
+            except KeyboardInterrupt as e:
+                results.append(e)
+        follower = threading.Thread(target=follow)
+        follower.start()
+        while self.nh.coalesced < 1:
+            time.sleep(0.001)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual(1, len(leader_errors))
+        self.assertIsInstance(results[0], KeyboardInterrupt)
+
+    def test_get_note_coalesced_error(self):
+        release = threading.Event()
+        def get(url, params, **kwargs):
+            release.wait(5)
+            return Mock(status_code=500)
+        self.nh._session.get = Mock(side_effect=get)
+        errors = []
+        def call():
+            try:
+                self.nh.get_note('2014/1/26/test')
+            except notehub.NotehubError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while self.nh.coalesced < 2:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(3, len(errors))
+        self.assertEqual(1, self.nh._session.get.call_count)
+
+    def ok_response(self, body=SAMPLE_GET_NOTE):
+        return Mock(status_code=200, json=lambda: deepcopy(body))
+
+    def test_concurrency_limiter_grows_and_shrinks(self):
+        limiter = notehub.ConcurrencyLimiter(initial=2, max_limit=4)
+        for _ in range(20):
+            limiter.release(limiter.acquire(), 0.01)
+        self.assertEqual(4, limiter.limit)
+        # Failures from requests in flight together shrink it once
+        tokens = [limiter.acquire() for _ in range(4)]
+        self.assertEqual(4, limiter.in_flight)
+        for token in tokens:
+            limiter.release(token, 0.01, notehub.NotehubError('', 503))
+        self.assertEqual(2, limiter.limit)
+        # An error in a successful response isn't overload
+        limiter.release(limiter.acquire(), 0.01,
+                        notehub.NotehubError('Bad password', 200))
+        self.assertEqual(2, limiter.limit)
+        # So is rising latency
+        limiter.release(limiter.acquire(), 1.0)
+        self.assertEqual(1, limiter.limit)
+        self.assertEqual(0, limiter.in_flight)
+
+    def test_concurrency_limiter_blocks_at_the_limit(self):
+        limiter = notehub.ConcurrencyLimiter(initial=1)
+        token = limiter.acquire()
+        acquired = threading.Event()
+        thread = threading.Thread(
+            target=lambda: (limiter.acquire(), acquired.set()))
+        thread.start()
+        self.assertFalse(acquired.wait(0.05))
+        limiter.release(token, None)
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+
+    def test_circuit_breaker(self):
+        breaker = notehub.CircuitBreaker(window=4, min_requests=4,
+                                         cooldown=0.05)
+        self.nh.breaker = breaker
+        self.nh.limiter = notehub.ConcurrencyLimiter()
+        self.nh._session.get = Mock(return_value=Mock(status_code=503))
+        for _ in range(4):
+            with self.assertRaises(notehub.NotehubError):
+                self.nh.get_note('2014/1/26/test')
+        self.assertEqual('open', breaker.state)
+        self.assertEqual(1, breaker.opened)
+        # Calls fail fast, without a request, and aren't retried
+        self.nh.retry = notehub.RetryPolicy(backoff=0)
+        with self.assertRaises(notehub.CircuitOpenError):
+            self.nh.get_note('2014/1/26/test')
+        self.assertEqual(4, self.nh._session.get.call_count)
+
+        # After the cooldown one trial request is let through
+        time.sleep(0.06)
+        self.nh._session.get = Mock(return_value=self.ok_response())
+        self.nh.get_note('2014/1/26/test')
+        self.assertEqual('closed', breaker.state)
+        self.assertEqual(0.0, breaker.error_rate)
+        self.assertEqual(0, self.nh.limiter.in_flight)
+
+    def test_circuit_breaker_reopens_after_failed_trial(self):
+        breaker = notehub.CircuitBreaker(window=2, min_requests=2,
+                                         cooldown=0)
+        for _ in range(2):
+            breaker.before_request()
+            breaker.record(notehub.NotehubError('reset'))
+        self.assertEqual('open', breaker.state)
+        breaker.before_request()
+        self.assertEqual('half_open', breaker.state)
+        # Only one trial at a time
+        with self.assertRaises(notehub.CircuitOpenError):
+            breaker.before_request()
+        breaker.record(notehub.NotehubError('reset'))
+        self.assertEqual(('open', 2), (breaker.state, breaker.opened))
+
+    def test_retry_on_server_error_and_connection_error(self):
+        self.nh.retry = notehub.RetryPolicy(max_attempts=3, backoff=0)
+        self.nh._session.get = Mock(side_effect=[
+            Mock(status_code=503),
+            requests.exceptions.ConnectionError('reset'),
+            self.ok_response()])
+        note = self.nh.get_note('2014/1/26/test')
+        self.assertEqual(SAMPLE_GET_NOTE['note'], note['note'])
+        self.assertEqual(3, self.nh._session.get.call_count)
+
+    def test_retry_gives_up_after_max_attempts(self):
+        self.nh.retry = notehub.RetryPolicy(max_attempts=2, backoff=0)
+        self.nh._session.put = Mock(return_value=Mock(status_code=500))
+        with self.assertRaises(notehub.NotehubError) as cm:
+            self.nh.update_note('2014/1/18/test-7', 'text', 'abc123')
+        self.assertEqual(500, cm.exception.status_code)
+        self.assertEqual(2, self.nh._session.put.call_count)
+
+    def test_no_retry_for_create_note(self):
+        self.nh.retry = notehub.RetryPolicy(max_attempts=5, backoff=0)
+        self.nh._session.post = Mock(return_value=Mock(status_code=503))
+        with self.assertRaises(notehub.NotehubError):
+            self.nh.create_note('some test text')
+        self.assertEqual(1, self.nh._session.post.call_count)
+
+    def test_no_retry_for_failure_status(self):
+        self.nh.retry = notehub.RetryPolicy(max_attempts=5, backoff=0)
+        bad_response = deepcopy(SAMPLE_GET_NOTE)
+        bad_response['status'] = {'success': False, 'message': 'Bad noteID.'}
+        self.nh._session.get = Mock(return_value=self.ok_response(bad_response))
+        with self.assertRaises(notehub.NotehubError):
+            self.nh.get_note('not a real noteId')
+        self.assertEqual(1, self.nh._session.get.call_count)
+
+    def test_retry_status_codes(self):
+        policy = notehub.RetryPolicy(retry_status_codes=(502,))
+        self.assertTrue(policy.should_retry(notehub.NotehubError('', 502)))
+        self.assertTrue(policy.should_retry(notehub.NotehubError('')))
+        self.assertFalse(policy.should_retry(notehub.NotehubError('', 500)))
+        self.assertFalse(policy.should_retry(notehub.NotehubError('', 200)))
+
+    def test_retry_delay_bounds(self):
+        policy = notehub.RetryPolicy(backoff=0.1, max_backoff=0.5)
+        for retry, limit in [(1, 0.1), (2, 0.2), (3, 0.4), (4, 0.5),
+                             (10, 0.5)]:
+            delays = [policy.get_delay(retry) for _ in range(200)]
+            self.assertTrue(all(0 <= delay <= limit for delay in delays))
+            # Jittered, not a fixed wait
+            self.assertGreater(len(set(delays)), 1)
+
+    def test_deadline_stops_retries(self):
+        self.nh.retry = notehub.RetryPolicy(max_attempts=1000, backoff=0.01,
+                                            max_backoff=0.01, deadline=0.1)
+        self.nh._session.get = Mock(return_value=Mock(status_code=503))
+        start = time.monotonic()
+        with self.assertRaises(notehub.NotehubError):
+            self.nh.get_note('2014/1/26/test')
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertLess(self.nh._session.get.call_count, 1000)
+
+    def test_deadline_covers_slow_body(self):
+        self.nh.retry = notehub.RetryPolicy(max_attempts=1, deadline=0.05)
+        def trickle(chunk_size):
+            for _ in range(100):
+                time.sleep(0.01)
+                yield b' '
+        self.nh._session.get = Mock(return_value=Mock(
+            status_code=200, iter_content=trickle))
+        start = time.monotonic()
+        with self.assertRaises(notehub.NotehubError) as cm:
+            self.nh.get_note('2014/1/26/test')
+        self.assertIn('Deadline', str(cm.exception))
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_hedged_get_first_answer_wins(self):
+        self.nh.retry = notehub.RetryPolicy(max_attempts=1, hedge_after=0.02)
+        slow = deepcopy(SAMPLE_GET_NOTE)
+        slow['note'] = 'slow'
+        fast = deepcopy(SAMPLE_GET_NOTE)
+        fast['note'] = 'fast'
+        release = threading.Event()
+        calls = []
+        def get(url, params, **kwargs):
+            calls.append(params)
+            if len(calls) == 1:
+                release.wait(5)
+                return self.ok_response(slow)
+            return self.ok_response(fast)
+        self.nh._session.get = Mock(side_effect=get)
+        note = self.nh.get_note('2014/1/26/test')
+        release.set()
+        self.assertEqual('fast', note['note'])
+        self.assertEqual(2, len(calls))
+
+    def test_hedged_get_after_close(self):
+        self.nh.retry = notehub.RetryPolicy(hedge_after=1)
+        self.nh._session.get = Mock(return_value=self.ok_response())
+        self.nh.get_note('2014/1/26/test')
+        self.nh.close()
+        self.nh._get_session().get = Mock(return_value=self.ok_response())
+        self.nh.get_note('2014/1/26/test')
+
+    def make_disk_cache(self, **kwargs):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = notehub.DiskNoteCache(directory, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_disk_cache_shares_one_connection(self):
+        cache = self.make_disk_cache()
+        threads = [threading.Thread(target=cache.put,
+                                    args=('note-%d' % i, {'note': 'x'}))
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(10, len(cache))
+        conn = cache._conn
+        threading.Thread(target=cache.get, args=('note-1',)).start()
+        self.assertIs(conn, cache._conn)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+    def test_disk_cache_reconnects_after_fork(self):
+        cache = self.make_disk_cache()
+        cache.put('note', {'note': 'from parent'})
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                conn = cache._conn
+                ok = cache.get('note') == {'note': 'from parent'}
+                status = 0 if ok and cache._conn is not conn else 1
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+        self.assertEqual({'note': 'from parent'}, cache.get('note'))
+
+    def test_disk_cache_purges_expired_notes(self):
+        cache = self.make_disk_cache(ttl=0.05)
+        for i in range(4):
+            cache.put('note-%d' % i, {'note': 'x'})
+        time.sleep(0.06)
+        # A put removes the notes that have expired, even unread ones
+        cache.put('note-4', {'note': 'x'})
+        self.assertEqual(1, len(cache))
+        self.assertEqual(4, cache.expirations)
+
+    def test_disk_cache_rolls_back_failed_writes(self):
+        cache = self.make_disk_cache()
+        cache.put('note', {'note': 'x'})
+        def fail(conn):
+            conn.execute('DELETE FROM meta')
+            raise sqlite3.OperationalError('database is locked')
+        with self.assertRaises(notehub.NotehubError):
+            cache._transaction(fail)
+        # The delete was rolled back and the connection is usable
+        self.assertEqual({'note': 'x'}, cache.get('note'))
+        cache.invalidate('note')
+        self.assertEqual(0, len(cache))
+
+
+class TestFakeNotehub(unittest.TestCase):
+    """Checks the benchmark server behaves like Notehub.org."""
+
+    def setUp(self):
+        sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                        'benchmarks'))
+        from fake_notehub import FakeNotehubServer
+        self.server = FakeNotehubServer(publishers={'pid': 'psk'})
+        self.server.start()
+        self.nh = notehub.Notehub('pid', 'psk')
+        self.nh.BASE_URL = self.server.url
+
+    def tearDown(self):
+        self.nh.close()
+        self.server.stop()
+        sys.path.pop(0)
+
+    def test_round_trip(self):
+        note = self.nh.create_note('some test text', 'abc123')
+        self.assertIn('some-test-text', note['noteID'])
+        self.nh.update_note(note['noteID'], 'the new text', 'abc123')
+        fetched = self.nh.get_note(note['noteID'])
+        self.assertEqual('the new text', fetched['note'])
+        self.assertEqual('1', fetched['statistics']['views'])
+
+    def test_requests_transport(self):
+        nh = notehub.Notehub('pid', 'psk', transport='requests')
+        nh.BASE_URL = self.server.url
+        self.addCleanup(nh.close)
+        note = nh.create_note('some test text', 'abc123')
+        nh.update_note_stream(note['noteID'], iter(['the ', 'new text']),
+                              'abc123')
+        out = io.StringIO()
+        nh.get_note_to_file(note['noteID'], out)
+        self.assertEqual('the new text', out.getvalue())
+        with self.assertRaises(notehub.NotehubError):
+            nh.update_note(note['noteID'], 'the new text', 'wrong')
+
+    def test_compression(self):
+        text = 'Some compressible note text. ' * 2000
+        for name in notehub.TRANSPORTS:
+            with self.subTest(transport=name):
+                samples = []
+                nh = notehub.Notehub('pid', 'psk', transport=name,
+                                     hooks=[samples.append],
+                                     compress_threshold=1024)
+                nh.BASE_URL = self.server.url
+                self.addCleanup(nh.close)
+
+                note = nh.create_note(text, 'abc123')
+                sample = samples.pop()
+                self.assertGreater(sample.request_bytes_saved, 50000)
+                self.assertLess(sample.request_bytes, 5000)
+                self.assertEqual(text, nh.get_note(note['noteID'])['note'])
+                sample = samples.pop()
+                self.assertGreater(sample.response_bytes_saved, 50000)
+                self.assertGreater(sample.response_bytes, 50000)
+
+                # Small notes aren't worth compressing
+                nh.update_note(note['noteID'], 'short', 'abc123')
+                self.assertEqual(0, samples.pop().request_bytes_saved)
+
+                nh.update_note_stream(note['noteID'], iter([text, text]),
+                                      'abc123')
+                self.assertGreater(samples.pop().request_bytes_saved, 50000)
+                out = io.StringIO()
+                nh.get_note_to_file(note['noteID'], out)
+                self.assertEqual(text + text, out.getvalue())
+
+    def test_compression_not_accepted(self):
+        self.server.accept_gzip = False
+        samples = []
+        self.nh.hooks.append(samples.append)
+        self.nh.compress_threshold = 0
+        # Sent again uncompressed, then compression is turned off
+        note = self.nh.create_note('some test text', 'abc123')
+        self.assertEqual(2, samples.pop().attempts)
+        self.nh.update_note(note['noteID'], 'the new text', 'abc123')
+        self.assertEqual(1, samples.pop().attempts)
+        self.assertEqual('the new text',
+                         self.nh.get_note(note['noteID'])['note'])
+
+
+    def test_watcher(self):
+        note = self.nh.create_note('some test text', 'abc123')
+        note_id = note['noteID']
+        self.nh.cache = notehub.NoteCache()
+        watcher = notehub.Watcher(self.nh, [note_id, 'missing'],
+                                  min_interval=0.01, max_interval=0.04,
+                                  jitter=0)
+        # The first poll only records the note
+        events = watcher.poll()
+        self.assertEqual(['error'], [event.kind for event in events])
+        self.assertEqual(0.02, watcher.interval('missing'))
+        self.assertEqual(0.02, watcher.interval(note_id))
+
+        time.sleep(0.05)
+        events = watcher.poll()
+        kinds = sorted((event.note_id, event.kind) for event in events)
+        self.assertEqual(sorted([('missing', 'error'), (note_id, 'views')]),
+                         kinds)
+        views = [event for event in events if event.kind == 'views'][0]
+        self.assertEqual((1, 2, 1), (views.old, views.new, views.delta))
+        self.assertEqual(0.01, watcher.interval(note_id))
+        self.assertEqual(0.04, watcher.interval('missing'))
+
+        # Edited by someone else while the old text is cached
+        self.nh.get_note(note_id)
+        other = notehub.Notehub('pid', 'psk')
+        other.BASE_URL = self.server.url
+        self.addCleanup(other.close)
+        other.update_note(note_id, 'the new text', 'abc123')
+        time.sleep(0.05)
+        events = dict((event.kind, event) for event in watcher.poll()
+                      if event.note_id == note_id)
+        self.assertEqual({'text', 'edited', 'views'}, set(events))
+        self.assertEqual('the new text', events['text'].note['note'])
+        self.assertEqual(notehub.ContentHashIndex.hash_text('the new text'),
+                         events['text'].new)
+        self.assertEqual(2, events['views'].delta)
+        self.assertIsNone(events['edited'].old)
+        # The stale note was dropped from the cache
+        self.assertEqual('the new text', self.nh.get_note(note_id)['note'])
+
+        watcher.remove('missing')
+        self.assertEqual([], watcher.poll())
+
+    def test_watcher_events(self):
+        note = self.nh.create_note('some test text', 'abc123')
+        watcher = notehub.Watcher(self.nh, min_interval=0.01,
+                                  max_interval=0.01)
+        seen = []
+
+        def callback(event):
+            seen.append(event)
+            watcher.stop()
+
+        thread = threading.Thread(target=watcher.run, args=(callback,))
+        thread.start()
+        watcher.add(note['noteID'])
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(['views'], [event.kind for event in seen])
+
+    def test_prefetcher(self):
+        note_ids = [self.nh.create_note('note %d' % i)['noteID']
+                    for i in range(12)]
+        self.server.latency = 0.02
+        with notehub.Prefetcher(self.nh, note_ids + ['missing'],
+                                max_window=8) as notes:
+            results = []
+            for note_id, note in notes:
+                results.append((note_id, note))
+                time.sleep(0.01)
+        self.assertEqual(note_ids + ['missing'],
+                         [note_id for note_id, _ in results])
+        self.assertEqual('note 11', results[11][1]['note'])
+        self.assertIsInstance(results[12][1], notehub.NotehubError)
+        # Two or three fetches cover a 20 ms fetch at 10 ms a note
+        self.assertTrue(2 <= notes.window <= 5, notes.window)
+        self.assertGreater(notes.hits, notes.misses)
+
+    def test_prefetcher_memory_budget(self):
+        note_ids = [self.nh.create_note('note %d' % i)['noteID']
+                    for i in range(6)]
+        samples = []
+        self.nh.hooks.append(samples.append)
+        notes = notehub.Prefetcher(self.nh, note_ids, max_window=6,
+                                   max_bytes=1)
+        self.addCleanup(notes.close)
+        self.assertEqual(note_ids[0], next(notes)[0])
+        time.sleep(0.1)
+        # Only the next note is fetched once its size is known
+        self.assertEqual(2, len(samples))
+        self.assertEqual(note_ids[1:], [note_id for note_id, _ in notes])
+
+    def journal_path(self):
+        path = os.path.join(tempfile.mkdtemp(), 'notes.journal')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        return path
+
+    def test_write_behind(self):
+        path = self.journal_path()
+        note = self.nh.create_note('some test text', 'abc123')
+        with notehub.WriteBehind(self.nh, path) as wb:
+            self.assertEqual(0o600, os.stat(path).st_mode & 0o777)
+            created = wb.create_note('a new note', 'abc123')
+            updates = [wb.update_note(note['noteID'], 'text %d' % i,
+                                      'abc123') for i in range(5)]
+            wrong = wb.update_note(note['noteID'], 'text 5', 'wrong')
+            self.assertIn('a-new-note', created.wait(5)['noteID'])
+            self.assertIs(created, wb.ticket(created.id))
+            self.assertTrue(wb.flush(5))
+            self.assertEqual(0, wb.pending())
+        self.assertTrue(all(ticket.done() for ticket in updates))
+        with self.assertRaises(notehub.NotehubError):
+            wrong.wait()
+        # Made in the order they were queued
+        self.assertEqual('text 4', self.nh.get_note(note['noteID'])['note'])
+        self.assertEqual(0, os.path.getsize(path))
+        with self.assertRaises(notehub.NotehubError):
+            wb.create_note('too late')
+
+    def test_write_behind_retries(self):
+        self.server.error_rate = 1
+        retry = notehub.RetryPolicy(max_attempts=100, backoff=0.01,
+                                    max_backoff=0.01)
+        with notehub.WriteBehind(self.nh, self.journal_path(),
+                                 retry=retry) as wb:
+            ticket = wb.create_note('some test text')
+            time.sleep(0.05)
+            self.assertFalse(ticket.done())
+            self.server.error_rate = 0
+            self.assertIn('some-test-text', ticket.wait(5)['noteID'])
+
+    def test_write_behind_replay(self):
+        path = self.journal_path()
+        note = self.nh.create_note('some test text', 'abc123')
+        records = [
+            {'op': 'queue', 't': 'a', 'call': 'create_note',
+             'args': {'note_text': 'never sent'}},
+            {'op': 'queue', 't': 'b', 'call': 'create_note',
+             'args': {'note_text': 'maybe sent'}},
+            {'op': 'sent', 't': 'b'},
+            {'op': 'queue', 't': 'c', 'call': 'update_note',
+             'args': {'note_id': note['noteID'],
+                      'new_note_text': 'replayed', 'password': 'abc123'}},
+            {'op': 'queue', 't': 'd', 'call': 'create_note',
+             'args': {'note_text': 'already made'}},
+            {'op': 'done', 't': 'd', 'result': {}},
+        ]
+        with open(path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            # Cut short by the crash
+            f.write('{"op": "queue", "t": "e"')
+
+        with notehub.WriteBehind(self.nh, path) as wb:
+            self.assertIn('never-sent', wb.ticket('a').wait(5)['noteID'])
+            with self.assertRaises(notehub.NotehubError):
+                wb.ticket('b').wait(5)
+            wb.ticket('c').wait(5)
+            with self.assertRaises(KeyError):
+                wb.ticket('d')
+        self.assertEqual('replayed', self.nh.get_note(note['noteID'])['note'])
+        # Only the note that was never sent was created
+        self.assertEqual(2, len(self.server._notes))
+
+        with open(path, 'w') as f:
+            f.write('not json\n')
+        with self.assertRaises(notehub.NotehubError):
+            notehub.WriteBehind(self.nh, path)
+
+    def test_pool(self):
+        self.server.publishers['pid2'] = 'psk2'
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        credentials = [('pid', 'psk'), ('pid2', 'psk2')]
+        specs = [{'note_text': 'note %d' % i, 'password': 'abc123'}
+                 for i in range(8)]
+        with notehub.NotehubPool(credentials, notehub.NoteOwners(directory),
+                                 pool_size=2) as pool:
+            for nh in pool.publishers:
+                nh.BASE_URL = self.server.url
+            notes = [note for _, note in pool.create_notes(specs)]
+            stats = pool.stats()
+            self.assertEqual(['pid', 'pid2'], list(stats))
+            self.assertEqual(8, sum(s.calls for s in stats.values()))
+            self.assertTrue(all(s.calls for s in stats.values()))
+            self.assertEqual(0, stats['pid'].in_flight)
+            self.assertGreater(stats['pid'].throughput, 0)
+
+        # The owners are read back from the file by a new pool
+        owners = notehub.NoteOwners(directory)
+        self.assertEqual(8, len(owners))
+        pool = notehub.NotehubPool(credentials, owners)
+        self.addCleanup(pool.close)
+        for nh in pool.publishers:
+            nh.BASE_URL = self.server.url
+        specs = [{'note_id': note['noteID'], 'new_note_text': 'updated',
+                  'password': 'abc123'} for note in notes]
+        for _, resp in pool.update_notes(specs):
+            self.assertNotIsInstance(resp, notehub.NotehubError)
+        self.assertEqual('updated', pool.get_note(notes[0]['noteID'])['note'])
+
+        with self.assertRaises(notehub.NotehubError):
+            pool.update_note(notes[0]['noteID'], 'updated', 'wrong')
+        self.assertEqual(1, sum(s.errors for s in pool.stats().values()))
+        with self.assertRaises(notehub.NotehubError):
+            pool.update_note('2014/1/1/unknown', 'updated', 'abc123')
+        with self.assertRaises(ValueError):
+            notehub.NotehubPool([])
+
+    def test_pool_rate(self):
+        self.server.publishers['pid2'] = 'psk2'
+        pool = notehub.NotehubPool([('pid', 'psk'), ('pid2', 'psk2')],
+                                   rate=10)
+        self.addCleanup(pool.close)
+        for nh in pool.publishers:
+            nh.BASE_URL = self.server.url
+        start = time.monotonic()
+        for i in range(4):
+            note = pool.create_note('note %d' % i, 'abc123')
+        # Each publisher makes one call at once, then waits 0.1 s
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertLess(time.monotonic() - start, 0.19)
+        self.assertEqual([2, 2], [s.calls for s in pool.stats().values()])
+        # Without owners only notes created by the pool can be updated
+        pool.update_note(note['noteID'], 'updated', 'abc123')
+
+    def test_checks_signatures_and_passwords(self):
+        note = self.nh.create_note('some test text', 'abc123')
+        with self.assertRaises(notehub.NotehubError):
+            self.nh.update_note(note['noteID'], 'the new text', 'wrong')
         self.nh.psk = 'example of not a psk'
         with self.assertRaises(notehub.NotehubError):
             self.nh.create_note('some test text')
 
+    def test_streamed_notes(self):
+        text = 'Line \u00e9 "quoted" \\ \U0001f600 & more=text\n' * 5000
+        path = os.path.join(tempfile.mkdtemp(), 'note.txt')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+
+        note = self.nh.create_note_stream(path, 'abc123')
+        self.assertEqual(text, self.nh.get_note(note['noteID'])['note'])
+
+        # An iterator is sent with chunked encoding
+        chunks = (text[i:i + 1000] for i in range(0, len(text), 1000))
+        self.nh.update_note_stream(note['noteID'], chunks, 'abc123')
+        out = io.StringIO()
+        resp = self.nh.get_note_to_file(note['noteID'], out)
+        self.assertEqual(text, out.getvalue())
+        self.assertNotIn('note', resp)
+        self.assertEqual('2', resp['statistics']['views'])
+
+        with open(path, 'rb') as f:
+            self.nh.update_note_stream(note['noteID'], f, 'abc123')
+        self.nh.get_note_to_file(note['noteID'], path)
+        with open(path, encoding='utf-8', newline='') as f:
+            self.assertEqual(text, f.read())
+
+    def test_index_skips_unchanged_notes(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        index = notehub.ContentHashIndex(directory)
+        self.addCleanup(index.close)
+        self.nh.index = index
+        note_id = self.nh.create_note('some test text', 'abc123')['noteID']
+        self.assertEqual({'skipped': True},
+                         self.nh.update_note(note_id, 'some test text',
+                                             'abc123'))
+        self.nh.update_note(note_id, 'the new text', 'abc123')
+        self.assertTrue(index.is_unchanged(note_id, 'the new text'))
+        results = dict((spec['new_note_text'], note) for spec, note in
+                       self.nh.update_notes([
+                           {'note_id': note_id, 'password': 'abc123',
+                            'new_note_text': 'the new text'}]))
+        self.assertEqual({'the new text': {'skipped': True}}, results)
+        self.assertEqual(2, self.nh.skipped)
+        # A failed update forgets the note
+        with self.assertRaises(notehub.NotehubError):
+            self.nh.update_note(note_id, 'other text', 'wrong')
+        self.assertIsNone(index.get(note_id))
+
+    def test_index_rebuilds_from_notehub(self):
+        note_id = self.nh.create_note('some test text', 'abc123')['noteID']
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.nh.index = notehub.ContentHashIndex(directory)
+        self.addCleanup(self.nh.index.close)
+        # The missing note is fetched to see that it hasn't changed
+        self.assertEqual({'skipped': True},
+                         self.nh.update_note(note_id, 'some test text',
+                                             'abc123'))
+        self.nh.update_note(note_id, 'the new text', 'abc123')
+        self.assertEqual('the new text', self.nh.get_note(note_id)['note'])
+
+        self.nh.index.clear()
+        self.assertEqual({'missing': notehub.NotehubError},
+                         dict((note_id, type(error)) for note_id, error in
+                              self.nh.index.rebuild_from(
+                                  self.nh, [note_id, 'missing']).items()))
+        self.assertTrue(self.nh.index.is_unchanged(note_id, 'the new text'))
+
+        self.nh.index.rebuild = False
+        self.nh.index.clear()
+        self.nh.update_note(note_id, 'the new text', 'abc123')
+        self.assertEqual(1, self.nh.skipped)
+
+    def write(self, directory, path, text):
+        path = os.path.join(directory, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def test_mirror(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.write(directory, 'a.md', 'note a')
+        self.write(directory, 'sub/b.md', 'note b')
+        self.write(directory, 'c.txt', 'not published')
+        self.write(directory, '.git/d.md', 'not published')
+        mirror = notehub.Mirror(self.nh, directory, password='abc123')
+        self.addCleanup(mirror.manifest.close)
+        self.assertEqual([('a.md', 'new'), ('sub/b.md', 'new')],
+                         list(mirror.scan()))
+
+        results = dict((r.path, r) for r in mirror.run())
+        self.assertEqual(['a.md', 'sub/b.md'], sorted(results))
+        self.assertEqual('created', results['a.md'].action)
+        note_id = results['a.md'].note_id
+        self.assertEqual('note a', self.nh.get_note(note_id)['note'])
+
+        self.write(directory, 'a.md', 'new text for a')
+        # Touched but the same text
+        self.write(directory, 'sub/b.md', 'note b')
+        os.utime(os.path.join(directory, 'sub', 'b.md'), ns=(1, 1))
+        results = dict((r.path, (r.action, r.note_id)) for r in mirror.run())
+        self.assertEqual({'a.md': ('updated', note_id),
+                          'sub/b.md': ('unchanged',
+                                       mirror.manifest.get('sub/b.md')
+                                       ['note_id'])}, results)
+        self.assertEqual('new text for a', self.nh.get_note(note_id)['note'])
+        self.assertEqual(1, mirror.manifest.get('sub/b.md')['mtime'])
+
+        os.remove(os.path.join(directory, 'sub', 'b.md'))
+        self.assertEqual({'sub/b.md'}, mirror.removed())
+
+        # A note can only be updated with the password it was created with
+        self.write(directory, 'a.md', 'newer text for a')
+        mirror.password = 'other'
+        result, = mirror.run()
+        self.assertEqual('failed', result.action)
+        self.assertIsInstance(result.error, notehub.NotehubError)
+
+    def test_mirror_command(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.write(directory, 'a.md', 'note a')
+        notehub.Notehub.BASE_URL, base_url = (self.server.url,
+                                              notehub.Notehub.BASE_URL)
+        self.addCleanup(setattr, notehub.Notehub, 'BASE_URL', base_url)
+        args = ['--pid', 'pid', '--psk', 'psk', 'mirror', directory]
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            self.assertEqual(0, notehub.main(args))
+            self.assertEqual(0, notehub.main(args))
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(1, len(lines))
+        self.assertTrue(lines[0].startswith('created a.md '))
+
+    def run_command(self, args, stdin=''):
+        notehub.Notehub.BASE_URL, base_url = (self.server.url,
+                                              notehub.Notehub.BASE_URL)
+        self.addCleanup(setattr, notehub.Notehub, 'BASE_URL', base_url)
+        stdout = io.StringIO()
+        old_stdin, sys.stdin = sys.stdin, io.StringIO(stdin)
+        try:
+            with contextlib.redirect_stdout(stdout):
+                status = notehub.main(['--pid', 'pid', '--psk', 'psk'] +
+                                      args)
+        finally:
+            sys.stdin = old_stdin
+        return status, [json.loads(line)
+                        for line in stdout.getvalue().splitlines()]
+
+    def test_batch_commands(self):
+        status, lines = self.run_command(
+            ['create', '--password', 'abc123', '--parallel', '2'],
+            '{"note_text": "note one"}\n\n{"note_text": "note two"}\n')
+        self.assertEqual(0, status)
+        note_ids = dict((json.loads(line['input'])['note_text'],
+                         line['result']['noteID']) for line in lines)
+        self.assertEqual(['note one', 'note two'], sorted(note_ids))
+
+        spec = json.dumps({'note_id': note_ids['note one'],
+                           'new_note_text': 'new text'})
+        status, lines = self.run_command(['update', '--password', 'abc123',
+                                          spec, 'not json', '{"bad": 1}'])
+        self.assertEqual(1, status)
+        results = dict((line['input'], line) for line in lines)
+        self.assertIn('result', results[spec])
+        self.assertIn('Invalid JSON', results['not json']['error'])
+        self.assertIn('Invalid spec', results['{"bad": 1}']['error'])
+
+        status, lines = self.run_command(
+            ['get'], '\n'.join([note_ids['note one'], 'missing']))
+        self.assertEqual(1, status)
+        results = dict((line['input'], line) for line in lines)
+        self.assertEqual('new text',
+                         results[note_ids['note one']]['result']['note'])
+        self.assertEqual(200, results['missing']['status_code'])
+
+    def test_export_resumes_and_verifies(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        archive = os.path.join(directory, 'notes.jsonl.gz')
+        note_ids = [self.nh.create_note('note %d' % i, 'abc123')['noteID']
+                    for i in range(5)]
+        errors = notehub.export_notes(self.nh, note_ids[:3] + ['missing'],
+                                      archive, checkpoint_every=2)
+        self.assertEqual(['missing'], list(errors))
+        # An interrupted write after the checkpoint is thrown away
+        with open(archive, 'ab') as f:
+            f.write(b'\x1f\x8b partial member')
+        self.assertEqual({}, notehub.export_notes(self.nh, note_ids, archive))
+        notes = list(notehub.read_export(archive))
+        self.assertEqual(sorted(note_ids),
+                         sorted(note['noteID'] for note in notes))
+        self.assertEqual('note 0', [note for note in notes
+                                    if note['noteID'] == note_ids[0]][0]
+                                   ['note'])
+
+        self.nh.update_note(note_ids[1], 'changed', 'abc123')
+        results = dict(notehub.verify_export(self.nh, archive))
+        self.assertEqual('changed', results.pop(note_ids[1]))
+        self.assertEqual(set(['ok']), set(results.values()))
+
+    def test_streamed_notes_are_signed(self):
+        self.nh.psk = 'example of not a psk'
+        with self.assertRaises(notehub.NotehubError):
+            self.nh.create_note_stream(iter(['some test text']))
+
+
+class TestStreaming(unittest.TestCase):
+
+    def test_signature_matches_concatenated_text(self):
+        nh = notehub.Notehub(PID, PSK)
+        text = 'x\u00e9' * 100000
+        expected = md5((PID + PSK + 'id' + text + 'pw').encode('utf-8'))
+        self.assertEqual(expected.hexdigest(),
+                         nh._get_signature('id', text, 'pw'))
+
+    def split(self, body, size):
+        data = json.dumps(body).encode('utf-8')
+        written = []
+        fields = notehub._split_note(
+            (data[i:i + size] for i in range(0, len(data), size)),
+            written.append)
+        return ''.join(written), fields
+
+    def test_split_note(self):
+        body = deepcopy(SAMPLE_GET_NOTE)
+        body['note'] = 'a\\b "c" \u00e9\U0001f600\n\u0001' * 20
+        expected = dict(body)
+        del expected['note']
+        for size in (1, 2, 3, 7, 64 * 1024):
+            self.assertEqual((body['note'], expected), self.split(body, size))
+
+    def test_split_note_rejects_bad_json(self):
+        for data in (b'', b'[1]', b'{"note": "abc', b'{"a": 1', b'{1: 2}'):
+            with self.assertRaises(notehub.NotehubError):
+                notehub._split_note([data], lambda text: None)
+
+    def test_iterator_source_is_read_once(self):
+        source = notehub._NoteSource(iter(['abc']), 1024)
+        self.assertFalse(source.rereadable)
+        self.assertEqual([b'abc'], list(source))
+        with self.assertRaises(notehub.NotehubError):
+            list(source)
+
+
+class FakeAsyncResponse(object):
+    """Stands in for an aiohttp response in the AsyncNotehub tests."""
+
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def read(self):
+        if isinstance(self.body, Exception):
+            raise self.body
+        return json.dumps(self.body).encode('utf-8')
+
+
+class TestAsyncNotehub(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.nh = notehub.AsyncNotehub(PID, PSK, max_in_flight=2)
+        self.nh._session = Mock(closed=False)
+
+    def mock_response(self, body, status=200):
+        if not isinstance(body, Exception):
+            body = deepcopy(body)
+        self.nh._session.request = Mock(
+            return_value=FakeAsyncResponse(status, body))
+
+    async def test_get_note(self):
+        self.mock_response(SAMPLE_GET_NOTE)
+        note = await self.nh.get_note('2014/1/26/test')
+        expected_note = deepcopy(SAMPLE_GET_NOTE)
+        del expected_note['status']
+        self.assertEqual(expected_note, note)
+        args, kwargs = self.nh._session.request.call_args
+        self.assertEqual('GET', args[0])
+        self.assertEqual('2014/1/26/test', kwargs['params']['noteID'])
+
+    async def test_create_note_signs_like_notehub(self):
+        self.mock_response(SAMPLE_CREATE_NOTE)
+        note = await self.nh.create_note('some test text', 'abc123')
+        self.assertIn('some-test-text', note['noteID'])
+        data = self.nh._session.request.call_args[1]['data']
+        expected = notehub.Notehub(PID, PSK)._create_note_data(
+            'some test text', 'abc123')
+        self.assertEqual(expected, data)
+
+    async def test_update_note(self):
+        self.mock_response(SAMPLE_UPDATE_NOTE)
+        note = await self.nh.update_note('2014/1/18/test-7', 'the new text',
+                                         'abc123')
+        expected_note = deepcopy(SAMPLE_UPDATE_NOTE)
+        del expected_note['status']
+        self.assertEqual(expected_note, note)
+        self.assertEqual('PUT', self.nh._session.request.call_args[0][0])
+
+    async def test_get_note_coalesces_concurrent_calls(self):
+        self.mock_response(SAMPLE_GET_NOTE)
+        notes = await asyncio.gather(*[self.nh.get_note('2014/1/26/test')
+                                       for _ in range(5)])
+        self.assertEqual(1, self.nh._session.request.call_count)
+        self.assertEqual(4, self.nh.coalesced)
+        self.assertEqual(5, len(set(id(note) for note in notes)))
+        self.assertEqual({}, self.nh._flights)
+
+    async def test_update_note_drops_flight(self):
+        self.mock_response(SAMPLE_GET_NOTE)
+        first = asyncio.ensure_future(self.nh.get_note('2014/1/18/test-7'))
+        await asyncio.sleep(0)
+        self.assertIn('2014/1/18/test-7', self.nh._flights)
+        self.mock_response(SAMPLE_UPDATE_NOTE)
+        await self.nh.update_note('2014/1/18/test-7', 'the new text',
+                                  'abc123')
+        self.assertNotIn('2014/1/18/test-7', self.nh._flights)
+        await first
+
+    async def test_transport_errors_are_notehub_errors(self):
+        import aiohttp
+        self.nh._session.request = Mock(
+            side_effect=aiohttp.ClientConnectionError('refused'))
+        with self.assertRaises(notehub.NotehubError) as cm:
+            await self.nh.get_note('2014/1/26/test')
+        self.assertIsNone(cm.exception.status_code)
+        self.mock_response(asyncio.TimeoutError())
+        with self.assertRaises(notehub.NotehubError):
+            await self.nh.get_note('2014/1/26/test')
+        self.nh._session.request = Mock(
+            return_value=FakeAsyncResponse(200, None))
+        self.nh._session.request.return_value.read = \
+            lambda: asyncio.sleep(0, result=b'not json')
+        with self.assertRaises(notehub.NotehubError):
+            await self.nh.get_note('2014/1/26/test')
+
+    async def test_errors(self):
+        self.mock_response(SAMPLE_GET_NOTE, status=500)
+        with self.assertRaises(notehub.NotehubError):
+            await self.nh.get_note('2014/1/26/test')
+        bad_response = deepcopy(SAMPLE_GET_NOTE)
+        bad_response['status'] = {'success': False, 'message': 'Bad noteID.'}
+        self.mock_response(bad_response)
+        with self.assertRaises(notehub.NotehubError):
+            await self.nh.get_note('not a real noteId')
+
 
 if __name__ == '__main__':
     unittest.main()